@@ -1,14 +1,28 @@
 # audio_utils.py
 import os
+import json
 import tempfile
 import logging
 import time
-import wave
+import re
 import asyncio
+import subprocess
+from typing import Awaitable, Callable, Optional
+import numpy as np
 from pydub import AudioSegment
 from google import genai
 from google.genai import types
-from config import TRANSCRIPTION_MODEL, TRANSCRIPTION_PROMPT
+from config import (
+    TRANSCRIPTION_MODEL, TRANSCRIPTION_PROMPT,
+    TRANSCRIPTION_SEGMENT_THRESHOLD, TRANSCRIPTION_SEGMENT_SECONDS, TRANSCRIPTION_SEGMENT_SEARCH,
+    TRANSCRIPTION_SEGMENT_OVERLAP, TRANSCRIPTION_SEGMENT_CONCURRENCY,
+    TRANSCRIPTION_PREPROCESS, TRANSCRIPTION_SAMPLE_RATE, TRANSCRIPTION_BITRATE, TRANSCRIPTION_BATCH_TIMEOUT,
+    TTS_VOICE_NAME, TTS_BITRATE_STEPS,
+    VAD_FRAME_MS, VAD_THRESHOLD_DB, VAD_MIN_SPEECH_DB, VAD_MAX_SILENCE, VAD_PADDING,
+)
+from services.audio_pool import get_audio_pool
+from services.metrics import TELEGRAM_DOWNLOAD, TRANSCRIPTION, TTS_SYNTHESIS, TTS_ENCODE, count_error
+from services.tracing import span
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -38,7 +52,8 @@ def get_audio_duration(ogg_file_path: str) -> float:
         logger.error(f"Ошибка определения длительности: {e}")
         return 0.0
 
-def transcribe_with_gemini_sync(ogg_file_path: str, api_key: str, model_version=None, prompt=None) -> str:
+def transcribe_with_gemini_sync(ogg_file_path: str, api_key: str, model_version=None, prompt=None,
+                                duration: float | None = None) -> str:
     start_time = time.time()
     try:
         model_to_use = model_version if model_version else TRANSCRIPTION_MODEL
@@ -70,75 +85,482 @@ def transcribe_with_gemini_sync(ogg_file_path: str, api_key: str, model_version=
         return transcription
 
     except Exception as e:
+        count_error("transcription", e)
         logger.error(f"Ошибка транскрибации через Gemini API: {e}", exc_info=True)
         return f"❌ Ошибка транскрибации: {e}"
     finally:
         elapsed_time = time.time() - start_time
+        # Длительность передаёт вызывающий код: повторно декодировать аудио ради лога незачем
+        duration_text = f"{duration:.2f} секунд" if duration is not None else "н/д"
+        proc_time_logger.info(f"Метод: Gemini API, Длительность аудио: {duration_text}, Время обработки: {elapsed_time:.2f} секунд")
+
+async def transcribe_with_gemini(ogg_file_path: str, api_key: str, model_version=None, prompt=None,
+                                 duration: float | None = None) -> str:
+    with span("transcribe.gemini", duration=duration):
+        return await asyncio.to_thread(transcribe_with_gemini_sync, ogg_file_path, api_key, model_version, prompt, duration)
+
+# --- Сегментированная транскрибация длинных голосовых ---
+def frame_energy_db(samples: np.ndarray, sample_rate: int, frame_ms: int = 30) -> np.ndarray:
+    """Энергия (дБ) по кадрам длиной frame_ms для моно-сигнала float32 в диапазоне [-1, 1]."""
+    frame_len = max(1, int(sample_rate * frame_ms / 1000))
+    n_frames = len(samples) // frame_len
+    if n_frames == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = samples[:n_frames * frame_len].reshape(n_frames, frame_len)
+    rms = np.sqrt(np.mean(frames * frames, axis=1) + 1e-12)
+    return 20.0 * np.log10(rms)
+
+def segment_to_array(audio: AudioSegment) -> tuple[np.ndarray, int]:
+    """Переводит AudioSegment в моно float32 numpy-массив."""
+    mono = audio.set_channels(1)
+    samples = np.array(mono.get_array_of_samples(), dtype=np.float32)
+    samples /= float(1 << (8 * mono.sample_width - 1))
+    return samples, mono.frame_rate
+
+def find_silence_cuts(samples: np.ndarray, sample_rate: int,
+                      segment_seconds: float = TRANSCRIPTION_SEGMENT_SECONDS,
+                      search_seconds: float = TRANSCRIPTION_SEGMENT_SEARCH,
+                      frame_ms: int = 30) -> list[float]:
+    """
+    Подбирает точки разреза (в секундах) примерно каждые segment_seconds,
+    выбирая внутри окна ±search_seconds самый тихий кадр.
+    """
+    energy = frame_energy_db(samples, sample_rate, frame_ms)
+    frame_sec = frame_ms / 1000.0
+    total = len(samples) / sample_rate
+    cuts = []
+    target = segment_seconds
+    while target < total - segment_seconds / 2:
+        lo = max(0, int((target - search_seconds) / frame_sec))
+        hi = min(len(energy), int((target + search_seconds) / frame_sec) + 1)
+        if hi <= lo:
+            break
+        quietest = lo + int(np.argmin(energy[lo:hi]))
+        cut = (quietest + 0.5) * frame_sec
+        cuts.append(cut)
+        target = cut + segment_seconds
+    return cuts
+
+def export_segments(ogg_file_path: str, overlap: float = TRANSCRIPTION_SEGMENT_OVERLAP) -> list[str]:
+    """
+    Режет аудио по паузам на перекрывающиеся сегменты и сохраняет их во временные .ogg.
+    Возвращает пути к сегментам по порядку (вызывающий код удаляет их сам).
+    """
+    audio = AudioSegment.from_file(ogg_file_path)
+    samples, sample_rate = segment_to_array(audio)
+    cuts = find_silence_cuts(samples, sample_rate)
+    bounds = [0.0, *cuts, len(audio) / 1000.0]
+    paths = []
+    for start, end in zip(bounds, bounds[1:]):
+        start_ms = int(max(0.0, start - overlap) * 1000)
+        end_ms = int(min(len(audio) / 1000.0, end + overlap) * 1000)
+        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as tmp:
+            seg_path = tmp.name
+        audio[start_ms:end_ms].export(seg_path, format='ogg', codec='libopus')
+        paths.append(seg_path)
+    return paths
+
+# --- Предобработка: VAD, моно, понижение частоты ---
+def voice_activity_mask(energy_db: np.ndarray) -> np.ndarray:
+    """
+    Простая VAD по энергии: кадр считается речью, если он на VAD_THRESHOLD_DB громче
+    уровня шума (10-й перцентиль энергии) и не тише VAD_MIN_SPEECH_DB.
+    """
+    if energy_db.size == 0:
+        return np.zeros(0, dtype=bool)
+    noise_floor = float(np.percentile(energy_db, 10))
+    threshold = max(noise_floor + VAD_THRESHOLD_DB, VAD_MIN_SPEECH_DB)
+    return energy_db > threshold
+
+def speech_ranges(voiced: np.ndarray, frame_ms: int = VAD_FRAME_MS,
+                  max_silence: float = VAD_MAX_SILENCE, padding: float = VAD_PADDING) -> list[tuple[int, int]]:
+    """
+    По маске речи возвращает сохраняемые диапазоны (в мс): края без речи отрезаются,
+    паузы длиннее max_silence сжимаются до max_silence, вокруг речи остаётся padding.
+    """
+    if not voiced.any():
+        return []
+    pad = int(round(padding * 1000 / frame_ms))
+    if pad:
+        voiced = np.convolve(voiced.astype(np.int8), np.ones(2 * pad + 1, dtype=np.int8), mode='same') > 0
+    keep = voiced.copy()
+    max_sil = max(1, int(round(max_silence * 1000 / frame_ms)))
+    # Границы участков тишины: начала (False после True) и концы
+    padded = np.concatenate(([True], voiced, [True]))
+    starts = np.flatnonzero(padded[:-1] & ~padded[1:])
+    ends = np.flatnonzero(~padded[:-1] & padded[1:])
+    for start, end in zip(starts, ends):
+        if start == 0 or end == len(voiced):
+            continue  # ведущая/замыкающая тишина отрезается целиком
+        if end - start <= max_sil:
+            keep[start:end] = True
+        else:
+            head = max_sil // 2
+            keep[start:start + head] = True
+            keep[end - (max_sil - head):end] = True
+    padded = np.concatenate(([False], keep, [False]))
+    run_starts = np.flatnonzero(~padded[:-1] & padded[1:])
+    run_ends = np.flatnonzero(padded[:-1] & ~padded[1:])
+    return [(int(a) * frame_ms, int(b) * frame_ms) for a, b in zip(run_starts, run_ends)]
+
+def preprocess_for_transcription(ogg_file_path: str) -> tuple[str, dict]:
+    """
+    Готовит аудио к транскрибации: моно, TRANSCRIPTION_SAMPLE_RATE, вырезание пауз,
+    перекодирование в Opus TRANSCRIPTION_BITRATE.
+
+    Returns:
+        tuple[str, dict]: путь к новому временному файлу (или исходный, если выигрыша нет)
+                          и статистика: исходные/итоговые байты и секунды.
+    """
+    audio = AudioSegment.from_file(ogg_file_path)
+    stats = {
+        "orig_bytes": os.path.getsize(ogg_file_path),
+        "orig_seconds": len(audio) / 1000.0,
+    }
+    mono = audio.set_channels(1).set_frame_rate(TRANSCRIPTION_SAMPLE_RATE)
+    samples, sample_rate = segment_to_array(mono)
+    ranges = speech_ranges(voice_activity_mask(frame_energy_db(samples, sample_rate, VAD_FRAME_MS)))
+    if ranges:
+        trimmed = AudioSegment.empty()
+        for start_ms, end_ms in ranges:
+            trimmed += mono[start_ms:end_ms]
+    else:
+        # Речь не найдена (или очень тихая запись) — ничего не вырезаем
+        trimmed = mono
+
+    with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as tmp:
+        out_path = tmp.name
+    trimmed.export(out_path, format='ogg', codec='libopus', bitrate=TRANSCRIPTION_BITRATE)
+    stats["new_bytes"] = os.path.getsize(out_path)
+    stats["new_seconds"] = len(trimmed) / 1000.0
+
+    if stats["new_bytes"] >= stats["orig_bytes"] and stats["new_seconds"] >= stats["orig_seconds"]:
+        remove_temp_file(out_path)
+        stats["new_bytes"], stats["new_seconds"] = stats["orig_bytes"], stats["orig_seconds"]
+        return ogg_file_path, stats
+    return out_path, stats
+
+def _normalize_words(text: str) -> list[str]:
+    return [w for w in re.sub(r"[^\w\s]", " ", text.lower()).split() if w]
+
+def merge_overlap(previous: str, following: str, max_words: int = 12) -> str:
+    """
+    Склеивает два соседних фрагмента, убирая слова, повторённые из-за перекрытия сегментов:
+    ищется самый длинный совпадающий "хвост" previous и "голова" following (до max_words слов).
+    """
+    if not previous:
+        return following
+    if not following:
+        return previous
+    prev_words = _normalize_words(previous)
+    next_raw = following.split()
+    next_words = _normalize_words(following)
+    limit = min(max_words, len(prev_words), len(next_words))
+    for k in range(limit, 0, -1):
+        if prev_words[-k:] == next_words[:k]:
+            # Отбрасываем столько исходных слов following, сколько нормализованных совпало
+            dropped, taken = 0, 0
+            while taken < len(next_raw) and dropped < k:
+                dropped += len(_normalize_words(next_raw[taken]))
+                taken += 1
+            return f"{previous} {' '.join(next_raw[taken:])}".strip()
+    return f"{previous} {following}"
+
+async def transcribe_segmented(ogg_file_path: str, api_key: str,
+                               on_progress: Optional[Callable[[str, int, int], Awaitable[None]]] = None) -> str:
+    """
+    Транскрибирует длинное аудио параллельно по сегментам и склеивает результат по порядку.
+
+    on_progress(partial_text, done, total) вызывается по мере готовности сегментов
+    с текстом непрерывного готового префикса.
+    """
+    start_time = time.time()
+    seg_paths = await get_audio_pool().run(export_segments, ogg_file_path)
+    logger.info(f"Аудио разбито на {len(seg_paths)} сегментов для параллельной транскрибации")
+    results: list[Optional[str]] = [None] * len(seg_paths)
+    semaphore = asyncio.Semaphore(TRANSCRIPTION_SEGMENT_CONCURRENCY)
+    done = 0
+
+    def stitched_prefix() -> str:
+        text = ""
+        for part in results:
+            if part is None:
+                break
+            text = merge_overlap(text, part)
+        return text
+
+    async def run(index: int, path: str):
+        nonlocal done
+        async with semaphore:
+            text = await transcribe_with_gemini(path, api_key)
+        if not isinstance(text, str) or text.strip().startswith("❌"):
+            logger.warning(f"Сегмент {index + 1}/{len(seg_paths)} не распознан: {text}")
+            text = "[неразборчиво]"
+        results[index] = text.strip()
+        done += 1
+        if on_progress:
+            try:
+                await on_progress(stitched_prefix(), done, len(seg_paths))
+            except Exception as e:
+                logger.debug(f"Ошибка обновления прогресса транскрибации: {e}")
+
+    try:
+        await asyncio.gather(*(run(i, p) for i, p in enumerate(seg_paths)))
+    finally:
+        for path in seg_paths:
+            remove_temp_file(path)
+
+    if all(part == "[неразборчиво]" for part in results):
+        return "❌ Не удалось распознать ни один сегмент аудио."
+    proc_time_logger.info(f"Сегментированная транскрибация ({len(seg_paths)} сегм.): {time.time() - start_time:.2f}s")
+    return stitched_prefix()
+
+# --- Пакетная транскрибация коротких голосовых ---
+_BATCH_PROMPT = (
+    "{prompt}\n"
+    "Ниже {count} независимых аудиоклипов, каждому предшествует метка «Клип N». "
+    "Распознай каждый клип отдельно и верни JSON-массив объектов {{\"clip\": N, \"text\": \"...\"}} "
+    "по одному на каждый клип. Если речь в клипе неразборчива, верни для него пустую строку."
+)
+
+_BATCH_SCHEMA = types.Schema(
+    type=types.Type.ARRAY,
+    items=types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            "clip": types.Schema(type=types.Type.INTEGER),
+            "text": types.Schema(type=types.Type.STRING),
+        },
+        required=["clip", "text"],
+    ),
+)
+
+# Сверх TRANSCRIPTION_BATCH_TIMEOUT (сек): сам запрос обрывает SDK, ожидание потока — страховка
+_BATCH_TIMEOUT_GRACE = 5.0
+
+def transcribe_batch_sync(clips: list[bytes], api_key: str, model_version=None,
+                          timeout: float = TRANSCRIPTION_BATCH_TIMEOUT) -> dict[int, str]:
+    """
+    Распознаёт несколько коротких клипов одним запросом generate_content: аудио передаётся inline
+    (без загрузки в Files API), ответ — структурированный JSON. Возвращает {номер клипа с 0: текст}
+    только для клипов, которые модель вернула.
+    Таймаут задаётся самому HTTP-запросу: по истечении поток освобождается, а не продолжает ждать
+    ответ, пока клипы уже распознаются по отдельности.
+    """
+    start_time = time.time()
+    client = genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=int(timeout * 1000)))
+    contents = [_BATCH_PROMPT.format(prompt=TRANSCRIPTION_PROMPT, count=len(clips))]
+    for index, data in enumerate(clips):
+        contents.append(types.Part.from_text(text=f"Клип {index + 1}"))
+        contents.append(types.Part.from_bytes(data=data, mime_type="audio/ogg"))
+    response = client.models.generate_content(
+        model=model_version or TRANSCRIPTION_MODEL,
+        contents=contents,
+        config=types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=_BATCH_SCHEMA,
+        ),
+    )
+    items = response.parsed if isinstance(getattr(response, "parsed", None), list) else json.loads(response.text)
+    results: dict[int, str] = {}
+    for item in items:
         try:
-            duration = get_audio_duration(ogg_file_path) if os.path.exists(ogg_file_path) else 0
-            proc_time_logger.info(f"Метод: Gemini API, Длительность аудио: {duration:.2f} секунд, Время обработки: {elapsed_time:.2f} секунд")
-        except Exception:
-            pass
+            index = int(item["clip"]) - 1
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= index < len(clips) and isinstance(item.get("text"), str) and item["text"].strip():
+            results[index] = item["text"].strip()
+    proc_time_logger.info(
+        f"Метод: Gemini API (пакет {len(clips)} клипов, распознано {len(results)}), "
+        f"Время обработки: {time.time() - start_time:.2f} секунд"
+    )
+    return results
 
-async def transcribe_with_gemini(ogg_file_path: str, api_key: str, model_version=None, prompt=None) -> str:
-    return await asyncio.to_thread(transcribe_with_gemini_sync, ogg_file_path, api_key, model_version, prompt)
+async def transcribe_voice_batch(ogg_filenames: list[str], api_key: str) -> list[str]:
+    """
+    Транскрибирует несколько коротких голосовых одним запросом и раздаёт тексты по порядку.
+
+    Клипы, которых нет в ответе, а также весь пакет при ошибке или превышении
+    TRANSCRIPTION_BATCH_TIMEOUT распознаются по отдельности обычным путём.
+    """
+    prepared = await asyncio.gather(*(prepare_for_transcription(path) for path in ogg_filenames))
+    results: dict[int, str] = {}
+    try:
+        clips = []
+        for path, _ in prepared:
+            with open(path, "rb") as f:
+                clips.append(f.read())
+        with TRANSCRIPTION.time(mode="batch"), span("transcribe.batch", clips=len(clips)):
+            # Запрос ограничен таймаутом SDK; wait_for с запасом — страховка на случай зависшего потока
+            results = await asyncio.wait_for(
+                asyncio.to_thread(transcribe_batch_sync, clips, api_key),
+                timeout=TRANSCRIPTION_BATCH_TIMEOUT + _BATCH_TIMEOUT_GRACE,
+            )
+    except asyncio.TimeoutError as e:
+        count_error("transcription", e)
+        logger.warning(f"Пакетная транскрибация не уложилась в {TRANSCRIPTION_BATCH_TIMEOUT}s, распознаю по отдельности")
+    except Exception as e:
+        count_error("transcription", e)
+        logger.warning(f"Пакетная транскрибация не удалась, распознаю по отдельности: {e}")
+
+    async def single(index: int) -> str:
+        if index in results:
+            return results[index]
+        path, duration = prepared[index]
+        return await transcribe_with_gemini(path, api_key, duration=duration)
+
+    try:
+        return list(await asyncio.gather(*(single(i) for i in range(len(prepared)))))
+    finally:
+        for (path, _), original in zip(prepared, ogg_filenames):
+            if path != original:
+                remove_temp_file(path)
 
 async def process_voice_message(bot, message, api_key: str) -> str:
+    return await process_voice_file(bot, message.voice.file_id, api_key)
+
+async def process_voice_file(bot, file_id: str, api_key: str) -> str:
+    """Скачивает голосовое по file_id и транскрибирует его (нужно для восстановления задач без объекта Message)."""
     start_time = time.time()
     ogg_filename = None
     try:
-        file_info = await bot.get_file(message.voice.file_id)
+        ogg_filename = await download_voice_file(bot, file_id)
+        return await transcribe_voice_file(ogg_filename, api_key)
+    except Exception as e:
+        logger.error(f"Ошибка обработки голосового сообщения: {e}", exc_info=True)
+        return f"❌ Ошибка: {e}"
+    finally:
+        remove_temp_file(ogg_filename)
+        proc_time_logger.info(f"Полное время обработки: {time.time() - start_time:.2f}s")
+
+async def download_voice_file(bot, file_id: str) -> str:
+    """Скачивает голосовое из Telegram во временный .ogg и возвращает путь к нему."""
+    start_time = time.time()
+    with span("telegram.download", kind="voice"):
+        file_info = await bot.get_file(file_id)
         file_bytes = await bot.download_file(file_info.file_path)
         with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as tmp_file:
             tmp_file.write(file_bytes.read() if hasattr(file_bytes, 'read') else file_bytes)
             ogg_filename = tmp_file.name
+    TELEGRAM_DOWNLOAD.observe(time.time() - start_time, kind="voice")
+    proc_time_logger.info(f"Скачивание голосового: {time.time() - start_time:.2f}s")
+    return ogg_filename
 
-        duration = get_audio_duration(ogg_filename)
-        logger.info(f"Длительность: {duration:.2f}s")
+async def prepare_for_transcription(ogg_filename: str) -> tuple[str, float]:
+    """
+    Предобработка в пуле аудио (если включена). Возвращает путь к подготовленному файлу
+    (исходный, если предобработка выключена или не удалась) и его длительность.
+    """
+    if TRANSCRIPTION_PREPROCESS:
+        try:
+            with span("transcribe.preprocess"):
+                prepared_path, stats = await get_audio_pool().run(preprocess_for_transcription, ogg_filename)
+            proc_time_logger.info(
+                f"Предобработка: сэкономлено {stats['orig_bytes'] - stats['new_bytes']} байт "
+                f"и {stats['orig_seconds'] - stats['new_seconds']:.2f} с "
+                f"({stats['orig_seconds']:.2f} с → {stats['new_seconds']:.2f} с)"
+            )
+            return prepared_path, stats["new_seconds"]
+        except Exception as e:
+            logger.warning(f"Предобработка аудио не удалась, отправляем исходный файл: {e}")
+    return ogg_filename, await get_audio_pool().run(get_audio_duration, ogg_filename)
 
-        text = await transcribe_with_gemini(ogg_filename, api_key)
-        return text
-    except Exception as e:
-        logger.error(f"Ошибка обработки голосового сообщения: {e}", exc_info=True)
-        return f"❌ Ошибка: {e}"
+async def transcribe_voice_file(ogg_filename: str, api_key: str,
+                                on_progress: Optional[Callable[[str, int, int], Awaitable[None]]] = None) -> str:
+    """
+    Транскрибирует уже скачанный .ogg файл.
+    Аудио длиннее TRANSCRIPTION_SEGMENT_THRESHOLD распознаётся параллельно по сегментам.
+    """
+    started = time.monotonic()
+    prepared_path, duration = await prepare_for_transcription(ogg_filename)
+    logger.info(f"Длительность: {duration:.2f}s")
+    segmented = bool(TRANSCRIPTION_SEGMENT_THRESHOLD and duration > TRANSCRIPTION_SEGMENT_THRESHOLD)
+
+    try:
+        if segmented:
+            return await transcribe_segmented(prepared_path, api_key, on_progress)
+        return await transcribe_with_gemini(prepared_path, api_key, duration=duration)
     finally:
-        if ogg_filename and os.path.exists(ogg_filename):
-            try:
-                os.remove(ogg_filename)
-                logger.info(f"Удалён временный файл {ogg_filename}")
-            except Exception as e:
-                logger.warning(f"Не удалось удалить {ogg_filename}: {e}")
-        proc_time_logger.info(f"Полное время обработки: {time.time() - start_time:.2f}s")
+        # Вместе с предобработкой: это время пользователь ждёт текст
+        TRANSCRIPTION.observe(time.monotonic() - started, mode="segmented" if segmented else "single")
+        if prepared_path != ogg_filename:
+            remove_temp_file(prepared_path)
+
+def remove_temp_file(path: str | None):
+    """Удаляет временный файл, если он существует."""
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+            logger.info(f"Удалён временный файл {path}")
+        except Exception as e:
+            logger.warning(f"Не удалось удалить {path}: {e}")
+
+# --- Озвучка (TTS) ---
+TTS_SAMPLE_RATE = 24000  # Gemini TTS отдаёт PCM 24 кГц, 16 бит, моно
+
+def tts_bitrate_for(seconds: float) -> str:
+    """Подбирает битрейт Opus по длительности речи: короткие ответы — качественнее, длинные — компактнее."""
+    for max_seconds, bitrate in TTS_BITRATE_STEPS:
+        if max_seconds is None or seconds <= max_seconds:
+            return bitrate
+    return TTS_BITRATE_STEPS[-1][1]
+
+def encode_pcm_to_ogg_opus_sync(pcm: bytes, sample_rate: int = TTS_SAMPLE_RATE, bitrate: str | None = None) -> bytes:
+    """
+    Кодирует сырой PCM s16le (моно) в OGG/Opus целиком в памяти: PCM подаётся ffmpeg в stdin,
+    готовый контейнер читается из stdout — без временных файлов.
+    """
+    seconds = len(pcm) / (sample_rate * 2)
+    bitrate = bitrate or tts_bitrate_for(seconds)
+    proc = subprocess.run(
+        [
+            AudioSegment.converter, "-hide_banner", "-loglevel", "error",
+            "-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0",
+            "-c:a", "libopus", "-b:a", bitrate, "-application", "voip",
+            "-ar", "48000", "-f", "ogg", "pipe:1",
+        ],
+        input=pcm,
+        capture_output=True,
+    )
+    if proc.returncode != 0 or not proc.stdout:
+        raise RuntimeError(f"ffmpeg завершился с кодом {proc.returncode}: {proc.stderr.decode(errors='ignore').strip()}")
+    logger.info(f"PCM {seconds:.1f} с закодирован в OGG/Opus {bitrate}: {len(proc.stdout)} байт")
+    return proc.stdout
 
-async def generate_audio_to_opus(text: str, model_version: str, api_key: str) -> tuple[bool, str]:
+async def encode_pcm_to_ogg_opus(pcm: bytes, sample_rate: int = TTS_SAMPLE_RATE, bitrate: str | None = None) -> bytes:
+    """Кодирование в OGG/Opus в пуле обработки аудио (см. encode_pcm_to_ogg_opus_sync)."""
+    # Замер здесь, а не в воркере: метрики процессов пула в основной процесс не попадают
+    with TTS_ENCODE.time(), span("tts.encode", bytes=len(pcm)):
+        return await get_audio_pool().run(encode_pcm_to_ogg_opus_sync, pcm, sample_rate, bitrate)
+
+async def synthesize_speech_pcm(text: str, model_version: str, api_key: str) -> bytes:
     """
-    Генерация аудио (OPUS) через Gemini:
+    Запрашивает озвучку у Gemini и возвращает сырой PCM:
       - формируем запрос CONTENT/Part по спецификации (AUDIO-модальность + SpeechConfig/VoiceConfig);
-      - вытаскиваем аудиобайт из parts.inline_data.data в ответе;
-      - сохраняем PCM->WAV->OPUS (libopus), совместимый с Telegram. 
+      - вытаскиваем аудиобайт из parts.inline_data.data в ответе.
     """
-    try:
-        logger.info(f"Generating audio for text: {text[:50]}...")
-        client = genai.Client(api_key=api_key)
+    logger.info(f"Generating audio for text: {text[:50]}...")
+    client = genai.Client(api_key=api_key)
 
-        # Формируем корректный CONTENT (а не просто строку), чтобы гарантированно получить аудиочасти
-        contents = [
-            types.Content(
-                role="user",
-                parts=[types.Part.from_text(text=text)]
-            )
-        ]
-
-        config = types.GenerateContentConfig(
-            response_modalities=["AUDIO"],
-            speech_config=types.SpeechConfig(
-                voice_config=types.VoiceConfig(
-                    prebuilt_voice_config=types.PrebuiltVoiceConfig(voice_name='Sulafat')
-                )
-            ),
+    # Формируем корректный CONTENT (а не просто строку), чтобы гарантированно получить аудиочасти
+    contents = [
+        types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=text)]
         )
+    ]
+
+    config = types.GenerateContentConfig(
+        response_modalities=["AUDIO"],
+        speech_config=types.SpeechConfig(
+            voice_config=types.VoiceConfig(
+                prebuilt_voice_config=types.PrebuiltVoiceConfig(voice_name=TTS_VOICE_NAME)
+            )
+        ),
+    )
 
-        # Вызываем синхронный SDK в пуле потоков (не блокируем event loop)
+    # Вызываем синхронный SDK в пуле потоков (не блокируем event loop)
+    with TTS_SYNTHESIS.time(), span("tts.synthesize", chars=len(text)):
         response = await asyncio.to_thread(
             client.models.generate_content,
             model=model_version,
@@ -146,52 +568,27 @@ async def generate_audio_to_opus(text: str, model_version: str, api_key: str) ->
             config=config
         )
 
-        # По спецификации TTS аудио приходит в parts.inline_data.data (PCM 24kHz, 16-bit) [docs]
-        # Ищем байты во всех кандидатах/частях
-        audio_bytes = None
-        if getattr(response, "candidates", None):
-            for cand in response.candidates:
-                if cand and cand.content and cand.content.parts:
-                    for part in cand.content.parts:
-                        if getattr(part, "inline_data", None) and getattr(part.inline_data, "data", None):
-                            audio_bytes = part.inline_data.data
-                            break
-                if audio_bytes:
-                    break
-
-        if not audio_bytes:
-            logger.error("No inline data found in response parts")
-            return (False, "No inline data found in response parts")
-
-        # Сохраняем PCM -> WAV
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp_wav:
-            wav_filename = tmp_wav.name
-
-        with wave.open(wav_filename, 'wb') as wf:
-            wf.setnchannels(1)        # mono
-            wf.setsampwidth(2)        # 16-bit (2 bytes)
-            wf.setframerate(24000)    # 24kHz
-            wf.writeframes(audio_bytes)
-
-        # Конвертация в OPUS для Telegram
-        opus_filename = wav_filename.replace('.wav', '.opus')
-        AudioSegment.from_wav(wav_filename).export(
-            opus_filename,
-            format='opus',
-            codec='libopus',
-            bitrate='64k',
-            parameters=["-ar", "48000", "-ac", "1"]
-        )
-
-        # Чистим WAV
-        try:
-            os.unlink(wav_filename)
-        except Exception:
-            pass
+    # По спецификации TTS аудио приходит в parts.inline_data.data (PCM 24kHz, 16-bit) [docs]
+    # Ищем байты во всех кандидатах/частях
+    if getattr(response, "candidates", None):
+        for cand in response.candidates:
+            if cand and cand.content and cand.content.parts:
+                for part in cand.content.parts:
+                    if getattr(part, "inline_data", None) and getattr(part.inline_data, "data", None):
+                        return part.inline_data.data
+    raise RuntimeError("No inline data found in response parts")
 
-        logger.info(f"Создан OPUS файл: {opus_filename} ({os.path.getsize(opus_filename)} байт)")
-        return (True, opus_filename)
+async def generate_audio_to_opus(text: str, model_version: str, api_key: str) -> tuple[bool, bytes | str]:
+    """
+    Генерация аудио (OGG/Opus, совместимо с send_voice) через Gemini.
 
+    Returns:
+        tuple[bool, bytes | str]: (True, байты OGG/Opus) или (False, текст ошибки).
+    """
+    try:
+        pcm = await synthesize_speech_pcm(text, model_version, api_key)
+        return (True, await encode_pcm_to_ogg_opus(pcm))
     except Exception as e:
+        count_error("tts", e)
         logger.exception(f"Error in generate_audio_to_opus: {str(e)}")
         return (False, str(e))
@@ -5,16 +5,25 @@ from .start_handler import start_router
 from .voice_handler import voice_router
 from .text_handler import text_router
 from .photo_handler import photo_router
+from .document_handler import document_router
 from .settings_handler import settings_router
 from .model_handler import model_router
+from .role_handler import role_router
+from .perf_handler import perf_router
+from services.tracing import TraceMiddleware
 
 def register_handlers(dp: Router) -> None:
     """
     Регистрирует все роутеры в корневом диспетчере (Dispatcher в aiogram 3 — это Router).
+    Каждое обновление обрабатывается в своей трассе (trace_id в логе, спаны этапов).
     """
+    dp.update.outer_middleware(TraceMiddleware())
     dp.include_router(start_router)
     dp.include_router(settings_router)
     dp.include_router(model_router)
+    dp.include_router(role_router)
+    dp.include_router(perf_router)
     dp.include_router(voice_router)
     dp.include_router(photo_router)
+    dp.include_router(document_router)
     dp.include_router(text_router)
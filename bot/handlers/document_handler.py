@@ -0,0 +1,109 @@
+# bot/handlers/document_handler.py
+import asyncio
+import logging
+from aiogram import Router, F
+from aiogram.types import Message
+from mod_llm import get_model_family
+from services.model_service import generate_model_response
+from services.context_service import get_chat_model
+from services.document_service import (
+    document_kind, prepare_document, ExtractedDocument, UploadedDocument,
+)
+from services.telegram_outbound import get_outbound
+from services.cancellation import get_cancellation, RequestCancelled
+from utils.helpers import send_response
+from config import PLACEHOLDER_MODE, DOCUMENT_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+document_router = Router()
+
+_DEFAULT_TASK = "Кратко изложи содержание документа и выдели главное"
+
+
+def _build_prompt(file_name: str, task: str, doc) -> str:
+    if isinstance(doc, UploadedDocument):
+        return f"{task}\n\n(Документ «{file_name}» приложен к сообщению.)"
+    note = "\n[Документ обрезан: показано начало, остальное не поместилось в контекст модели]" if doc.truncated else ""
+    return f"{task}\n\n[ДОКУМЕНТ: {file_name}]\n{doc.text}{note}\n[КОНЕЦ ДОКУМЕНТА]"
+
+
+def _history_prompt(file_name: str, task: str, doc) -> str:
+    """Запись в истории чата: задача и имя документа, без текста — иначе он уходил бы в каждый следующий запрос."""
+    if isinstance(doc, UploadedDocument):
+        return f"{task}\n\n[Документ «{file_name}» (Files API)]"
+    return f"{task}\n\n[Документ «{file_name}», {len(doc.text)} символов{', обрезан' if doc.truncated else ''}]"
+
+
+def _truncation_notice(doc) -> str:
+    if isinstance(doc, ExtractedDocument) and doc.truncated:
+        return (f"\n\n⚠️ Документ не поместился в контекст модели: проанализировано только начало "
+                f"(~{len(doc.text)} символов).")
+    return ""
+
+
+@document_router.message(F.document)
+async def handle_document(message: Message):
+    chat_id = message.chat.id
+    document = message.document
+    file_name = document.file_name or "документ"
+
+    kind = document_kind(document)
+    if kind is None:
+        await message.reply("❌ Поддерживаются документы txt, md, pdf и docx.")
+        return
+    if (document.file_size or 0) > DOCUMENT_MAX_BYTES:
+        await message.reply(f"❌ Файл слишком большой: бот может скачать не больше {DOCUMENT_MAX_BYTES // (1024 * 1024)} МБ.")
+        return
+
+    outbound = get_outbound()
+    status_msg = None
+    # /clear и смена модели прерывают анализ (см. services/cancellation.py)
+    with get_cancellation().request(chat_id, "document"):
+        try:
+            # 1) Статус (в режиме 'typing' вместо статуса и эмодзи — «печатает...»)
+            if PLACEHOLDER_MODE != "typing":
+                status_msg = await message.reply("_Читаю документ..._", parse_mode="Markdown")
+
+            # 2) Эмодзи документа; удаляется вместе со статусом одним deleteMessages
+            async with outbound.placeholder(message.bot, chat_id, "📄"):
+                model_family = get_model_family(get_chat_model(chat_id))
+                try:
+                    doc = await prepare_document(message.bot, chat_id, document, kind, model_family)
+                except RuntimeError as e:
+                    # Нет библиотеки для формата или Files API не принял файл
+                    outbound.delete(message.bot, chat_id, getattr(status_msg, "message_id", None))
+                    await message.reply(f"❌ {e}")
+                    return
+
+                if isinstance(doc, ExtractedDocument) and not doc.text:
+                    outbound.delete(message.bot, chat_id, getattr(status_msg, "message_id", None))
+                    await message.reply("❌ В документе не найден текст (возможно, это скан).")
+                    return
+
+                if status_msg:
+                    await outbound.edit_text(message.bot, chat_id, status_msg.message_id, "_Анализирую документ..._", parse_mode="Markdown")
+
+                task = message.caption or _DEFAULT_TASK
+                prompt = _build_prompt(file_name, task, doc)
+                files = [doc] if isinstance(doc, UploadedDocument) else None
+                # Генерация (sync -> to_thread), не блокируем event loop
+                response_text = await asyncio.to_thread(
+                    generate_model_response, chat_id, prompt, None,
+                    files=files, history_prompt=_history_prompt(file_name, task, doc),
+                )
+
+                if not response_text:
+                    await message.reply("❌ Не удалось проанализировать документ.")
+                else:
+                    await send_response(message.bot, chat_id, response_text + _truncation_notice(doc), message.message_id)
+
+                # Удаляем плейсхолдеры
+                outbound.delete(message.bot, chat_id, getattr(status_msg, "message_id", None))
+
+        except RequestCancelled as e:
+            logger.info(f"Анализ документа в чате {chat_id} отменён: {e.reason}")
+            outbound.delete(message.bot, chat_id, getattr(status_msg, "message_id", None))
+        except Exception as e:
+            logger.error(f"Ошибка при обработке документа: {e}", exc_info=True)
+            await message.reply("❌ Произошла ошибка при анализе документа")
@@ -4,7 +4,8 @@ from aiogram import Router, F
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.filters import Command
 from services.context_service import get_chat_model, set_chat_model
-from mod_llm import MODELS, get_model_info
+from services.cancellation import get_cancellation, REASON_SETTINGS
+from mod_llm import get_registry, get_model_info
 
 logger = logging.getLogger(__name__)
 
@@ -29,16 +30,8 @@ async def model_menu(message: Message):
     # Создаем кнопки для каждого семейства моделей
     keyboard_buttons = []
     
-    # Группируем модели по семействам
-    families = {}
-    for model in MODELS:
-        family = model['family']
-        if family not in families:
-            families[family] = []
-        families[family].append(model)
-    
-    # Создаем кнопки для каждого семейства
-    for family_name, family_models in families.items():
+    # Создаем кнопки для каждого семейства (порядок — как в каталоге моделей)
+    for family_name in get_registry().families():
         family_display = {
             'gemini': '🔮 Gemini',
             'gemma': '💎 Gemma', 
@@ -67,7 +60,7 @@ async def show_family_models(callback: CallbackQuery):
     family_name = callback.data.split("_")[1]
     
     # Фильтруем модели по семейству
-    family_models = [model for model in MODELS if model['family'] == family_name]
+    family_models = get_registry().by_family(family_name)
     
     if not family_models:
         await callback.answer("❌ Модели не найдены")
@@ -122,7 +115,9 @@ async def select_model(callback: CallbackQuery):
         await callback.answer("❌ Модель не найдена")
         return
     
-    # Устанавливаем новую модель для чата
+    # Устанавливаем новую модель для чата; ответы, которые ещё готовит прежняя модель, отменяются
+    if model_id != get_chat_model(chat_id):
+        get_cancellation().cancel_chat(chat_id, REASON_SETTINGS)
     set_chat_model(chat_id, model_id)
     
     await callback.answer(f"✅ Выбрана модель: {selected_model['name']}")
@@ -0,0 +1,82 @@
+# bot/handlers/perf_handler.py - aiogram 3.x version
+import logging
+import os
+from aiogram import Router
+from aiogram.types import Message
+from aiogram.filters import Command
+from config import MESSAGE_CHUNK_CHARS
+from services.metrics import get_metrics, Histogram, ERRORS
+
+logger = logging.getLogger(__name__)
+
+perf_router = Router()
+
+# Заголовки гистограмм в отчёте (порядок — как проходит запрос)
+_TITLES = {
+    "bot_telegram_download_seconds": "Скачивание из Telegram",
+    "bot_transcription_seconds": "Транскрибация",
+    "bot_queue_wait_seconds": "Ожидание в очереди",
+    "bot_stage_seconds": "Этапы конвейера",
+    "bot_context_seconds": "Контекст (получение и обрезка)",
+    "bot_provider_ttft_seconds": "Модель: до первого фрагмента",
+    "bot_provider_seconds": "Модель: полный ответ",
+    "bot_tts_synthesis_seconds": "Синтез речи",
+    "bot_tts_encode_seconds": "Кодирование OGG/Opus",
+    "bot_telegram_request_seconds": "Запросы к Bot API",
+}
+
+
+def _admin_ids() -> set[int]:
+    """ADMIN_IDS из .env: id пользователей через запятую."""
+    ids = set()
+    for value in os.getenv("ADMIN_IDS", "").replace(" ", "").split(","):
+        if value.lstrip("-").isdigit():
+            ids.add(int(value))
+    return ids
+
+
+def _format_seconds(value) -> str:
+    if value is None:
+        return "—"
+    return f"{value * 1000:.0f}мс" if value < 1 else f"{value:.1f}с"
+
+
+def _histogram_lines(histogram: Histogram) -> list[str]:
+    lines = []
+    for labels, count, total in sorted(histogram.series(), key=lambda s: -s[1]):
+        name = ", ".join(v for v in labels.values() if v) or "всего"
+        p50 = histogram.quantile(0.5, **labels)
+        p95 = histogram.quantile(0.95, **labels)
+        lines.append(
+            f"  {name}: n={count}, ср. {_format_seconds(total / count)}, "
+            f"p50 {_format_seconds(p50)}, p95 {_format_seconds(p95)}"
+        )
+    return lines
+
+
+def build_report() -> str:
+    """Сводка задержек по этапам и ошибок (квантили — оценка по корзинам гистограмм)."""
+    histograms = {m.name: m for m in get_metrics().metrics() if isinstance(m, Histogram)}
+    sections = ["📊 Производительность (с момента запуска)"]
+    for name, title in _TITLES.items():
+        histogram = histograms.get(name)
+        lines = _histogram_lines(histogram) if histogram else []
+        if lines:
+            sections.append(f"\n{title}:\n" + "\n".join(lines[:6]))
+    errors = sorted(ERRORS.series(), key=lambda s: -s[1])
+    if errors:
+        sections.append("\nОшибки:\n" + "\n".join(
+            f"  {labels['stage']} / {labels['error']}: {value:g}" for labels, value in errors[:10]
+        ))
+    if len(sections) == 1:
+        sections.append("\nДанных пока нет.")
+    return "\n".join(sections)
+
+
+@perf_router.message(Command("perf"))
+async def perf_command(message: Message):
+    """Задержки по этапам обработки — только для администраторов (ADMIN_IDS)"""
+    if not message.from_user or message.from_user.id not in _admin_ids():
+        await message.reply("⛔ Команда доступна только администраторам бота (ADMIN_IDS в .env).")
+        return
+    await message.reply(build_report()[:MESSAGE_CHUNK_CHARS])
@@ -1,61 +1,77 @@
 # bot/handlers/photo_handler.py
 import asyncio
 import logging
-from aiogram import Router, F
+from aiogram import Bot, Router, F
 from aiogram.types import Message
 from services.model_service import generate_model_response
+from services.media_group import get_media_group_collector
+from services.telegram_outbound import get_outbound
+from services.cancellation import get_cancellation, RequestCancelled
+from services.metrics import TELEGRAM_DOWNLOAD
+from services.tracing import span
+from utils.helpers import send_response
+from config import PLACEHOLDER_MODE, MEDIA_GROUP_MAX_IMAGES
 
 logger = logging.getLogger(__name__)
 
 photo_router = Router()
 
-MAX_MSG_LEN = 4000
-
-def _split_text(text: str, chunk: int = MAX_MSG_LEN):
-    for i in range(0, len(text), chunk):
-        yield text[i:i + chunk]
+async def _download_photo(bot: Bot, message: Message) -> bytes:
+    # Скачиваем самое большое фото
+    photo = message.photo[-1]
+    with TELEGRAM_DOWNLOAD.time(kind="photo"), span("telegram.download", kind="photo"):
+        file_info = await bot.get_file(photo.file_id)  # получение file_path [2]  # noqa: E501
+        file_obj = await bot.download_file(file_info.file_path)  # скачивание файла [2]  # noqa: E501
+    return file_obj.read() if hasattr(file_obj, "read") else file_obj  # bytes для модели [2]  # noqa: E501
 
 @photo_router.message(F.photo)
 async def handle_photo(message: Message):
     chat_id = message.chat.id
 
-    try:
-        # 1) Статус
-        status_msg = await message.reply("_Анализирую изображение..._", parse_mode="Markdown")  # отдельный текст [1]  # noqa: E501
-        # 2) Эмодзи поиска
-        icon_msg = await message.bot.send_message(chat_id, "🔎")  # отдельный эмодзи [2]  # noqa: E501
-
-        # Скачиваем самое большое фото
-        photo = message.photo[-1]
-        file_info = await message.bot.get_file(photo.file_id)  # получение file_path [2]  # noqa: E501
-        file_obj = await message.bot.download_file(file_info.file_path)  # скачивание файла [2]  # noqa: E501
-        image_bytes = file_obj.read() if hasattr(file_obj, "read") else file_obj  # bytes для модели [2]  # noqa: E501
-
-        user_text = message.caption if message.caption else "Опиши это изображение"
-
-        # Генерация (sync -> to_thread) с image_bytes
-        response_text = await asyncio.to_thread(generate_model_response, chat_id, user_text, image_bytes)  # не блокируем loop [3][4]  # noqa: E501
-
-        # Ответ
-        if not response_text:
-            await message.reply("❌ Не удалось проанализировать изображение.")
-        else:
-            first = True
-            for chunk in _split_text(response_text):
-                if first:
-                    await message.reply(chunk, disable_web_page_preview=True)
-                    first = False
+    # Альбом: обрабатываем один раз, всеми фото сразу (остальные части просто отдают их ведущему)
+    messages = [message]
+    if message.media_group_id:
+        messages = await get_media_group_collector().collect(message)
+        if messages is None:
+            return
+        messages = messages[:MEDIA_GROUP_MAX_IMAGES]
+    first = messages[0]
+
+    outbound = get_outbound()
+    status_msg = None
+    # /clear и смена модели прерывают анализ (см. services/cancellation.py)
+    with get_cancellation().request(chat_id, "photo"):
+        try:
+            # 1) Статус (в режиме 'typing' вместо статуса и эмодзи — «печатает...»)
+            if PLACEHOLDER_MODE != "typing":
+                status_text = "_Анализирую изображение..._" if len(messages) == 1 else f"_Анализирую изображения ({len(messages)})..._"
+                status_msg = await first.reply(status_text, parse_mode="Markdown")  # отдельный текст [1]  # noqa: E501
+
+            # 2) Эмодзи поиска; удаляется вместе со статусом одним deleteMessages
+            async with outbound.placeholder(message.bot, chat_id, "🔎"):
+                # Все фото альбома скачиваются параллельно
+                images = await asyncio.gather(*(_download_photo(message.bot, m) for m in messages))
+
+                caption = next((m.caption for m in messages if m.caption), None)
+                user_text = caption or ("Опиши это изображение" if len(images) == 1 else "Опиши эти изображения")
+
+                # Генерация (sync -> to_thread): одно фото — bytes, альбом — список bytes одним запросом
+                image_arg = images[0] if len(images) == 1 else list(images)
+                response_text = await asyncio.to_thread(generate_model_response, chat_id, user_text, image_arg)  # не блокируем loop [3][4]  # noqa: E501
+
+                # Ответ
+                if not response_text:
+                    await first.reply("❌ Не удалось проанализировать изображение.")
                 else:
-                    await message.answer(chunk, disable_web_page_preview=True)
-
-        # Удаляем плейсхолдеры
-        for mid in (getattr(status_msg, "message_id", None), getattr(icon_msg, "message_id", None)):
-            if mid:
-                try:
-                    await message.bot.delete_message(chat_id, mid)  # удаляем оба [1]  # noqa: E501
-                except Exception:
-                    pass
-
-    except Exception as e:
-        logger.error(f"Ошибка при обработке фото: {e}", exc_info=True)
-        await message.reply("❌ Произошла ошибка при анализе изображения")
+                    # Markdown → HTML Telegram, части по границам абзацев; очень длинный ответ — файлом
+                    await send_response(message.bot, chat_id, response_text, first.message_id)
+
+                # Удаляем плейсхолдеры
+                outbound.delete(message.bot, chat_id, getattr(status_msg, "message_id", None))
+
+        except RequestCancelled as e:
+            logger.info(f"Анализ изображений в чате {chat_id} отменён: {e.reason}")
+            outbound.delete(message.bot, chat_id, getattr(status_msg, "message_id", None))
+        except Exception as e:
+            logger.error(f"Ошибка при обработке фото: {e}", exc_info=True)
+            await first.reply("❌ Произошла ошибка при анализе изображения")
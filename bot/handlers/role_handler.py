@@ -0,0 +1,104 @@
+# bot/handlers/role_handler.py - aiogram 3.x version
+import logging
+from aiogram import Router, F
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.filters import Command, CommandObject
+from services.context_service import get_chat_role, set_chat_role
+from services.role_manager import get_role_manager
+from services.cancellation import get_cancellation, REASON_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+role_router = Router()
+
+# Значения ChatSettings.role: None — роль по умолчанию (person.set), '' — без роли
+_DEFAULT_KEY = "default"
+_NONE_KEY = "none"
+
+
+def _role_title(chat_id: int) -> str:
+    role = get_chat_role(chat_id)
+    if role is None:
+        default = get_role_manager().current().name
+        return f"по умолчанию ({default})" if default else "по умолчанию (без роли)"
+    return role or "без роли"
+
+
+def _apply_role(chat_id: int, role) -> None:
+    # Ответы, которые ещё готовятся от имени прежней роли, отменяются
+    if role != get_chat_role(chat_id):
+        get_cancellation().cancel_chat(chat_id, REASON_SETTINGS)
+    set_chat_role(chat_id, role)
+
+
+def _parse_choice(value: str):
+    """Значение из команды/кнопки -> ChatSettings.role; ValueError — такой роли нет."""
+    if value == _DEFAULT_KEY:
+        return None
+    if value.lower() in (_NONE_KEY, "null", "0"):
+        return ""
+    for name in get_role_manager().available_roles():
+        if name.lower() == value.lower():
+            return name
+    raise ValueError(value)
+
+
+@role_router.message(Command('role'))
+async def role_menu(message: Message, command: CommandObject = None):
+    """Меню выбора роли; /role <имя> — сразу переключает"""
+    chat_id = message.chat.id
+    if command is not None and command.args:
+        try:
+            role = _parse_choice(command.args.strip())
+        except ValueError:
+            await message.reply(f"❌ Роль «{command.args.strip()}» не найдена. Список ролей: /role")
+            return
+        _apply_role(chat_id, role)
+        await message.reply(f"🎭 Роль в этом чате: **{_role_title(chat_id)}**", parse_mode="Markdown")
+        return
+
+    roles = get_role_manager().available_roles()
+    role_text = f"""
+🎭 **Роль ассистента**
+
+📋 Текущая роль: **{_role_title(chat_id)}**
+
+Выберите роль для этого чата:
+"""
+    keyboard_buttons = [[InlineKeyboardButton(text=f"👤 {name}", callback_data=f"setrole_{name[:50]}")] for name in roles]
+    keyboard_buttons.append([InlineKeyboardButton(text="⚙️ По умолчанию (person.set)", callback_data=f"setrole_{_DEFAULT_KEY}")])
+    keyboard_buttons.append([InlineKeyboardButton(text="🚫 Без роли", callback_data=f"setrole_{_NONE_KEY}")])
+    keyboard_buttons.append([InlineKeyboardButton(text="❌ Закрыть", callback_data="close_role_menu")])
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    await message.reply(role_text, reply_markup=keyboard, parse_mode="Markdown")
+
+
+@role_router.callback_query(F.data.startswith("setrole_"))
+async def select_role(callback: CallbackQuery):
+    """Выбор роли из меню"""
+    chat_id = callback.message.chat.id
+    try:
+        role = _parse_choice(callback.data[len("setrole_"):])
+    except ValueError:
+        await callback.answer("❌ Роль не найдена")
+        return
+
+    _apply_role(chat_id, role)
+    title = _role_title(chat_id)
+    await callback.answer(f"✅ Роль: {title}")
+
+    close_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="❌ Закрыть", callback_data="close_role_menu")]
+    ])
+    await callback.message.edit_text(
+        f"✅ **Роль изменена!**\n\n🎭 Роль в этом чате: **{title}**",
+        reply_markup=close_keyboard, parse_mode="Markdown",
+    )
+
+
+@role_router.callback_query(F.data == "close_role_menu")
+async def close_role_menu(callback: CallbackQuery):
+    """Закрытие меню ролей"""
+    await callback.message.delete()
+    await callback.answer("Меню ролей закрыто")
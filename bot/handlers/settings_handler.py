@@ -62,9 +62,11 @@ async def toggle_voice_callback(callback: CallbackQuery):
 @settings_router.callback_query(F.data == "clear_context")
 async def clear_context_callback(callback: CallbackQuery):
     """Очистка контекста"""
-    from services.context_service import clear_context
+    from services.context_service import clear_chat_history
+    from services.cancellation import get_cancellation, REASON_CLEAR
     chat_id = callback.message.chat.id
-    clear_context(chat_id)
+    get_cancellation().cancel_chat(chat_id, REASON_CLEAR)
+    await clear_chat_history(chat_id)
     
     await callback.answer("🗑 Контекст очищен")
     await settings_menu(callback.message)
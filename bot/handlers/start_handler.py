@@ -30,8 +30,10 @@ async def help_command(message: Message):
 /help - Показать эту справку
 /vt - Переключить режим озвучивания ответов
 /model - Управление моделями ИИ
+/role - Роль ассистента в этом чате
 /settings - Настройки бота
 /clear - Очистить контекст диалога
+/perf - Задержки по этапам (для администраторов)
 
 📝 Поддерживаемые типы сообщений:
 • Текст - обычный диалог
@@ -44,7 +46,10 @@ async def help_command(message: Message):
 @start_router.message(Command("clear"))
 async def clear_context(message: Message):
     from services.context_service import clear_chat_history
+    from services.cancellation import get_cancellation, REASON_CLEAR
     chat_id = message.chat.id
-    clear_chat_history(chat_id)
+    # Незавершённые ответы, голосовые и озвучка прерываются и не допишут старые ходы в очищенный контекст
+    get_cancellation().cancel_chat(chat_id, REASON_CLEAR)
+    await clear_chat_history(chat_id)
     await message.reply("🗑 Контекст диалога очищен")
 
@@ -7,17 +7,16 @@ from aiogram.types import Message
 from services.model_service import generate_model_response
 from services.context_service import get_voice_mode
 from services.audio_service import send_audio_with_progress  # используем общий сервис TTS
+from services.telegram_outbound import get_outbound
+from services.message_debounce import get_message_debouncer
+from services.cancellation import get_cancellation, RequestCancelled
+from utils.helpers import send_response
+from config import PLACEHOLDER_MODE, TEXT_DEBOUNCE_ENABLED, CANCEL_ON_NEW_MESSAGE
 
 logger = logging.getLogger(__name__)
 
 text_router = Router()
 
-MAX_MSG_LEN = 4000
-
-def _split_text(text: str, chunk: int = MAX_MSG_LEN):
-    for i in range(0, len(text), chunk):
-        yield text[i:i + chunk]
-
 @text_router.message(F.text)
 async def handle_text_message(message: Message):
     # Игнорируем команды
@@ -25,47 +24,61 @@ async def handle_text_message(message: Message):
         return
 
     chat_id = message.chat.id
-    user_input = message.text
 
-    try:
-        # 1) Отдельное сообщение статуса
-        status_msg = await message.reply("_Формулирую ответ..._", parse_mode="Markdown")  # текст статуса [aiogram editMessageText]  # noqa: E501
-        # 2) Отдельный эмодзи (крупный/анимируется, пока один)
-        icon_msg = await message.bot.send_message(chat_id, "📝")  # отдельное сообщение-эмодзи  # noqa: E501
+    # Несколько сообщений подряд — один ход пользователя и одна генерация; отвечаем на последнее
+    messages = [message]
+    if TEXT_DEBOUNCE_ENABLED:
+        messages = await get_message_debouncer().collect(message)
+        if messages is None:
+            return
+        message = messages[-1]
+    user_input = "\n".join(m.text for m in messages)
+
+    outbound = get_outbound()
+    status_msg = None
+    # Токен отмены: новое сообщение (CANCEL_ON_NEW_MESSAGE), /clear или смена модели прерывают
+    # генерацию и озвучку; недописанный ответ не попадает в контекст
+    with get_cancellation().request(chat_id, "text", supersede=CANCEL_ON_NEW_MESSAGE, payload=user_input) as token:
+        try:
+            # Пользователь дополнил вопрос, пока готовился ответ: отменённые вопросы идут вместе с новым
+            if token.superseded:
+                user_input = "\n".join([*token.superseded, user_input])
+
+            # 1) Отдельное сообщение статуса (в режиме 'typing' вместо статуса и эмодзи — «печатает...»)
+            if PLACEHOLDER_MODE != "typing":
+                status_msg = await message.reply("_Формулирую ответ..._", parse_mode="Markdown")  # текст статуса [aiogram editMessageText]  # noqa: E501
 
-        # Генерация (sync -> to_thread), не блокируем event loop
-        response_text = await asyncio.to_thread(generate_model_response, chat_id, user_input, None)
+            # 2) Отдельный эмодзи (крупный/анимируется, пока один); удаляется вместе со статусом одним deleteMessages
+            async with outbound.placeholder(message.bot, chat_id, "📝"):
+                # Генерация (sync -> to_thread), не блокируем event loop
+                response_text = await asyncio.to_thread(generate_model_response, chat_id, user_input, None)
+                token.raise_if_cancelled()
 
-        # Отправка ответа
-        if not response_text:
-            await message.reply("❌ Не удалось сгенерировать ответ.")
-        else:
-            first = True
-            for chunk in _split_text(response_text):
-                if first:
-                    await message.reply(chunk, disable_web_page_preview=True)
-                    first = False
+                # Отправка ответа
+                if not response_text:
+                    await message.reply("❌ Не удалось сгенерировать ответ.")
                 else:
-                    await message.answer(chunk, disable_web_page_preview=True)
+                    # Markdown → HTML Telegram, части по границам абзацев; очень длинный ответ — файлом
+                    await send_response(message.bot, chat_id, response_text, message.message_id)
+                # Ответ доставлен — следующему сообщению этот вопрос уже не нужен
+                token.payload = None
 
-        # Удаляем плейсхолдеры текста
-        for mid in (getattr(status_msg, "message_id", None), getattr(icon_msg, "message_id", None)):
-            if mid:
-                try:
-                    await message.bot.delete_message(chat_id, mid)
-                except Exception:
-                    pass
+                # Удаляем плейсхолдеры текста
+                outbound.delete(message.bot, chat_id, getattr(status_msg, "message_id", None))
 
-        # Голосовой дубль: теперь ВСЮ логику плейсхолдеров (сначала текст, затем эмодзи)
-        # выполняет общий сервис send_audio_with_progress
-        if response_text and get_voice_mode(chat_id):
-            await send_audio_with_progress(
-                bot=message.bot,
-                chat_id=chat_id,
-                text=response_text,
-                reply_to_message_id=message.message_id
-            )
+            # Голосовой дубль: теперь ВСЮ логику плейсхолдеров (сначала текст, затем эмодзи)
+            # выполняет общий сервис send_audio_with_progress
+            if response_text and get_voice_mode(chat_id):
+                await send_audio_with_progress(
+                    bot=message.bot,
+                    chat_id=chat_id,
+                    text=response_text,
+                    reply_to_message_id=message.message_id
+                )
 
-    except Exception as e:
-        logger.error(f"Ошибка при обработке текста: {e}", exc_info=True)
-        await message.reply("❌ Произошла ошибка при обработке сообщения")
+        except RequestCancelled as e:
+            logger.info(f"Ответ в чате {chat_id} отменён: {e.reason}")
+            outbound.delete(message.bot, chat_id, getattr(status_msg, "message_id", None))
+        except Exception as e:
+            logger.error(f"Ошибка при обработке текста: {e}", exc_info=True)
+            await message.reply("❌ Произошла ошибка при обработке сообщения")
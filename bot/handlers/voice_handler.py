@@ -4,6 +4,8 @@ import logging
 from aiogram import Router, F
 from aiogram.types import Message
 from services.voice_queue import get_voice_queue
+from services.telegram_outbound import get_outbound
+from config import PLACEHOLDER_MODE
 
 logger = logging.getLogger(__name__)
 voice_router = Router()
@@ -16,22 +18,34 @@ async def handle_voice(message: Message):
         # 1) Текстовый статус (отдельное сообщение)
         status_msg = await message.reply("распознаю речь...")  # отдельный текстовый плейсхолдер [2][3]
 
-        # 2) Отдельный эмодзи (анимируется, пока один в сообщении)
-        icon_voice_msg = await message.bot.send_message(chat_id, "🎤")  # отдельный эмодзи-плейсхолдер [3]
+        # 2) Отдельный эмодзи (анимируется, пока один в сообщении); в режиме 'typing' не нужен —
+        #    очередь показывает «печатает...» на время распознавания
+        icon_voice_msg = None
+        if PLACEHOLDER_MODE != "typing":
+            icon_voice_msg = await message.bot.send_message(chat_id, "🎤")  # отдельный эмодзи-плейсхолдер [3]
+        icon_id = getattr(icon_voice_msg, "message_id", None)
+        outbound = get_outbound()
 
         queue = get_voice_queue()
         if not queue:
-            # Если очередь недоступна — очищаем плейсхолдеры и сообщаем об ошибке
-            try:
-                await message.bot.delete_message(chat_id, status_msg.message_id)  # удаление статуса [2]
-                await message.bot.delete_message(chat_id, icon_voice_msg.message_id)  # удаление эмодзи [2]
-            except Exception:
-                pass
+            # Если очередь недоступна — очищаем плейсхолдеры (одним deleteMessages) и сообщаем об ошибке
+            outbound.delete(message.bot, chat_id, status_msg.message_id, icon_id)
             await message.reply("❌ Сервис обработки голосовых временно недоступен")  # уведомление [3]
             return
 
         # Передаём исходное сообщение и оба плейсхолдера в очередь
-        queue.add_message(message, status_msg, icon_voice_msg)  # очередь сама управляет жизненным циклом [3]
+        position = queue.add_message(message, status_msg, icon_voice_msg)  # очередь сама управляет жизненным циклом [3]
+
+        if position is None:
+            # Очередь переполнена — сообщаем пользователю, плейсхолдер эмодзи убираем
+            outbound.delete(message.bot, chat_id, icon_id)
+            await outbound.edit_text(
+                message.bot, chat_id, status_msg.message_id,
+                "⏳ Сейчас слишком много голосовых в обработке. Пожалуйста, отправьте сообщение чуть позже."
+            )
+        elif position > 1:
+            # Перед нами есть задачи — показываем позицию в очереди
+            await outbound.edit_text(message.bot, chat_id, status_msg.message_id, f"распознаю речь... (в очереди: {position})")
 
     except Exception as e:
         logger.error(f"Ошибка при приёме голосового: {e}", exc_info=True)
@@ -0,0 +1,59 @@
+# bot/metrics_server.py
+"""Локальный HTTP-эндпоинт метрик в формате Prometheus (/metrics) — отдельно от webhook-сервера."""
+import logging
+from typing import Optional
+from aiohttp import web
+from config import METRICS_HOST, METRICS_PORT
+from services.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsServer:
+    """
+    aiohttp-сервер с одной страницей /metrics. По умолчанию слушает только 127.0.0.1:
+    метрики снимает локальный Prometheus/агент, наружу они не публикуются.
+    """
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _metrics(self, _: web.Request) -> web.Response:
+        return web.Response(body=get_metrics().render_prometheus().encode("utf-8"),
+                            headers={"Content-Type": _CONTENT_TYPE})
+
+    async def start(self):
+        if not self.port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except OSError as e:
+            # Порт занят (например, вторая копия бота) — бот работает без эндпоинта, /perf остаётся
+            logger.error(f"Метрики: не удалось открыть {self.host}:{self.port}: {e}")
+            await runner.cleanup()
+            return
+        self._runner = runner
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# Синглтон сервера метрик
+_server_instance: Optional[MetricsServer] = None
+
+def get_metrics_server() -> MetricsServer:
+    global _server_instance
+    if _server_instance is None:
+        _server_instance = MetricsServer()
+    return _server_instance
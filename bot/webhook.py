@@ -0,0 +1,153 @@
+# bot/webhook.py
+"""Режим webhook: aiohttp-сервер с проверкой секрета, ограничением параллельных обновлений, /healthz, /readyz и мягкой остановкой."""
+import asyncio
+import hashlib
+import logging
+import signal
+from typing import Any, Awaitable, Callable, Dict
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from config import (
+    WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_MAX_CONCURRENT_UPDATES, WEBHOOK_MAX_PENDING_UPDATES, WEBHOOK_DRAIN_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def default_secret(token: str) -> str:
+    """
+    Секрет по умолчанию — производный от токена бота: одинаков на всех репликах и не угадывается.
+    Telegram допускает в секрете только A-Z, a-z, 0-9, _ и -.
+    """
+    return hashlib.sha256(f"webhook:{token}".encode()).hexdigest()
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик webhook: Telegram получает ответ сразу, обновление обрабатывается в фоне.
+
+    - одновременно обрабатывается не больше WEBHOOK_MAX_CONCURRENT_UPDATES обновлений, остальные ждут;
+    - при WEBHOOK_MAX_PENDING_UPDATES принятых, но не обработанных обновлений отвечаем 503 —
+      Telegram доставит их повторно, память не растёт;
+    - во время остановки новые обновления не принимаются (503), начатые дорабатываются (drain);
+    - запрос без верного X-Telegram-Bot-Api-Secret-Token отклоняется (401) до всех этих проверок.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, **kwargs):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **kwargs)
+        self._slots = asyncio.Semaphore(WEBHOOK_MAX_CONCURRENT_UPDATES)
+        self._in_flight: set[asyncio.Task] = set()
+        self.accepting = True
+        self.stats = {"received": 0, "rejected": 0, "failed": 0, "unauthorized": 0}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        # Сначала секрет: запросы не от Telegram не занимают очередь и не видят её состояние
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            self.stats["unauthorized"] += 1
+            return web.Response(status=401, text="Unauthorized")
+        if not self.accepting or len(self._in_flight) >= WEBHOOK_MAX_PENDING_UPDATES:
+            self.stats["rejected"] += 1
+            return web.Response(status=503, text="busy")
+        self.stats["received"] += 1
+        return await super().handle(request)
+
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        task = asyncio.current_task()
+        self._in_flight.add(task)
+        try:
+            async with self._slots:
+                await super()._background_feed_update(bot, update)
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.error(f"Ошибка обработки обновления из webhook: {e}", exc_info=True)
+        finally:
+            self._in_flight.discard(task)
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Перестаёт принимать обновления и ждёт завершения начатых (не дольше timeout)."""
+        self.accepting = False
+        pending = set(self._in_flight)
+        if not pending:
+            return
+        logger.info(f"Webhook: дожидаюсь {len(pending)} обновлений (до {timeout:.0f}s)")
+        done, not_done = await asyncio.wait(pending, timeout=timeout)
+        for task in not_done:
+            task.cancel()
+        if not_done:
+            logger.warning(f"Webhook: прервано {len(not_done)} незавершённых обновлений")
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "in_flight": len(self._in_flight), "accepting": self.accepting}
+
+
+async def run_webhook(
+    bot: Bot,
+    dp: Dispatcher,
+    webhook_url: str,
+    secret: str,
+    on_startup: Callable[[], Awaitable[None]],
+    on_shutdown: Callable[[], Awaitable[None]],
+    is_ready: Callable[[], bool],
+):
+    """
+    Поднимает aiohttp-сервер, регистрирует webhook в Telegram и работает до SIGINT/SIGTERM.
+
+    is_ready — проверка готовности для /readyz (например, что конвейер голосовых запущен).
+    Webhook при остановке не удаляется: другие реплики за балансировщиком продолжают работать.
+    """
+    handler = BoundedRequestHandler(dispatcher=dp, bot=bot, secret_token=secret)
+    app = web.Application()
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    started = False
+
+    async def healthz(_: web.Request) -> web.Response:
+        # Процесс жив и отвечает
+        return web.json_response({"status": "ok"})
+
+    async def readyz(_: web.Request) -> web.Response:
+        # Готов принимать трафик: запущен, не останавливается, зависимости поднялись
+        ready = started and handler.accepting and is_ready()
+        return web.json_response(
+            {"status": "ready" if ready else "not ready", **handler.get_stats()},
+            status=200 if ready else 503,
+        )
+
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+
+    await on_startup()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    await bot.set_webhook(
+        url=webhook_url,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    started = True
+    logger.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, адрес {webhook_url}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остаётся KeyboardInterrupt
+            pass
+
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Webhook: остановка, новые обновления не принимаются")
+        await handler.drain()
+        await runner.cleanup()
+        await on_shutdown()
@@ -6,12 +6,50 @@ import logging # Импортируем logging для сообщений
 # Настройки очереди обработки голоса
 # Количество воркеров для параллельной обработки голосовых сообщений
 # Рекомендуется устанавливать значение от 1 до количества ядер CPU
-VOICE_WORKERS_COUNT = 2 # По умолчанию 2 воркера
+VOICE_WORKERS_COUNT = 2 # По умолчанию 2 воркера (стартовое значение для автомасштабирования)
+VOICE_WORKERS_MIN = 1   # Нижняя граница автомасштабирования
+VOICE_WORKERS_MAX = 6   # Верхняя граница автомасштабирования
+
+# Ограничение очереди: при переполнении пользователь получает отказ с просьбой повторить позже
+VOICE_QUEUE_MAXSIZE = 50
+
+# Приоритет: короткие голосовые обрабатываются раньше длинных.
+# Длинным добавляется "штраф" к сроку в секундах, чтобы они не голодали бесконечно.
+VOICE_SHORT_CLIP_SECONDS = 20       # до этой длительности клип считается коротким
+VOICE_LONG_CLIP_PENALTY = 30.0      # сек виртуальной задержки для длинных клипов
+
+# Автомасштабирование воркеров
+VOICE_SCALE_INTERVAL = 2.0          # период проверки нагрузки (сек)
+VOICE_SCALE_UP_DEPTH = 3            # задач в ожидании на один воркер для добавления воркера
+VOICE_SCALE_UP_WAIT = 10.0          # среднее ожидание в очереди (сек) для добавления воркера
+VOICE_SCALE_DOWN_IDLE = 60.0        # сколько секунд очередь должна быть пустой для снятия воркера
+
+# Конвейер голосовых: у каждого этапа свой пул воркеров (мин., макс.).
+# Этап транскрибации стартует с VOICE_WORKERS_COUNT и масштабируется в [VOICE_WORKERS_MIN, VOICE_WORKERS_MAX].
+VOICE_STAGE_WORKERS = {
+    "download": (1, 4),
+    "transcribe": (VOICE_WORKERS_MIN, VOICE_WORKERS_MAX),
+    "generate": (1, 4),
+    "tts": (1, 2),
+}
+VOICE_STAGE_QUEUE_SIZE = 5          # ёмкость очереди одного воркера между этапами (обратное давление)
+
+# Журнал задач голосовой очереди (переживает перезапуск/падение бота)
+VOICE_JOURNAL_PATH = 'voice_journal.sqlite3'
+VOICE_JOURNAL_MAX_AGE = 6 * 3600    # незавершённые задачи старше этого (сек) не восстанавливаем
+VOICE_JOURNAL_KEEP_DONE = 24 * 3600 # сколько хранить записи завершённых задач (сек)
 
 # Настройки контекста
 MAX_HISTORY = 100                   # Максимальная глубина контекста
 CONTEXT_TIMEOUT = 12000              # Время хранения контекста (сек)
 
+# Каталог моделей: id, семейство, лимиты контекста/вывода, возможности (см. mod_llm.py)
+MODEL_CATALOG_PATH = 'models_catalog.json'
+# Снимок метаданных провайдеров (лимиты, модальности, thinking, rate limits) — пишет get_model_limits.py
+MODEL_SNAPSHOT_PATH = os.path.join('cache', 'model_snapshot.json')
+MODEL_REFRESH_INTERVAL = 0               # сек между обновлениями снимка внутри бота (0 — только вручную)
+MODEL_REFRESH_TIMEOUT = 30.0             # сек на запрос к одному провайдеру
+
 # Начальные размеры контекста
 DEFAULT_MAX_HISTORY   = 100          # сообщений
 DEFAULT_CONTEXT_TTL   = 12000        # секунд
@@ -25,9 +63,136 @@ LOG_TO_CONSOLE = False  # Включи True, если хочешь лог в к
 TRANSCRIPTION_MODEL = 'gemini-2.5-flash-lite' # Или любая другая подходящая модель
 TRANSCRIPTION_PROMPT = 'Транскрибируй речь, выдай текст без дополнительных слов'
 
+# Длинные голосовые режутся по паузам на перекрывающиеся сегменты и распознаются параллельно
+TRANSCRIPTION_SEGMENT_THRESHOLD = 90     # сек; длиннее — сегментируем (0 — отключить)
+TRANSCRIPTION_SEGMENT_SECONDS = 45       # целевая длина сегмента (сек)
+TRANSCRIPTION_SEGMENT_SEARCH = 5         # окно поиска паузы вокруг точки разреза (± сек)
+TRANSCRIPTION_SEGMENT_OVERLAP = 1.0      # перекрытие соседних сегментов (сек)
+TRANSCRIPTION_SEGMENT_CONCURRENCY = 4    # одновременных запросов на одно голосовое
+TRANSCRIPTION_PROGRESS_EDITS = True      # показывать частичный текст в статусе по мере готовности
+TRANSCRIPTION_PROGRESS_INTERVAL = 3.0    # не чаще раза в N сек (лимиты Telegram на edit)
+
+# Пакетная транскрибация: короткие голосовые, которые уже ждут в очереди, распознаются одним
+# запросом со структурированным ответом. Пакет собирается только из готовых задач — без ожидания
+TRANSCRIPTION_BATCH_ENABLED = True
+TRANSCRIPTION_BATCH_MAX_ITEMS = 6        # голосовых в одном запросе
+TRANSCRIPTION_BATCH_MAX_CLIP = 20        # сек; более длинные всегда распознаются отдельно
+TRANSCRIPTION_BATCH_MAX_SECONDS = 90     # суммарная длительность пакета (сек)
+TRANSCRIPTION_BATCH_MAX_BYTES = 4 * 1024 * 1024  # аудио пакета передаётся inline в запросе
+TRANSCRIPTION_BATCH_TIMEOUT = 30.0       # сек; не уложились — распознаём клипы по отдельности
+
+# Предобработка перед отправкой на транскрибацию: моно, понижение частоты,
+# вырезание длинных пауз (VAD по энергии) и компактное перекодирование в Opus
+TRANSCRIPTION_PREPROCESS = True
+TRANSCRIPTION_SAMPLE_RATE = 16000        # Gemini всё равно понижает аудио до 16 кГц
+TRANSCRIPTION_BITRATE = '24k'            # битрейт Opus для речи
+VAD_FRAME_MS = 30                        # длина кадра анализа (мс)
+VAD_THRESHOLD_DB = 12.0                  # речь — на столько дБ выше уровня шума
+VAD_MIN_SPEECH_DB = -50.0                # и не тише этого абсолютного уровня
+VAD_MAX_SILENCE = 0.6                    # паузы длиннее (сек) сжимаются до этой длины
+VAD_PADDING = 0.2                        # запас вокруг речи (сек), чтобы не обрезать края слов
+
+# Пул процессов для декодирования/кодирования/ресемплинга/VAD (pydub, ffmpeg, numpy)
+AUDIO_POOL_WORKERS = min(4, os.cpu_count() or 2)   # постоянных процессов = макс. одновременных ffmpeg
+AUDIO_POOL_MAX_PENDING = 32                         # задач в пуле; остальные ждут (обратное давление)
+
+# Настройки озвучки ответов (TTS)
+TTS_MODEL = 'gemini-2.5-flash-preview-tts'
+TTS_VOICE_NAME = 'Sulafat'
+# Битрейт Opus по длительности речи: (до N секунд, битрейт); None — для всего остального
+TTS_BITRATE_STEPS = [(30, '48k'), (120, '32k'), (None, '24k')]
+# Длинный ответ озвучивается частями по границам абзацев/предложений параллельно;
+# первая часть короче, чтобы пользователь услышал начало как можно раньше
+TTS_CHUNK_CHARS = 1200
+TTS_FIRST_CHUNK_CHARS = 400
+TTS_CONCURRENCY = 3
+# Кэш озвучки: ключ — hash(нормализованный текст, голос, модель); аудио хранится на диске (LRU),
+# вместе с file_id Telegram, чтобы повторно отправлять без синтеза и без загрузки
+TTS_CACHE_ENABLED = True
+TTS_CACHE_DIR = os.path.join('cache', 'tts')
+TTS_CACHE_MAX_BYTES = 200 * 1024 * 1024
+TTS_CACHE_MAX_ENTRIES = 20000            # записей в индексе (в том числе только с file_id, без аудио)
+
+# Исходящие запросы к Telegram: лимиты скорости и индикаторы ожидания
+TELEGRAM_GLOBAL_RATE = 25                # запросов в секунду на бота (лимит Telegram ~30)
+TELEGRAM_CHAT_RATE = 1.0                 # сообщений/правок в секунду в личный чат
+TELEGRAM_CHAT_BURST = 3                  # допустимый всплеск в чат
+TELEGRAM_GROUP_RATE = 20 / 60            # в группы — не больше 20 сообщений в минуту
+TELEGRAM_RETRY_ATTEMPTS = 3              # повторов после 429 (retry_after)
+TELEGRAM_DELETE_DELAY = 0.5              # удаления копятся и уходят одним deleteMessages
+MESSAGE_CHUNK_CHARS = 4000               # длина части ответа (лимит Telegram — 4096)
+RESPONSE_DOCUMENT_CHARS = 12000          # ответ длиннее — отправляется файлом .md с превью в подписи
+# Альбомы: части с одним media_group_id собираются и уходят модели одним запросом
+MEDIA_GROUP_WINDOW = 0.8                 # сек тишины после последней части альбома
+MEDIA_GROUP_MAX_WAIT = 3.0               # но не дольше этого с первой части
+MEDIA_GROUP_MAX_IMAGES = 10              # изображений в одном запросе
+# Склейка сообщений: несколько текстов подряд (разрезанная клиентом вставка, строки «очередью»)
+# уходят модели одним запросом. Окно ожидания подстраивается под темп набора в чате
+TEXT_DEBOUNCE_ENABLED = True
+TEXT_DEBOUNCE_MIN = 0.6                  # сек ожидания следующего сообщения (минимум)
+TEXT_DEBOUNCE_MAX = 2.5                  # ... и максимум для медленного набора
+TEXT_DEBOUNCE_MAX_WAIT = 6.0             # не дольше этого с первого сообщения
+TEXT_DEBOUNCE_SPLIT_CHARS = 3500         # сообщение такой длины — вероятно, часть разрезанной вставки: ждём максимум
+TEXT_DEBOUNCE_TRACKED_CHATS = 1000       # чатов, для которых помним темп набора (LRU)
+# Новое текстовое сообщение отменяет ещё не готовый ответ на предыдущее (вопросы склеиваются в один);
+# /clear и смена модели отменяют все незавершённые запросы чата
+CANCEL_ON_NEW_MESSAGE = True
+# Документы (txt, md, pdf, docx): скачиваются потоком, текст извлекается частями в пределах бюджета токенов
+DOCUMENT_MAX_BYTES = 20 * 1024 * 1024    # лимит скачивания файлов через Bot API
+DOCUMENT_SPOOL_MEMORY = 1024 * 1024      # до этого размера файл держится в памяти, дальше — во временном файле
+DOCUMENT_CONTEXT_SHARE = 0.5             # доля контекста модели чата под текст документа
+DOCUMENT_FILES_API_BYTES = 2 * 1024 * 1024  # для Gemini pdf/txt/md больше этого загружаются через Files API
+DOCUMENT_CACHE_ITEMS = 32                # извлечённых текстов в кэше (ключ — file_unique_id)
+# 'emoji' — отдельные сообщения-эмодзи (📝, 🔎, 🎤, 🎙) с удалением после ответа;
+# 'typing' — sendChatAction вместо них и без текстовых статусов: меньше вызовов API на ответ
+PLACEHOLDER_MODE = 'emoji'
+
+# Режим получения обновлений: 'polling' (по умолчанию) или 'webhook' (aiohttp-сервер).
+# Для webhook в .env задаются WEBHOOK_URL (публичный https-адрес) и, для нескольких реплик, WEBHOOK_SECRET
+BOT_MODE = 'polling'
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8080
+WEBHOOK_MAX_CONNECTIONS = 40             # одновременных соединений от Telegram (параметр setWebhook)
+WEBHOOK_MAX_CONCURRENT_UPDATES = 32      # обновлений, обрабатываемых одновременно
+WEBHOOK_MAX_PENDING_UPDATES = 256        # сверх этого отвечаем 503, Telegram доставит повторно
+WEBHOOK_DRAIN_TIMEOUT = 30.0             # сек на завершение начатых обновлений при остановке
+
+# Метрики задержек по этапам: Prometheus-эндпоинт http://METRICS_HOST:METRICS_PORT/metrics и команда /perf.
+# /perf доступна пользователям из ADMIN_IDS в .env (id через запятую)
+METRICS_HOST = '127.0.0.1'               # только локально; наружу метрики не публикуются
+METRICS_PORT = 9108                      # 0 — без HTTP-эндпоинта (/perf работает)
+
+# Трассировка запросов: у каждого обновления свой trace_id (виден в bot_debug.log), этапы записываются
+# спанами; медленные запросы сохраняются в TRACE_DIR в формате Chrome Trace Event (chrome://tracing, Perfetto)
+TRACE_ENABLED = True
+TRACE_DIR = os.path.join('cache', 'traces')
+TRACE_SLOW_THRESHOLD = 15.0              # сек от получения обновления до последнего этапа; медленнее — в файл
+TRACE_MAX_SPANS = 500                    # спанов в одной трассе (остальные отбрасываются)
+TRACE_MAX_FILES = 200                    # файлов трасс на диске; старые удаляются
+
 # Настройки ролей
 ROLE_CONFIG_FILE = 'person.set'
 ROLES_BASE_DIR = 'person' # Изменено с 'roles' на 'person'
+ROLE_RELOAD_INTERVAL = 5.0               # сек между проверками person.set и файлов роли (0 — без горячей перезагрузки)
+ROLE_CACHE_SIZE = 8                      # ролей чатов в памяти одновременно (LRU; роль по умолчанию не считается)
+
+# База знаний роли: вместо всего файла в запрос попадают только фрагменты, относящиеся к вопросу
+# (индекс BM25 на numpy, хранится на диске и перестраивается при изменении файла)
+KB_INDEX_DIR = os.path.join('cache', 'kb')
+KB_CHUNK_CHARS = 800                     # размер фрагмента базы знаний
+KB_TOP_K = 6                             # фрагментов в запросе (не больше)
+KB_TOKEN_BUDGET = 1500                   # токенов базы знаний в запросе; база меньше бюджета уходит целиком
+
+# Долговременная память чата: ходы, вытесненные из контекста (context_ttl/max_history), индексируются
+# локально (хешированные n-граммы, numpy, файлы на диске) и подмешиваются к запросу по смыслу
+MEMORY_ENABLED = True
+MEMORY_DIR = os.path.join('cache', 'memory')
+MEMORY_DIM = 512                         # размерность хешированных векторов
+MEMORY_TOP_K = 3                         # фрагментов прошлых разговоров в запросе (не больше)
+MEMORY_TOKEN_BUDGET = 400                # токенов памяти в запросе
+MEMORY_MIN_SCORE = 0.2                   # минимальное косинусное сходство с вопросом
+MEMORY_SNIPPET_CHARS = 600               # длина сохраняемого фрагмента (вопрос + ответ)
 
 # Создаем отдельный логгер для config, чтобы видеть его сообщения
 logger_config = logging.getLogger('config') 
@@ -65,21 +230,23 @@ def find_file_case_insensitive(directory, filename):
     
     return None
 
-def load_role_settings():
-    """
-    Загружает настройки роли из файла person.set.
-    """
-    logger_config.debug("Начало загрузки настроек роли...")
-    role_settings = {
+def _empty_role_settings() -> dict:
+    return {
         'name': None,
         'instructions': None,
-        'knowledge_base': None
+        'knowledge_base': None,
+        'knowledge_base_path': None,
     }
-    
+
+def read_role_name():
+    """
+    Читает имя роли из файла person.set (строка вида ROLE = ...).
+    Возвращает None, если файла нет или роль не задана (пусто/null/none/0).
+    """
     logger_config.debug(f"Проверяем наличие файла настроек: {os.path.abspath(ROLE_CONFIG_FILE)}")
     if not os.path.exists(ROLE_CONFIG_FILE):
         logger_config.info(f"Файл настроек роли {ROLE_CONFIG_FILE} не найден. Используется стандартный режим.")
-        return role_settings
+        return None
 
     try:
         with open(ROLE_CONFIG_FILE, 'r', encoding='utf-8') as f:
@@ -90,82 +257,94 @@ def load_role_settings():
                 # Пропускаем пустые строки и комментарии
                 if not line or line.startswith('#'):
                     continue
-                
+
                 # Ищем строку вида ROLE = ...
                 if line.startswith('ROLE'):
                     try:
                         # Разделяем по '=' и берем правую часть
                         _, raw_role_value = line.split('=', 1)
-                        raw_role = raw_role_value.strip()
-                        logger_config.info(f"Найдена роль в конфиге: '{raw_role}'")
-                        
-                        # Проверяем, задана ли роль и не является ли она "нулевой"
-                        if raw_role and raw_role.lower() not in ('null', 'none', '0', ''):
-                            
-                            # Формируем путь к папке роли
-                            role_dir = os.path.join(ROLES_BASE_DIR, raw_role)
-                            logger_config.debug(f"Путь к папке роли: {os.path.abspath(role_dir)}")
-                            logger_config.debug(f"Папка роли существует: {os.path.exists(role_dir)}")
-                            
-                            # --- ОСНОВНОЕ ПРАВИЛО ---
-                            # Роль запускается ТОЛЬКО если существует Instructions.txt (в любом регистре)
-                            instructions_path = find_file_case_insensitive(role_dir, 'Instructions.txt')
-                            logger_config.debug(f"Путь к Instructions.txt (поиск без учета регистра): {instructions_path}")
-                            if instructions_path:
-                                role_settings['name'] = raw_role
-                                logger_config.info(f"Найден файл инструкций '{os.path.basename(instructions_path)}' для роли '{raw_role}'. Активируем роль.")
-                                
-                                # Загружаем Instructions.txt
-                                try:
-                                    with open(instructions_path, 'r', encoding='utf-8') as inst_f:
-                                        instructions_content = inst_f.read().strip()
-                                        if instructions_content:
-                                            role_settings['instructions'] = instructions_content
-                                            logger_config.info(f"Инструкции для роли '{raw_role}' загружены. Длина: {len(instructions_content)} символов.")
-                                        else:
-                                            logger_config.warning(f"Файл инструкций {instructions_path} пуст.")
-                                except Exception as e:
-                                    logger_config.error(f"Ошибка чтения файла инструкций {instructions_path}: {e}")
-                                
-                                # Загружаем knowledge_base.txt (опционально, с поиском без учета регистра)
-                                kb_path = find_file_case_insensitive(role_dir, 'knowledge_base.txt')
-                                logger_config.debug(f"Путь к knowledge_base.txt (поиск без учета регистра): {kb_path}")
-                                if kb_path:
-                                    try:
-                                        with open(kb_path, 'r', encoding='utf-8') as kb_f:
-                                            kb_content = kb_f.read().strip()
-                                            if kb_content:
-                                                role_settings['knowledge_base'] = kb_content
-                                                logger_config.info(f"База знаний '{os.path.basename(kb_path)}' для роли '{raw_role}' загружена. Длина: {len(kb_content)} символов.")
-                                            else:
-                                                 logger_config.info(f"Файл базы знаний {kb_path} пуст.")
-                                    except Exception as e:
-                                        logger_config.warning(f"Ошибка чтения файла базы знаний {kb_path}: {e}. Продолжаем без базы знаний.")
-                                else:
-                                     logger_config.info(f"Файл базы знаний 'knowledge_base.txt' не найден в {role_dir}. Продолжаем без базы знаний.")
-                                    
-                            else:
-                                # Instructions.txt НЕ найден (ни в каком регистре)
-                                logger_config.warning(
-                                    f"Для роли '{raw_role}' не найден файл инструкций 'Instructions.txt' (в любом регистре) в папке {os.path.abspath(role_dir)}. "
-                                    f"Роль НЕ будет активирована. Используется стандартный режим."
-                                )
-                        else:
-                            logger_config.info("Роль не задана или установлена в 'null'. Используется стандартный режим.")
-                        # После обработки ROLE=... выходим из цикла
-                        break 
                     except ValueError as ve:
                         # Если split не смог разделить строку на 2 части
                         logger_config.warning(f"Некорректный формат строки {line_num} в файле {ROLE_CONFIG_FILE}: {line}. Ошибка: {ve}")
                         continue # Пропускаем эту строку и идем дальше
-            
+                    raw_role = raw_role_value.strip()
+                    logger_config.info(f"Найдена роль в конфиге: '{raw_role}'")
+                    # Проверяем, задана ли роль и не является ли она "нулевой"
+                    if raw_role and raw_role.lower() not in ('null', 'none', '0', ''):
+                        return raw_role
+                    logger_config.info("Роль не задана или установлена в 'null'. Используется стандартный режим.")
+                    return None
+
             logger_config.info("Файл person.set успешно прочитан (или обработан с предупреждениями).")
-            
+
     except Exception as e:
         logger_config.error(f"Ошибка при чтении файла {ROLE_CONFIG_FILE}: {e}. Используется стандартный режим.", exc_info=True)
-        
-    logger_config.debug(f"Итоговые настройки роли: name={role_settings['name']}, instructions={'YES' if role_settings['instructions'] else 'NO'}, knowledge_base={'YES' if role_settings['knowledge_base'] else 'NO'}")
+    return None
+
+def load_role(raw_role):
+    """
+    Загружает роль из папки person/<raw_role>: Instructions.txt (обязателен) и knowledge_base.txt (опционально).
+    """
+    role_settings = _empty_role_settings()
+
+    # Формируем путь к папке роли
+    role_dir = os.path.join(ROLES_BASE_DIR, raw_role)
+    logger_config.debug(f"Путь к папке роли: {os.path.abspath(role_dir)}")
+    logger_config.debug(f"Папка роли существует: {os.path.exists(role_dir)}")
+
+    # --- ОСНОВНОЕ ПРАВИЛО ---
+    # Роль запускается ТОЛЬКО если существует Instructions.txt (в любом регистре)
+    instructions_path = find_file_case_insensitive(role_dir, 'Instructions.txt')
+    logger_config.debug(f"Путь к Instructions.txt (поиск без учета регистра): {instructions_path}")
+    if not instructions_path:
+        # Instructions.txt НЕ найден (ни в каком регистре)
+        logger_config.warning(
+            f"Для роли '{raw_role}' не найден файл инструкций 'Instructions.txt' (в любом регистре) в папке {os.path.abspath(role_dir)}. "
+            f"Роль НЕ будет активирована. Используется стандартный режим."
+        )
+        return role_settings
+
+    role_settings['name'] = raw_role
+    logger_config.info(f"Найден файл инструкций '{os.path.basename(instructions_path)}' для роли '{raw_role}'. Активируем роль.")
+
+    # Загружаем Instructions.txt
+    try:
+        with open(instructions_path, 'r', encoding='utf-8') as inst_f:
+            instructions_content = inst_f.read().strip()
+            if instructions_content:
+                role_settings['instructions'] = instructions_content
+                logger_config.info(f"Инструкции для роли '{raw_role}' загружены. Длина: {len(instructions_content)} символов.")
+            else:
+                logger_config.warning(f"Файл инструкций {instructions_path} пуст.")
+    except Exception as e:
+        logger_config.error(f"Ошибка чтения файла инструкций {instructions_path}: {e}")
+
+    # Загружаем knowledge_base.txt (опционально, с поиском без учета регистра)
+    kb_path = find_file_case_insensitive(role_dir, 'knowledge_base.txt')
+    logger_config.debug(f"Путь к knowledge_base.txt (поиск без учета регистра): {kb_path}")
+    if kb_path:
+        try:
+            with open(kb_path, 'r', encoding='utf-8') as kb_f:
+                kb_content = kb_f.read().strip()
+                if kb_content:
+                    role_settings['knowledge_base'] = kb_content
+                    # По пути строится поисковый индекс (services/knowledge_index.py)
+                    role_settings['knowledge_base_path'] = kb_path
+                    logger_config.info(f"База знаний '{os.path.basename(kb_path)}' для роли '{raw_role}' загружена. Длина: {len(kb_content)} символов.")
+                else:
+                     logger_config.info(f"Файл базы знаний {kb_path} пуст.")
+        except Exception as e:
+            logger_config.warning(f"Ошибка чтения файла базы знаний {kb_path}: {e}. Продолжаем без базы знаний.")
+    else:
+         logger_config.info(f"Файл базы знаний 'knowledge_base.txt' не найден в {role_dir}. Продолжаем без базы знаний.")
     return role_settings
 
-# Загружаем настройки роли при импорте config.py
-CURRENT_ROLE_SETTINGS = load_role_settings()
+def load_role_settings():
+    """
+    Загружает настройки роли из файла person.set.
+    """
+    logger_config.debug("Начало загрузки настроек роли...")
+    raw_role = read_role_name()
+    role_settings = load_role(raw_role) if raw_role else _empty_role_settings()
+    logger_config.debug(f"Итоговые настройки роли: name={role_settings['name']}, instructions={'YES' if role_settings['instructions'] else 'NO'}, knowledge_base={'YES' if role_settings['knowledge_base'] else 'NO'}")
+    return role_settings
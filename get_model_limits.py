@@ -1,66 +1,65 @@
 # get_model_limits.py
+"""
+Обновляет снимок метаданных моделей (cache/model_snapshot.json): Gemini, Groq и OpenRouter
+опрашиваются параллельно. Бот читает снимок при старте без обращения к сети.
+
+    python get_model_limits.py            # один раз
+    python get_model_limits.py --check    # показать, чего из каталога нет у провайдеров
+"""
+import argparse
+import asyncio
 import logging
-import os
-from google import genai
-from google.genai import types
 
 from dotenv import load_dotenv
 
-
-# Загружаем ключ из .env
+# Загружаем ключи из .env до импорта сервисов
 load_dotenv(override=True)
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-if not GOOGLE_API_KEY:
-    raise ValueError("Не найден GOOGLE_API_KEY в .env")
+from config import MODEL_SNAPSHOT_PATH
+from mod_llm import get_registry, apply_snapshot, FAMILY_PROVIDER
+from services.catalog_refresh import CatalogRefresher
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def main():
-    """Основная функция для получения и записи лимитов моделей."""
-    output_file = "model_limits.txt"
-    
-    try:
-        logger.info("Создание клиента genai...")
-        client = genai.Client()
-        
-        logger.info("Получение списка моделей...")
-        models_list = client.models.list()
-        
-        logger.info(f"Открытие файла '{output_file}' для записи...")
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write("# Список моделей и их максимальная длина входного контекста\n")
-            f.write("# Формат: model_id - input_token_limit\n")
-            f.write("----------------------------------------\n")
-            
-            model_count = 0
-            for model in models_list:
-                model_count += 1
-                try:
-                    model_name = getattr(model, 'name', 'N/A')
-                    # Извлекаем короткое имя (после последнего '/')
-                    model_id = model_name.split('/')[-1] if '/' in model_name else model_name
-                    input_limit = getattr(model, 'input_token_limit', 'N/A')
-                    
-                    line = f"{model_id} - {input_limit}\n"
-                    f.write(line)
-                    logger.info(f"Записано: {model_id} - {input_limit}")
-                    
-                except Exception as e:
-                    error_line = f"Ошибка обработки модели #{model_count}: {e}\n"
-                    f.write(error_line)
-                    logger.error(error_line.strip())
-            
-            f.write("----------------------------------------\n")
-            f.write(f"Всего обработано моделей: {model_count}\n")
-        
-        logger.info(f"Информация о лимитах успешно записана в '{output_file}'")
-        
-    except Exception as e:
-        logger.error(f"Критическая ошибка при выполнении скрипта: {e}", exc_info=True)
-        print(f"Ошибка: {e}")
+
+def report(snapshot: dict, check: bool):
+    """Итог по провайдерам и лимиты моделей из каталога после наложения снимка."""
+    for name, provider in snapshot["providers"].items():
+        status = f"ошибка: {provider['error']}" if provider.get("error") else "ok"
+        print(f"{name}: {len(provider.get('models', {}))} моделей ({status})")
+
+    registry = apply_snapshot(snapshot)
+    print(f"\nМодели бота (снимок v{registry.snapshot_version}):")
+    for model in registry:
+        output_limit = model.get("output_token_limit") or "—"
+        print(f"  {model['id']} - {model['input_token_limit']} / {output_limit}")
+
+    if check:
+        missing = [
+            model["id"] for model in registry
+            if model["id"] not in snapshot["providers"].get(FAMILY_PROVIDER[model["family"]], {}).get("models", {})
+        ]
+        if missing:
+            print("\nНет у провайдеров (проверьте id в models_catalog.json):")
+            for model_id in missing:
+                print(f"  {model_id}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Обновление снимка метаданных моделей")
+    parser.add_argument("--output", default=MODEL_SNAPSHOT_PATH, help="путь к снимку")
+    parser.add_argument("--check", action="store_true", help="показать модели каталога, которых нет у провайдеров")
+    args = parser.parse_args()
+
+    snapshot = await CatalogRefresher(path=args.output).refresh()
+    if snapshot is None:
+        print("Ошибка: ни один провайдер не ответил, снимок не обновлён")
+        return 1
+    logger.info(f"Снимок v{snapshot['version']} записан в '{args.output}' (моделей в реестре: {len(get_registry())})")
+    report(snapshot, args.check)
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    raise SystemExit(asyncio.run(main()))
@@ -7,19 +7,31 @@ from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 
-from config import LOG_TO_CONSOLE, VOICE_WORKERS_COUNT
+from config import LOG_TO_CONSOLE, VOICE_WORKERS_COUNT, VOICE_WORKERS_MAX, BOT_MODE, WEBHOOK_PATH
 from bot.handlers import register_handlers  # <-- корректный импорт
 from services.voice_queue import get_voice_queue
+from services.audio_pool import get_audio_pool
+from services.role_manager import get_role_manager
+from services.catalog_refresh import get_catalog_refresher
+from services.telegram_outbound import get_outbound, OutboundMiddleware
+from services.long_term_memory import get_long_term_memory
+from services.metrics import get_metrics
+from services.tracing import get_tracer, TraceLogFilter
+from bot.webhook import run_webhook, default_secret
+from bot.metrics_server import get_metrics_server
 
 load_dotenv(override=True)
 
 handlers = [logging.FileHandler("bot_debug.log", encoding="utf-8")]
 if LOG_TO_CONSOLE:
     handlers.append(logging.StreamHandler())
+# trace_id запроса в каждой строке: строки разных чатов можно разделить поиском по нему
+for handler in handlers:
+    handler.addFilter(TraceLogFilter())
 
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    format="%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s",
     handlers=handlers,
 )
 logger = logging.getLogger(__name__)
@@ -29,12 +41,18 @@ if not TELEGRAM_TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN не задан в .env")
 
 bot = Bot(token=TELEGRAM_TOKEN)
+# Все исходящие запросы — через лимиты Telegram и повтор после 429
+bot.session.middleware(OutboundMiddleware(get_outbound()))
 dp = Dispatcher(storage=MemoryStorage())
 
 voice_queue = None
 
 async def on_startup():
     global voice_queue
+    # Процессы пула аудио поднимаем первыми: до роли, обновления каталога и прочего, что создаёт
+    # потоки (asyncio.to_thread), — тогда воркеры можно безопасно создать через fork
+    await get_audio_pool().start()
+
     loop = asyncio.get_running_loop()
     voice_queue = get_voice_queue(bot, loop)
 
@@ -45,18 +63,52 @@ async def on_startup():
         logger.info("GOOGLE_API_KEY загружен.")
 
     register_handlers(dp)
-    logger.info(f"Очередь обработки голоса запускается с {VOICE_WORKERS_COUNT} воркерами.")
+    # Роль (и индекс её базы знаний) загружается до первого запроса; дальше — горячая перезагрузка
+    await get_role_manager().start()
+    # Снимок моделей уже прочитан с диска при импорте mod_llm; периодическое обновление — если включено
+    get_catalog_refresher().start()
+    logger.info(f"Очередь обработки голоса запускается с {VOICE_WORKERS_COUNT} воркерами (до {VOICE_WORKERS_MAX}).")
     voice_queue.start()
 
+    # Показатели компонентов (глубина очередей, отмены, кэши) экспортируются вместе с гистограммами
+    metrics = get_metrics()
+    metrics.register_collector("voice_queue", voice_queue.get_stats)
+    metrics.register_collector("outbound", get_outbound().get_stats)
+    metrics.register_collector("role", get_role_manager().get_stats)
+    metrics.register_collector("memory", get_long_term_memory().get_stats)
+    metrics.register_collector("tracing", get_tracer().get_stats)
+    await get_metrics_server().start()
+
 async def on_shutdown():
+    await get_metrics_server().stop()
+    get_role_manager().stop()
+    get_catalog_refresher().stop()
     if voice_queue:
         voice_queue.stop()
+    get_audio_pool().stop()
+    await get_outbound().flush()
     await bot.session.close()
     logger.info("Бот остановлен.")
 
+def is_ready() -> bool:
+    return bool(voice_queue and voice_queue.running)
+
 async def main():
+    if BOT_MODE == "webhook":
+        base_url = os.getenv("WEBHOOK_URL")
+        if not base_url:
+            raise RuntimeError("BOT_MODE = 'webhook', но WEBHOOK_URL не задан в .env")
+        secret = os.getenv("WEBHOOK_SECRET") or default_secret(TELEGRAM_TOKEN)
+        await run_webhook(
+            bot, dp, base_url.rstrip("/") + WEBHOOK_PATH, secret,
+            on_startup=on_startup, on_shutdown=on_shutdown, is_ready=is_ready,
+        )
+        return
+
     await on_startup()
     try:
+        # Перед polling снимаем webhook, если бот раньше работал в режиме webhook
+        await bot.delete_webhook(drop_pending_updates=False)
         await dp.start_polling(bot)
     finally:
         await on_shutdown()
@@ -1,223 +1,271 @@
 # mod_llm.py
+"""
+Реестр моделей. Список моделей, их лимиты и возможности — в JSON-каталоге (MODEL_CATALOG_PATH),
+а не в коде: обновление каталога не требует правок. Поиск по id и семейству — по словарям, O(1).
+Поверх каталога накладывается снимок метаданных провайдеров (MODEL_SNAPSHOT_PATH, его пишет
+get_model_limits.py / services/catalog_refresh.py): актуальные лимиты, модальности, thinking.
+MODELS, get_model_info, get_model_family и DEFAULT_MODEL сохранены для совместимости.
+"""
+import json
+import logging
+import threading
+from typing import Iterator, Optional
+from config import MODEL_CATALOG_PATH, MODEL_SNAPSHOT_PATH
 
-MODELS = [
-    # --- Gemini Models ---
-    {
-        # Gemini 2.5 Pro — флагманская облачная модель Google.
-        # Поддерживает reasoning (Deep Think), multimodal input (текст, изображения, аудио, видео, PDF),
-        # search grounding (поиск Google) и function-calling.
-        # Обрабатывает контекст до 1 000 000 токенов.
-        # Идеальна для научных, технических, кодовых задач и глубокого анализа.
-        "id": "gemini-2.5-pro",
-        "name": "Gemini 2.5 Pro",
-        "family": "gemini",
-        "FreeRPD": 100,
-        "input_token_limit": 1048576, # Добавлено
-        "description": "Глубокий анализ, поиск, мультимодальность",
-        "audio_support": True
-    },
-    {
-        # Gemini 2.5 Flash — сбалансированная мощная облачная модель.
-        # Поддерживает multimodal input (текст, изображения, аудио, видео),
-        # reasoning и search grounding, function-calling.
-        # Хороший выбор для диалогов, генерации идей и креативных задач.
-        "id": "gemini-2.5-flash",
-        "name": "Gemini 2.5 Flash",
-        "family": "gemini",
-        "FreeRPD": 250,
-        "input_token_limit": 1048576, # Добавлено
-        "description": "Баланс скорости, качества, поиск",
-        "audio_support": True
-    },
-    {
-        # Gemini 2.5 Flash-Lite — самая быстрая и экономичная в семействе 2.5.
-        # Поддерживает multimodal input (текст, изображения, аудио, видео, PDF),
-        # reasoning (по умолчанию off, но можно включить) и search grounding.
-        # Отлично подходит для массовых задач: перевод, классификация, суммаризация.
-        "id": "gemini-2.5-flash-lite",
-        "name": "Gemini 2.5 Flash-Lite",
-        "family": "gemini",
-        "FreeRPD": 1000,
-        "input_token_limit": 1048576, # Добавлено
-        "description": "Очень быстрая, мультимодальная, с поиском",
-        "audio_support": True
-    },
-    {
-        # Gemini 2.0 Flash — предыдущая версия Flash.
-        # Поддерживает текст, изображения, аудио, видео.
-        # Есть grounding с Google Search, но reasoning и мультимодальность уступают версии 2.5.
-        "id": "gemini-2.0-flash",
-        "name": "Gemini 2.0 Flash",
-        "family": "gemini",
-        "FreeRPD": 200,
-        "input_token_limit": 1048576, # Добавлено
-        "description": "Стабильная Flash 2.0, мультимодальность",
-        "audio_support": True
-    },
-    {
-        # Gemini 2.0 Flash-Lite — облегченное ядро той же модели.
-        # Только аудио/текст/изображения, без глубокого reasoning.
-        # Максимально упрощена ради скорости.
-        "id": "gemini-2.0-flash-lite",
-        "name": "Gemini 2.0 Flash-Lite",
-        "family": "gemini",
-        "FreeRPD": 200,
-        "input_token_limit": 1048576, # Добавлено
-        "description": "Лёгкая версия Flash 2.0",
-        "audio_support": True
-    },
-
-    # --- Gemma Models ---
-    {
-        # Gemma 3 27B IT — топовая открытая модель Gemma.
-        # Поддерживает multimodal input (текст + изображения), long context до 128 000 токенов,
-        # мощный reasoning и глубокий анализ.
-        # Оптимальна для STEM-задач, анализа больших документов и сложных рассуждений.
-        "id": "gemma-3-27b-it",
-        "name": "Gemma 3 27B IT",
-        "family": "gemma",
-        "FreeRPD": 14400,
-        "input_token_limit": 131072, # Добавлено
-        "description": "Топ‑модель Gemma, мультимодальность, большой контекст",
-        "audio_support": False
-    },
-    {
-        # Gemma 3 12B IT — более компактная, но мощная модель.
-        # Поддерживает multimodal input (текст + изображения),
-        # способна решать большинство сложных задач с меньшими ресурсами.
-        "id": "gemma-3-12b-it",
-        "name": "Gemma 3 12B IT",
-        "family": "gemma",
-        "FreeRPD": 14400,
-        "input_token_limit": 32768, # Добавлено
-        "description": "Мощная, но быстрее 27B, мультимодальная",
-        "audio_support": False
-    },
-    {
-        # Gemma 3 4B IT — средняя модель в линейке Gemma 3.
-        # Поддерживает текст и изображения, reasoning на базовом уровне.
-        # Хороший баланс скорости, качества и мультимодальной поддержки.
-        "id": "gemma-3-4b-it",
-        "name": "Gemma 3 4B IT",
-        "family": "gemma",
-        "FreeRPD": 14400,
-        "input_token_limit": 32768, # Добавлено
-        "description": "Баланс скорости/качества, мультимодальность",
-        "audio_support": False
-    },
-    {
-        # Gemma 3n E4B IT — оптимизированная квантованная модель для локального или легкого облака.
-        # Поддерживает текст и ограниченную мультимодальность (часто текст + изображения),
-        # быстрее и легче в ресурсах, но с немного уменьшенным качеством.
-        "id": "gemma-3n-e4b-it",
-        "name": "Gemma 3n E4B IT",
-        "family": "gemma",
-        "FreeRPD": 14400,
-        "input_token_limit": 8192, # Добавлено
-        "description": "Локальная, быстрый баланс, мультимодальность",
-        "audio_support": False
-    },
-    {
-        # Gemma 3n E2B IT — самая лёгкая и быстрая модель Gemma для локального использования.
-        # Поддерживает только текстовый ввод, минимальное reasoning.
-        # Идеальна для мгновенных ответов на простые запросы с минимальными ресурсами.
-        "id": "gemma-3n-e2b-it",
-        "name": "Gemma 3n E2B IT",
-        "family": "gemma",
-        "FreeRPD": 14400,
-        "input_token_limit": 8192, # Добавлено
-        "description": "Самая лёгкая, только текст, простые ответы",
-        "audio_support": False
-    },
-    # --- НОВОЕ: Модели OpenRouter ---
-    {
-        "id": "qwen/qwen3-235b-a22b:free",
-        "name": "Qwen3 235B A22B (Free)",
-        "family": "openrouter",
-        "FreeRPD": 1000, # Примерное значение
-        "input_token_limit": 131072, # 131K
-        "description": "Qwen 235B MoE, 22B активных. Режимы 'thinking' и обычный. 100+ языков.",
-        "audio_support": False
-    },
-    {
-        "id": "deepseek/deepseek-chat-v3-0324:free",
-        "name": "DeepSeek V3 0324 (Free)",
-        "family": "openrouter",
-        "FreeRPD": 1000, # Примерное значение
-        "input_token_limit": 163840, # 164K (округлено до степени 2)
-        "description": "DeepSeek 685B MoE. Флагман чатов V3. Хорош во многих задачах.",
-        "audio_support": False
-    },
-
-    {
-        "id": "mistralai/mistral-small-3.2-24b-instruct:free",
-        "name": "Mistral Small 3.2 24B Instruct (Free)",
-        "family": "openrouter",
-        "FreeRPD": 1000, # Примерное значение
-        "input_token_limit": 131072, # 164K (округлено до степени 2)
-        "description": "Mistral Small 3.2 24B Instruct. Хорош во многих задачах.",
-        "audio_support": False
-    },
-
-    # --- НОВЫЕ: Модели Groq ---
-    # Предполагая, что Groq API будет использоваться для этих моделей
-    # и они будут доступны через OpenRouter с семейством 'groq'
-    # (Пожалуйста, уточните, если это не так)
-    {
-        "id": "openai/gpt-oss-120b", # Уточните правильный ID модели для Groq, если отличается
-        "name": "OpenAI GPT-OSS 120B",
-        "family": "groq",  # <-- Исправлено: семейство groq
-        "FreeRPD": 1000,   # <-- Исправлено: взято второе число (1K -> 1000)
-        "input_token_limit": 131072, # Контекст 131K
-        "description": "Открытая модель от OpenAI с 120 миллиардами параметров через Groq. Контекст до 131K токенов.",
-        "audio_support": False
-    },
-    {
-        "id": "openai/gpt-oss-20b", # Уточните правильный ID модели для Groq, если отличается
-        "name": "OpenAI GPT-OSS 20B",
-        "family": "groq",  # <-- Исправлено: семейство groq
-        "FreeRPD": 1000,   # <-- Исправлено: взято второе число (1K -> 1000)
-        "input_token_limit": 131072, # Контекст 131K
-        "description": "Открытая модель от OpenAI с 20 миллиардами параметров через Groq. Контекст до 131K токенов.",
-        "audio_support": False
-    },
-    {
-        "id": "meta-llama/llama-4-maverick-17b-128e-instruct", # Уточните ID для Groq
-        "name": "Meta Llama 4 Maverick 17B 128E Instruct",
-        "family": "groq",  # <-- Исправлено: семейство groq
-        "FreeRPD": 1000,   # <-- Исправлено: взято второе число (1K -> 1000)
-        "input_token_limit": 131072, # Контекст 131K
-        "description": "Модель Llama 4 Maverick с 17 миллиардами параметров и 128 experts через Groq. Контекст до 131K токенов.",
-        "audio_support": False
-    },
-    {
-        "id": "deepseek-r1-distill-llama-70b", # Уточните ID для Groq
-        "name": "DeepSeek R1 Distill Llama 70B",
-        "family": "groq",  # <-- Исправлено: семейство groq
-        "FreeRPD": 1000,   # <-- Исправлено: взято второе число (1K -> 1000)
-        "input_token_limit": 131072, # Контекст 131K
-        "description": "Модель DeepSeek R1 Distill Llama с 70 миллиардами параметров через Groq. Контекст до 131K токенов.",
-        "audio_support": False
-    }
-
-]
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION = 1
+SNAPSHOT_SCHEMA = 1
+KNOWN_FAMILIES = ("gemini", "gemma", "openrouter", "groq")
+# Семейство -> провайдер, у которого в снимке лежат метаданные (Gemma отдаёт Gemini API)
+FAMILY_PROVIDER = {"gemini": "gemini", "gemma": "gemini", "openrouter": "openrouter", "groq": "groq"}
+
+# Поле -> (допустимые типы, обязательное)
+_FIELDS = {
+    "id": (str, True),
+    "name": (str, True),
+    "family": (str, True),
+    "description": (str, True),
+    "FreeRPD": (int, True),
+    "input_token_limit": (int, True),
+    "output_token_limit": ((int, type(None)), False),
+    "audio_support": (bool, False),
+    "image_support": (bool, False),
+    "search_support": (bool, False),
+    "thinking_support": (bool, False),
+    "notes": (str, False),
+    "rate_limits": (dict, False),
+}
+# Флаги возможностей: имя для supports() -> поле каталога
+CAPABILITIES = {
+    "audio": "audio_support",
+    "images": "image_support",
+    "search": "search_support",
+    "thinking": "thinking_support",
+}
+
+
+class CatalogError(ValueError):
+    """Каталог моделей не прошёл проверку."""
+
+
+def validate_model(entry) -> dict:
+    """Проверяет запись каталога и возвращает её с заполненными флагами по умолчанию."""
+    if not isinstance(entry, dict):
+        raise CatalogError(f"запись модели должна быть объектом, получено {type(entry).__name__}")
+    model_id = entry.get("id", "?")
+    for field, (types_, required) in _FIELDS.items():
+        if field not in entry:
+            if required:
+                raise CatalogError(f"модель '{model_id}': нет обязательного поля '{field}'")
+            continue
+        value = entry[field]
+        allowed = types_ if isinstance(types_, tuple) else (types_,)
+        # bool — подкласс int: лимит True/False не должен пройти проверку
+        if not isinstance(value, allowed) or (isinstance(value, bool) and bool not in allowed):
+            raise CatalogError(f"модель '{model_id}': поле '{field}' имеет неверный тип ({type(value).__name__})")
+    if entry["family"] not in KNOWN_FAMILIES:
+        raise CatalogError(f"модель '{model_id}': неизвестное семейство '{entry['family']}'")
+    for field in ("input_token_limit", "output_token_limit", "FreeRPD"):
+        if entry.get(field) is not None and entry[field] <= 0:
+            raise CatalogError(f"модель '{model_id}': поле '{field}' должно быть положительным")
+    model = dict(entry)
+    for field in CAPABILITIES.values():
+        model.setdefault(field, False)
+    model.setdefault("output_token_limit", None)
+    return model
+
+
+class ModelRegistry:
+    """Модели из каталога с индексами по id и семейству."""
+
+    def __init__(self, models: list[dict], default_model: Optional[str] = None,
+                 version: int = CATALOG_VERSION, generated_at: Optional[str] = None, source: str = "manual"):
+        if not models:
+            raise CatalogError("каталог не содержит моделей")
+        self.models = [validate_model(m) for m in models]
+        self._by_id: dict[str, dict] = {}
+        self._by_family: dict[str, list[dict]] = {}
+        for model in self.models:
+            if model["id"] in self._by_id:
+                raise CatalogError(f"модель '{model['id']}' указана в каталоге дважды")
+            self._by_id[model["id"]] = model
+            self._by_family.setdefault(model["family"], []).append(model)
+        if default_model is None:
+            default_model = next((m["id"] for m in self.models if m["family"] == "gemini"), self.models[0]["id"])
+        if default_model not in self._by_id:
+            raise CatalogError(f"модель по умолчанию '{default_model}' отсутствует в каталоге")
+        self.default_model = default_model
+        self.version = version
+        self.generated_at = generated_at
+        self.source = source
+        # Версия снимка провайдеров, наложенного на каталог (None — только каталог)
+        self.snapshot_version: Optional[int] = None
+
+    @classmethod
+    def from_catalog(cls, data) -> "ModelRegistry":
+        if not isinstance(data, dict):
+            raise CatalogError("каталог должен быть JSON-объектом")
+        if data.get("version") != CATALOG_VERSION:
+            raise CatalogError(f"неподдерживаемая версия каталога: {data.get('version')} (ожидается {CATALOG_VERSION})")
+        models = data.get("models")
+        if not isinstance(models, list):
+            raise CatalogError("в каталоге нет списка 'models'")
+        return cls(
+            models,
+            default_model=data.get("default_model"),
+            version=data["version"],
+            generated_at=data.get("generated_at"),
+            source=data.get("source", "manual"),
+        )
+
+    def get(self, model_id: str) -> Optional[dict]:
+        return self._by_id.get(model_id)
+
+    def family(self, model_id: str) -> str:
+        model = self._by_id.get(model_id)
+        return model["family"] if model else "unknown"
+
+    def by_family(self, family: str) -> list[dict]:
+        return list(self._by_family.get(family, ()))
+
+    def families(self) -> list[str]:
+        """Семейства в порядке каталога."""
+        return list(self._by_family)
+
+    def supports(self, model_id: str, capability: str) -> bool:
+        model = self._by_id.get(model_id)
+        return bool(model and model.get(CAPABILITIES[capability]))
+
+    def __contains__(self, model_id) -> bool:
+        return model_id in self._by_id
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self.models)
+
+    def __len__(self) -> int:
+        return len(self.models)
+
+
+def validate_snapshot(snapshot) -> dict:
+    """Проверяет структуру снимка провайдеров; возвращает providers."""
+    if not isinstance(snapshot, dict) or snapshot.get("schema") != SNAPSHOT_SCHEMA:
+        raise CatalogError(f"неподдерживаемая схема снимка: {snapshot.get('schema') if isinstance(snapshot, dict) else None}")
+    providers = snapshot.get("providers")
+    if not isinstance(providers, dict):
+        raise CatalogError("в снимке нет объекта 'providers'")
+    for name, provider in providers.items():
+        if not isinstance(provider, dict) or not isinstance(provider.get("models", {}), dict):
+            raise CatalogError(f"провайдер '{name}': неверный формат")
+    return providers
+
+
+def _overlay(model: dict, meta: dict) -> dict:
+    """Накладывает метаданные провайдера на запись каталога (только известные значения)."""
+    merged = dict(model)
+    for field in ("input_token_limit", "output_token_limit"):
+        value = meta.get(field)
+        if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+            merged[field] = value
+    modalities = meta.get("input_modalities")
+    if isinstance(modalities, list) and modalities:
+        merged["image_support"] = "image" in modalities
+        merged["audio_support"] = "audio" in modalities
+    if isinstance(meta.get("thinking"), bool):
+        merged["thinking_support"] = meta["thinking"]
+    rate_limits = meta.get("rate_limits")
+    if isinstance(rate_limits, dict) and rate_limits:
+        merged["rate_limits"] = rate_limits
+        if isinstance(rate_limits.get("rpd"), int) and rate_limits["rpd"] > 0:
+            merged["FreeRPD"] = rate_limits["rpd"]
+    return merged
+
+
+def build_registry(catalog: dict, snapshot: Optional[dict] = None) -> ModelRegistry:
+    """Реестр из каталога с наложенным снимком провайдеров. Ошибка снимка не роняет каталог."""
+    base = ModelRegistry.from_catalog(catalog)
+    if snapshot is None:
+        return base
+    try:
+        providers = validate_snapshot(snapshot)
+        models = []
+        for model in base.models:
+            provider = providers.get(FAMILY_PROVIDER.get(model["family"], ""), {})
+            meta = provider.get("models", {}).get(model["id"])
+            # Лимиты на уровне провайдера (Groq — на аккаунт) — для моделей без собственных
+            provider_limits = provider.get("rate_limits")
+            if meta is None:
+                meta = {}
+            if isinstance(meta, dict) and not meta.get("rate_limits") and isinstance(provider_limits, dict):
+                meta = {**meta, "rate_limits": provider_limits}
+            models.append(_overlay(model, meta) if isinstance(meta, dict) else model)
+        registry = ModelRegistry(models, base.default_model, base.version, base.generated_at, base.source)
+    except CatalogError as e:
+        logger.warning(f"Снимок моделей не применён: {e}")
+        return base
+    registry.snapshot_version = snapshot.get("version")
+    return registry
+
+
+def _read_json(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_snapshot(path: str = MODEL_SNAPSHOT_PATH) -> Optional[dict]:
+    """Снимок провайдеров с диска (сеть не нужна); None — снимка нет или он повреждён."""
+    try:
+        return _read_json(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать снимок моделей {path}: {e}")
+        return None
+
+
+def _load_catalog(path: str = MODEL_CATALOG_PATH) -> dict:
+    try:
+        return _read_json(path)
+    except (OSError, ValueError) as e:
+        raise CatalogError(f"не удалось прочитать каталог моделей {path}: {e}") from e
+
+
+# Реестр загружается при импорте; без корректного каталога бот не стартует
+_registry = build_registry(_load_catalog(), load_snapshot())
+_registry_lock = threading.Lock()
+logger.info(
+    f"Каталог моделей {MODEL_CATALOG_PATH}: {len(_registry)} моделей, по умолчанию {_registry.default_model}, "
+    f"снимок провайдеров: {_registry.snapshot_version or 'нет'}"
+)
+
+def get_registry() -> ModelRegistry:
+    return _registry
+
+def apply_snapshot(snapshot: dict) -> ModelRegistry:
+    """
+    Перестраивает реестр с новым снимком и подменяет его одной операцией присваивания:
+    запросы, уже взявшие записи моделей, дорабатывают со старыми.
+    """
+    global _registry
+    with _registry_lock:
+        registry = build_registry(_load_catalog(), snapshot)
+        _registry = registry
+        # MODELS импортирован другими модулями по ссылке — обновляем список на месте
+        MODELS[:] = registry.models
+    return registry
+
+# --- Совместимость со старым API ---
+MODELS = list(_registry.models)
 
 # Функция для получения информации о модели по ID
 def get_model_info(model_id):
     """Получает информацию о модели по её ID."""
-    return next((m for m in MODELS if m['id'] == model_id), None)
+    return _registry.get(model_id)
 
 # Функция для получения семейства модели
 def get_model_family(model_id):
-    """Получает семейство модели ('gemini', 'gemma' или 'unknown')."""
-    model_info = get_model_info(model_id)
-    return model_info['family'] if model_info else 'unknown'
-
-# Модель по умолчанию - первая из списка Gemini или_gemini_2.5_flash_lite_preview_06_17_
-# Проверяем, существует ли модель по индексу 2
-if len(MODELS) > 2 :
-    DEFAULT_MODEL = MODELS[2]["id"] # gemini-2.5-flash-lite-preview-06-17
-else:
-    # Если нет, выбираем первую доступную модель Gemini
-    default_model_info = next((m for m in MODELS if m['family'] == 'gemini'), None)
-    DEFAULT_MODEL = default_model_info["id"] if default_model_info else MODELS[0]["id"]
+    """Получает семейство модели ('gemini', 'gemma', 'openrouter', 'groq' или 'unknown')."""
+    return _registry.family(model_id)
+
+# Модель по умолчанию — default_model из каталога (иначе первая модель Gemini)
+DEFAULT_MODEL = _registry.default_model
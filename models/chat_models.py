@@ -44,6 +44,8 @@ class ChatSettings:
     # current_model теперь инициализируется информацией о DEFAULT_MODEL
     current_model: Dict[str, Any] = field(default_factory=_get_default_model_info)
     voice_mode: bool = False
+    # Роль ассистента в чате (папка в person/): None — роль по умолчанию из person.set, '' — без роли
+    role: Optional[str] = None
 # --- Конец обновлённого ChatSettings ---
 
 @dataclass
@@ -0,0 +1,152 @@
+# services/audio_pool.py
+"""Пул процессов для CPU-нагруженной работы с аудио: декодирование, ресемплинг, VAD, кодирование."""
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+from config import AUDIO_POOL_WORKERS, AUDIO_POOL_MAX_PENDING
+
+logger = logging.getLogger(__name__)
+
+# Коэффициент сглаживания для скользящего среднего времени выполнения
+_EWMA_ALPHA = 0.2
+
+
+def _warm_up() -> int:
+    """Выполняется в каждом воркере при старте: прогревает импорт pydub/numpy."""
+    import audio_utils  # noqa: F401
+    time.sleep(0.05)  # держим воркер занятым, чтобы следующие задачи прогрева достались другим
+    return os.getpid()
+
+
+class AudioPool:
+    """
+    Пул постоянных процессов для pydub/ffmpeg/numpy.
+
+    - Воркеры создаются заранее (start) и живут всё время работы бота, поэтому декодирование
+      и VAD не блокируют event loop, а импорт библиотек не повторяется на каждую задачу.
+    - Одновременно ffmpeg запускают не больше workers процессов — всплеск голосовых
+      не превращается в сотни параллельных форков.
+    - max_pending ограничивает число задач в пуле; остальные ждут на семафоре (обратное давление).
+    """
+
+    def __init__(self, workers: int = AUDIO_POOL_WORKERS, max_pending: int = AUDIO_POOL_MAX_PENDING):
+        self.workers = max(1, workers)
+        self.max_pending = max(self.workers, max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.waiting = 0  # ждут места в пуле
+        self.pending = 0  # переданы в пул и ещё не завершены
+        self.stats = {
+            "processed": 0,
+            "failed": 0,
+            "run_time_avg": 0.0,
+            "queue_depth_max": 0,
+        }
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # fork дешевле и не переимпортирует main.py, но безопасен, только пока в процессе один поток:
+        # иначе в воркер копируются захваченные другими потоками блокировки (logging, SSL, очередь
+        # executor) и он может зависнуть. Поэтому fork — только при первом старте (on_startup
+        # поднимает пул раньше всего, что создаёт потоки), а пересоздание после падения и старт
+        # из уже работающего бота — через forkserver: воркеры форкаются из чистого однопоточного процесса
+        methods = multiprocessing.get_all_start_methods()
+        if "fork" in methods and threading.active_count() == 1:
+            context = multiprocessing.get_context("fork")
+        elif "forkserver" in methods:
+            context = multiprocessing.get_context("forkserver")
+            # Сервер заранее импортирует audio_utils (pydub/numpy), а не main.py
+            context.set_forkserver_preload(["audio_utils"])
+        else:
+            context = multiprocessing.get_context("spawn")
+        logger.info(f"Пул обработки аудио: метод запуска процессов {context.get_start_method()}")
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+    async def start(self):
+        """Создаёт пул и заранее поднимает все воркеры."""
+        if self._executor is not None:
+            return
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._executor = self._create_executor()
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        try:
+            pids = await asyncio.gather(
+                *(loop.run_in_executor(self._executor, _warm_up) for _ in range(self.workers))
+            )
+            logger.info(
+                f"Пул обработки аудио: {len(set(pids))} процессов готово "
+                f"за {time.monotonic() - started:.2f}s (лимит задач {self.max_pending})"
+            )
+        except Exception as e:
+            logger.error(f"Не удалось прогреть пул обработки аудио: {e}", exc_info=True)
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def depth(self) -> int:
+        """Глубина очереди пула: задачи, ждущие места, и задачи, ещё не взятые воркерами."""
+        return self.waiting + max(0, self.pending - self.workers)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "workers": self.workers,
+            "pending": self.pending,
+            "waiting": self.waiting,
+            "depth": self.depth(),
+        }
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """
+        Выполняет func(*args) в процессе пула. func и аргументы должны сериализоваться pickle
+        (функции уровня модуля, пути, байты).
+        """
+        if self._executor is None:
+            await self.start()
+        self.waiting += 1
+        self.stats["queue_depth_max"] = max(self.stats["queue_depth_max"], self.depth())
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.pending += 1
+        started = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(self._executor, func, *args)
+            except BrokenProcessPool:
+                # Воркер упал (например, ffmpeg/numpy убил процесс) — пересоздаём пул и повторяем один раз
+                logger.error("Пул обработки аудио повреждён, пересоздаю")
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create_executor()
+                result = await loop.run_in_executor(self._executor, func, *args)
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            self.pending -= 1
+            self._slots.release()
+            elapsed = time.monotonic() - started
+            avg = self.stats["run_time_avg"]
+            self.stats["run_time_avg"] = elapsed if avg == 0.0 else avg + _EWMA_ALPHA * (elapsed - avg)
+        self.stats["processed"] += 1
+        return result
+
+
+# Синглтон пула
+_audio_pool_instance: Optional[AudioPool] = None
+
+def get_audio_pool() -> AudioPool:
+    global _audio_pool_instance
+    if _audio_pool_instance is None:
+        _audio_pool_instance = AudioPool()
+    return _audio_pool_instance
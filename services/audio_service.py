@@ -1,81 +1,199 @@
 # services/audio_service.py
-"""Сервис озвучки: сначала текстовый статус, затем отдельный эмодзи, по готовности — удаление эмодзи, правка статуса и отправка аудио."""
+"""Сервис озвучки: сначала текстовый статус, затем отдельный эмодзи, по готовности — удаление эмодзи, правка статуса и отправка голосовых."""
+import asyncio
 import logging
 import os
+import re
+import time
 from aiogram import Bot
-from aiogram.types import FSInputFile
+from aiogram.types import BufferedInputFile
 from audio_utils import generate_audio_to_opus
+from config import TTS_MODEL, TTS_CHUNK_CHARS, TTS_FIRST_CHUNK_CHARS, TTS_CONCURRENCY
+from services.tts_cache import get_tts_cache, TTSCacheEntry
+from services.telegram_outbound import get_outbound
+from services.cancellation import current_token, raise_if_cancelled, RequestCancelled
+from services.tracing import record_span
 
 logger = logging.getLogger(__name__)
 
+# --- Подготовка текста к озвучке ---
+_SPOILER_RE = re.compile(r"(?:Процесс размышлений \(скрыт\):\s*)?<tg-spoiler>.*?</tg-spoiler>", re.DOTALL)
+_THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL)
+_CODE_BLOCK_RE = re.compile(r"```.*?(?:```|$)", re.DOTALL)
+_PRE_RE = re.compile(r"<pre>.*?</pre>", re.DOTALL)
+_LINK_RE = re.compile(r"\[([^\]]+)\]\([^)]+\)")
+_URL_RE = re.compile(r"https?://\S+")
+_TAG_RE = re.compile(r"</?[a-zA-Z][^>]*>")
+_MD_MARKS_RE = re.compile(r"(\*\*|__|~~|\*|`)")
+_LINE_PREFIX_RE = re.compile(r"^\s*(?:#{1,6}\s+|>\s?|[-*+•]\s+|\d+[.)]\s+)", re.MULTILINE)
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+def prepare_tts_text(text: str) -> str:
+    """
+    Убирает из ответа то, что не нужно озвучивать: скрытые размышления (<tg-spoiler>/<think>),
+    блоки кода, ссылки, HTML-теги и Markdown-разметку.
+    """
+    text = _SPOILER_RE.sub(" ", text)
+    text = _THINK_RE.sub(" ", text)
+    text = _CODE_BLOCK_RE.sub(" ", text)
+    text = _PRE_RE.sub(" ", text)
+    text = _LINK_RE.sub(r"\1", text)
+    text = _URL_RE.sub(" ", text)
+    text = _TAG_RE.sub("", text)
+    text = _LINE_PREFIX_RE.sub("", text)
+    text = _MD_MARKS_RE.sub("", text)
+    # Схлопываем пробелы внутри строк и лишние пустые строки
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r"\n\s*\n+", "\n\n", text)
+    return text.strip()
+
+def split_for_tts(text: str, budget: int = TTS_CHUNK_CHARS, first_budget: int = TTS_FIRST_CHUNK_CHARS) -> list[str]:
+    """
+    Делит текст на части не длиннее бюджета по границам абзацев, затем предложений, затем слов.
+    Первая часть ограничена first_budget, чтобы начало озвучки пришло быстрее.
+    """
+    pieces: list[str] = []
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        # Первый абзац дробим по предложениям уже при превышении first_budget
+        if len(paragraph) <= (first_budget if not pieces else budget):
+            pieces.append(paragraph)
+            continue
+        for sentence in _SENTENCE_RE.split(paragraph):
+            while len(sentence) > budget:
+                cut = sentence.rfind(" ", 0, budget)
+                cut = cut if cut > 0 else budget
+                pieces.append(sentence[:cut].strip())
+                sentence = sentence[cut:].strip()
+            if sentence:
+                pieces.append(sentence)
+
+    chunks: list[str] = []
+    current = ""
+    for piece in pieces:
+        limit = first_budget if not chunks else budget
+        if current and len(current) + 1 + len(piece) > limit:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
 async def send_audio_with_progress(
     bot: Bot,
     chat_id: int,
     text: str,
     reply_to_message_id: int | None = None
 ):
+    tts_text = prepare_tts_text(text)
+    if not tts_text:
+        logger.info(f"Нечего озвучивать для чата {chat_id}: ответ состоит из кода/служебных блоков")
+        return
+    chunks = split_for_tts(tts_text)
+    # Запрос отменили (/clear, новое сообщение), пока отправлялся текстовый ответ — не озвучиваем
+    raise_if_cancelled()
+
     # 1) Текстовый статус
     status_msg = await bot.send_message(
         chat_id,
-        "Генерирую аудиоответ, это может занять несколько минут..."
+        "Генерирую аудиоответ..." if len(chunks) > 1 else "Генерирую аудиоответ, это может занять несколько минут..."
     )
-    # 2) Отдельный эмодзи (большой/анимируется, пока один)
-    icon_msg = await bot.send_message(chat_id, "🎙")
+    outbound = get_outbound()
 
     google_api_key = os.getenv("GOOGLE_API_KEY")
-    tts_model = "gemini-2.5-flash-preview-tts"
-
-    ok = False
-    result_path_or_error = ""
-    try:
-        ok, result_path_or_error = await generate_audio_to_opus(text, tts_model, google_api_key)
-
-        # Удаляем эмодзи независимо от успеха
-        try:
-            await bot.delete_message(chat_id, icon_msg.message_id)
-        except Exception:
-            pass
+    semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+    cache = get_tts_cache()
 
+    async def synthesize(chunk: str) -> tuple[bool, TTSCacheEntry | str]:
+        key = cache.key_for(chunk) if cache else ""
+        if cache:
+            # Чтение файла и SQLite — в потоке, чтобы не задерживать другие чаты
+            entry = await asyncio.to_thread(cache.lookup, key)
+            if entry:
+                logger.info(f"Озвучка найдена в кэше ({'file_id' if entry.file_id else 'аудио'})")
+                return True, entry
+        async with semaphore:
+            ok, audio_or_error = await generate_audio_to_opus(chunk, TTS_MODEL, google_api_key)
         if not ok:
-            # Обновляем статус — ошибка
+            return False, audio_or_error
+        if cache:
+            await asyncio.to_thread(cache.store_audio, key, audio_or_error)
+        return True, TTSCacheEntry(key=key, audio=audio_or_error)
+
+    async def send_chunk(index: int, entry: TTSCacheEntry):
+        reply_to = reply_to_message_id if sent == 0 else None
+        if entry.file_id:
+            # Уже загружено в Telegram — отправляем по file_id без синтеза и без загрузки
             try:
-                await bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=status_msg.message_id,
-                    text=f"❌ Ошибка генерации аудио: {result_path_or_error}"
-                )
-            except Exception:
-                pass
-            return
-
-        # Обновляем статус — готово
-        try:
-            await bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=status_msg.message_id,
-                text="🎙 Голосовой ответ готов!"
-            )
-        except Exception:
-            pass
-
-        # Отправляем файл
-        audio = FSInputFile(result_path_or_error)
-        await bot.send_audio(chat_id, audio, reply_to_message_id=reply_to_message_id)
-
-    except Exception as e:
-        logger.exception(f"TTS send error: {e}")
-        try:
-            await bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=status_msg.message_id,
-                text=f"❌ Ошибка при отправке аудио: {e}"
-            )
-        except Exception:
-            pass
-    finally:
-        # Чистим временный файл, если он существует
+                await bot.send_voice(chat_id, entry.file_id, reply_to_message_id=reply_to)
+                return
+            except Exception as e:
+                logger.warning(f"file_id из кэша озвучки не принят Telegram: {e}")
+                if not entry.audio:
+                    raise
+        # Отправляем OGG/Opus из памяти как голосовое сообщение
+        voice = BufferedInputFile(entry.audio, filename=f"voice_{index + 1}.ogg")
+        msg = await bot.send_voice(chat_id, voice, reply_to_message_id=reply_to)
+        file_id = getattr(getattr(msg, "voice", None), "file_id", None)
+        if cache and entry.key and file_id:
+            await asyncio.to_thread(cache.set_file_id, entry.key, file_id)
+
+    # Все части синтезируются параллельно (с ограничением), отправляются строго по порядку:
+    # первая уходит сразу, как только готова, не дожидаясь остальных
+    tts_started = time.monotonic()
+    tasks = [asyncio.create_task(synthesize(chunk)) for chunk in chunks]
+    token = current_token()
+    # Отмена запроса сразу прерывает синтез, не дожидаясь готовности текущей части
+    unregister = token.on_cancel(lambda: [task.cancel() for task in tasks]) if token else (lambda: None)
+    sent = 0
+    errors: list[str] = []
+
+    async def edit_status(status_text: str):
+        # Правки склеиваются: при частых частях в Telegram уходит только последний текст
+        await outbound.edit_text(bot, chat_id, status_msg.message_id, status_text)
+
+    # 2) Отдельный эмодзи (большой/анимируется, пока один) или «записывает голосовое»;
+    #    эмодзи удаляется на выходе независимо от успеха
+    async with outbound.placeholder(bot, chat_id, "🎙", "record_voice"):
         try:
-            if ok and isinstance(result_path_or_error, str) and os.path.exists(result_path_or_error):
-                os.remove(result_path_or_error)
-        except Exception:
-            pass
+            for index, task in enumerate(tasks):
+                try:
+                    ok, entry_or_error = await task
+                except asyncio.CancelledError:
+                    # Синтез прерван отменой запроса (см. on_cancel выше) — это не отмена нашей задачи
+                    raise_if_cancelled()
+                    raise
+                # Отмена между частями: уже отправленное остаётся, остальное не синтезируется
+                raise_if_cancelled()
+                if not ok:
+                    errors.append(str(entry_or_error))
+                    continue
+
+                await send_chunk(index, entry_or_error)
+                sent += 1
+                if index + 1 < len(tasks):
+                    await edit_status(f"🎙 Озвучиваю: часть {index + 1}/{len(tasks)} отправлена...")
+
+            # Обновляем статус — итог
+            if not sent:
+                await edit_status(f"❌ Ошибка генерации аудио: {errors[0] if errors else 'нет данных'}")
+            elif errors:
+                await edit_status(f"🎙 Голосовой ответ готов частично: {sent}/{len(tasks)} частей.")
+            else:
+                await edit_status("🎙 Голосовой ответ готов!")
+
+        except RequestCancelled:
+            outbound.delete(bot, chat_id, status_msg.message_id)
+            raise
+        except Exception as e:
+            logger.exception(f"TTS send error: {e}")
+            await edit_status(f"❌ Ошибка при отправке аудио: {e}")
+        finally:
+            unregister()
+            for task in tasks:
+                task.cancel()
+            record_span("tts", tts_started, chunks=len(chunks), sent=sent, failed=len(errors))
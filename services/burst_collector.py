@@ -0,0 +1,47 @@
+# services/burst_collector.py
+"""Сбор «пачек» сообщений: ведущий обработчик ждёт тишины и забирает всю пачку, остальные — ничего."""
+import asyncio
+import time
+from typing import Hashable, Optional
+from aiogram.types import Message
+
+
+class BurstCollector:
+    """
+    Общая часть склейки альбомов (media_group) и быстрых текстовых сообщений.
+
+    Первое сообщение с данным ключом становится «ведущим»: его обработчик ждёт, пока новые
+    сообщения перестанут приходить (window после последнего, но не дольше max_wait с первого),
+    и получает всю пачку по порядку. Обработчики остальных сообщений получают None.
+    Окно может меняться с каждым сообщением (адаптивная склейка текста).
+    """
+
+    def __init__(self, max_wait: float):
+        self.max_wait = max_wait
+        # ключ -> [сообщения, момент последнего поступления, текущее окно]
+        self._groups: dict[Hashable, list] = {}
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    async def collect(self, key: Hashable, message: Message, window: float) -> Optional[list[Message]]:
+        now = time.monotonic()
+        group = self._groups.get(key)
+        if group is not None:
+            group[0].append(message)
+            group[1] = now
+            group[2] = window
+            return None
+
+        started = now
+        group = self._groups[key] = [[message], now, window]
+        try:
+            while True:
+                now = time.monotonic()
+                wait = min(group[1] + group[2], started + self.max_wait) - now
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            del self._groups[key]
+        return sorted(group[0], key=lambda m: m.message_id)
@@ -0,0 +1,233 @@
+# services/cancellation.py
+"""Токены отмены запросов: по чату и по запросу, передаются через contextvars в потоки генерации."""
+import contextvars
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Причины отмены
+REASON_SUPERSEDED = "superseded"   # пришло новое сообщение
+REASON_CLEAR = "clear"             # /clear
+REASON_SETTINGS = "settings"       # сменилась модель/настройки
+
+
+class RequestCancelled(BaseException):
+    """
+    Запрос отменён. Наследуется от BaseException, чтобы проходить сквозь `except Exception`
+    в сервисах моделей и не превращаться в «❌ Ошибка генерации».
+    """
+
+    def __init__(self, reason: str = ""):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    Отмена одного запроса (генерация текста, голосовое, озвучка...).
+
+    Потокобезопасен: проверяется из потока генерации (asyncio.to_thread), отменяется из event loop.
+    on_cancel-колбэки прерывают блокирующий вызов (закрывают HTTP-поток провайдера).
+    """
+
+    def __init__(self, chat_id: int, kind: str, payload: Optional[str] = None):
+        self.id = next(_token_ids)
+        self.chat_id = chat_id
+        self.kind = kind
+        self.payload = payload      # текст запроса — для склейки с новым сообщением при замене
+        self.reason: Optional[str] = None
+        self.created_at = time.monotonic()
+        # Текст запросов, отменённых этим (пользователь дополнил вопрос новым сообщением)
+        self.superseded: list[str] = []
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: list[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str) -> bool:
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug(f"Колбэк отмены завершился ошибкой: {e}")
+        return True
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise RequestCancelled(self.reason or "")
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Регистрирует колбэк; если токен уже отменён — вызывает сразу. Возвращает функцию снятия."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback()
+        return lambda: None
+
+    def _discard(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+_token_ids = itertools.count(1)
+_current_token: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar(
+    "cancel_token", default=None
+)
+
+
+def current_token() -> Optional[CancelToken]:
+    """Токен текущего запроса (виден и в asyncio.to_thread — контекст копируется в поток)."""
+    return _current_token.get()
+
+
+def is_cancelled() -> bool:
+    token = _current_token.get()
+    return token is not None and token.cancelled
+
+
+def raise_if_cancelled():
+    token = _current_token.get()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+@contextmanager
+def bind(token: Optional[CancelToken]):
+    """Делает token текущим на время блока (для воркеров, обрабатывающих задачи разных чатов)."""
+    reset = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset)
+
+
+def cancellable_stream(stream: Iterable, close: Optional[Callable[[], None]] = None) -> Iterator:
+    """
+    Итерирует поток ответа провайдера, проверяя отмену между фрагментами.
+    close — прерывает ожидание следующего фрагмента (закрывает HTTP-ответ) при отмене из другого потока;
+    вызванная этим ошибка чтения превращается в RequestCancelled.
+    """
+    token = _current_token.get()
+    if token is None:
+        yield from stream
+        return
+    token.raise_if_cancelled()
+    unregister = token.on_cancel(close) if close else (lambda: None)
+    try:
+        for item in stream:
+            token.raise_if_cancelled()
+            yield item
+        token.raise_if_cancelled()
+    except RequestCancelled:
+        raise
+    except Exception:
+        if token.cancelled:
+            raise RequestCancelled(token.reason or "") from None
+        raise
+    finally:
+        unregister()
+
+
+class CancellationRegistry:
+    """Активные токены по чатам и счётчики отмен (для метрик)."""
+
+    def __init__(self):
+        self._tokens: dict[int, set[CancelToken]] = defaultdict(set)
+        self.stats = {
+            "started": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "by_reason": defaultdict(int),
+            "by_kind": defaultdict(int),
+            "cancelled_seconds": 0.0,  # сколько уже длились отменённые запросы — потраченная впустую работа
+        }
+
+    def start(self, chat_id: int, kind: str, supersede: bool = False, payload: Optional[str] = None) -> CancelToken:
+        """
+        Регистрирует запрос. supersede=True — отменяет незавершённые запросы того же вида в чате,
+        их текст попадает в token.superseded.
+        """
+        token = CancelToken(chat_id, kind, payload)
+        if supersede:
+            for other in list(self._tokens.get(chat_id, ())):
+                if other.kind == kind and self._cancel(other, REASON_SUPERSEDED) and other.payload:
+                    token.superseded.extend(other.superseded)
+                    token.superseded.append(other.payload)
+        self._tokens[chat_id].add(token)
+        self.stats["started"] += 1
+        return token
+
+    def finish(self, token: CancelToken):
+        tokens = self._tokens.get(token.chat_id)
+        if tokens is None or token not in tokens:
+            return
+        tokens.discard(token)
+        if not tokens:
+            del self._tokens[token.chat_id]
+        if not token.cancelled:
+            self.stats["completed"] += 1
+
+    def cancel_chat(self, chat_id: int, reason: str, kinds: Optional[Iterable[str]] = None) -> int:
+        """Отменяет все (или только указанных видов) незавершённые запросы чата."""
+        kinds = set(kinds) if kinds else None
+        cancelled = 0
+        for token in list(self._tokens.get(chat_id, ())):
+            if (kinds is None or token.kind in kinds) and self._cancel(token, reason):
+                cancelled += 1
+        if cancelled:
+            logger.info(f"Чат {chat_id}: отменено запросов — {cancelled} ({reason})")
+        return cancelled
+
+    def _cancel(self, token: CancelToken, reason: str) -> bool:
+        if not token.cancel(reason):
+            return False
+        self.stats["cancelled"] += 1
+        self.stats["by_reason"][reason] += 1
+        self.stats["by_kind"][token.kind] += 1
+        self.stats["cancelled_seconds"] += time.monotonic() - token.created_at
+        return True
+
+    @contextmanager
+    def request(self, chat_id: int, kind: str, supersede: bool = False, payload: Optional[str] = None):
+        """Регистрирует запрос и делает его токен текущим на время блока."""
+        token = self.start(chat_id, kind, supersede=supersede, payload=payload)
+        try:
+            with bind(token):
+                yield token
+        finally:
+            self.finish(token)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "by_reason": dict(self.stats["by_reason"]),
+            "by_kind": dict(self.stats["by_kind"]),
+            "active": sum(len(tokens) for tokens in self._tokens.values()),
+        }
+
+
+# Синглтон реестра
+_registry_instance: Optional[CancellationRegistry] = None
+
+def get_cancellation() -> CancellationRegistry:
+    global _registry_instance
+    if _registry_instance is None:
+        _registry_instance = CancellationRegistry()
+    return _registry_instance
@@ -0,0 +1,239 @@
+# services/catalog_refresh.py
+"""Обновление снимка метаданных моделей: Gemini, Groq и OpenRouter опрашиваются параллельно."""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Callable, Optional
+import requests
+from google import genai
+from google.genai import types
+from config import MODEL_SNAPSHOT_PATH, MODEL_REFRESH_INTERVAL, MODEL_REFRESH_TIMEOUT
+from mod_llm import SNAPSHOT_SCHEMA, validate_snapshot, load_snapshot, apply_snapshot
+
+logger = logging.getLogger(__name__)
+
+GROQ_MODELS_URL = "https://api.groq.com/openai/v1/models"
+OPENROUTER_MODELS_URL = "https://openrouter.ai/api/v1/models"
+OPENROUTER_KEY_URL = "https://openrouter.ai/api/v1/key"
+
+# Лимиты бесплатных (:free) моделей OpenRouter: в минуту — всегда, в день — зависит от баланса ключа
+_OPENROUTER_FREE_RPM = 20
+_OPENROUTER_FREE_RPD = 50
+_OPENROUTER_FREE_RPD_WITH_CREDITS = 1000
+
+
+# --- Провайдеры: синхронные запросы, вызываются через asyncio.to_thread ---
+# Каждый возвращает (models, provider_info): models — {id: метаданные}, provider_info — общие сведения
+
+def fetch_gemini(timeout: float) -> tuple[dict, dict]:
+    if not os.getenv("GOOGLE_API_KEY"):
+        raise RuntimeError("GOOGLE_API_KEY не задан")
+    client = genai.Client(http_options=types.HttpOptions(timeout=int(timeout * 1000)))
+    models = {}
+    for model in client.models.list():
+        actions = getattr(model, "supported_actions", None) or []
+        if "generateContent" not in actions:
+            continue  # эмбеддинги, TTS-only и т.п. боту не нужны
+        model_id = (model.name or "").split("/")[-1]
+        models[model_id] = {
+            "name": getattr(model, "display_name", None),
+            "input_token_limit": getattr(model, "input_token_limit", None),
+            "output_token_limit": getattr(model, "output_token_limit", None),
+            "thinking": getattr(model, "thinking", None),
+        }
+    return models, {}
+
+
+def _groq_rate_limits(headers) -> dict:
+    limits = {}
+    for key, header in (("rpd", "x-ratelimit-limit-requests"), ("tpm", "x-ratelimit-limit-tokens")):
+        value = headers.get(header)
+        if value and value.isdigit():
+            limits[key] = int(value)
+    return limits
+
+
+def fetch_groq(timeout: float) -> tuple[dict, dict]:
+    api_key = os.getenv("GROQ_API_KEY")
+    if not api_key:
+        raise RuntimeError("GROQ_API_KEY не задан")
+    response = requests.get(GROQ_MODELS_URL, headers={"Authorization": f"Bearer {api_key}"}, timeout=timeout)
+    response.raise_for_status()
+    models = {}
+    for model in response.json().get("data", []):
+        if not model.get("active", True):
+            continue
+        models[model["id"]] = {
+            "name": model["id"],
+            "input_token_limit": model.get("context_window"),
+            "output_token_limit": model.get("max_completion_tokens"),
+        }
+    # Лимиты Groq — на аккаунт, а не на модель; в заголовках, если API их прислал
+    return models, {"rate_limits": _groq_rate_limits(response.headers)}
+
+
+def _openrouter_free_rpd(api_key: Optional[str], timeout: float) -> int:
+    if not api_key:
+        return _OPENROUTER_FREE_RPD
+    try:
+        response = requests.get(OPENROUTER_KEY_URL, headers={"Authorization": f"Bearer {api_key}"}, timeout=timeout)
+        response.raise_for_status()
+        is_free_tier = response.json().get("data", {}).get("is_free_tier", True)
+    except (requests.RequestException, ValueError) as e:
+        logger.debug(f"OpenRouter: не удалось узнать тариф ключа: {e}")
+        return _OPENROUTER_FREE_RPD
+    return _OPENROUTER_FREE_RPD if is_free_tier else _OPENROUTER_FREE_RPD_WITH_CREDITS
+
+
+def fetch_openrouter(timeout: float) -> tuple[dict, dict]:
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    response = requests.get(OPENROUTER_MODELS_URL, timeout=timeout)  # список моделей доступен без ключа
+    response.raise_for_status()
+    free_rpd = _openrouter_free_rpd(api_key, timeout)
+    models = {}
+    for model in response.json().get("data", []):
+        architecture = model.get("architecture") or {}
+        parameters = model.get("supported_parameters")
+        meta = {
+            "name": model.get("name"),
+            "input_token_limit": model.get("context_length"),
+            "output_token_limit": (model.get("top_provider") or {}).get("max_completion_tokens"),
+            "input_modalities": architecture.get("input_modalities"),
+            "output_modalities": architecture.get("output_modalities"),
+            "thinking": "reasoning" in parameters if isinstance(parameters, list) else None,
+        }
+        if model["id"].endswith(":free"):
+            meta["rate_limits"] = {"rpm": _OPENROUTER_FREE_RPM, "rpd": free_rpd}
+        models[model["id"]] = meta
+    return models, {}
+
+
+FETCHERS: dict[str, Callable[[float], tuple[dict, dict]]] = {
+    "gemini": fetch_gemini,
+    "groq": fetch_groq,
+    "openrouter": fetch_openrouter,
+}
+
+
+def write_snapshot(snapshot: dict, path: str = MODEL_SNAPSHOT_PATH):
+    """Атомарная запись: читатель видит либо старый, либо новый снимок целиком."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+class CatalogRefresher:
+    """
+    Собирает снимок метаданных моделей (лимиты контекста и вывода, модальности, thinking,
+    rate limits) со всех провайдеров параллельно и пишет его в MODEL_SNAPSHOT_PATH.
+    Бот читает снимок при старте без сети (mod_llm); в работающем боте снимок можно обновлять
+    периодически — новый реестр моделей подменяет старый атомарно (mod_llm.apply_snapshot).
+    Если провайдер недоступен, в снимке остаются его данные из предыдущей версии (stale).
+    """
+
+    def __init__(self, path: str = MODEL_SNAPSHOT_PATH, timeout: float = MODEL_REFRESH_TIMEOUT,
+                 interval: float = MODEL_REFRESH_INTERVAL, fetchers: Optional[dict] = None):
+        self.path = path
+        self.timeout = timeout
+        self.interval = interval
+        self.fetchers = fetchers or FETCHERS
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"refreshes": 0, "failures": 0, "last_duration": 0.0}
+
+    async def _fetch(self, name: str, fetcher) -> tuple[str, Optional[dict], dict, Optional[str], float]:
+        started = time.monotonic()
+        try:
+            models, info = await asyncio.wait_for(asyncio.to_thread(fetcher, self.timeout), self.timeout * 2)
+            return name, models, info, None, time.monotonic() - started
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            logger.warning(f"Каталог моделей: провайдер {name} недоступен: {error}")
+            return name, None, {}, error, time.monotonic() - started
+
+    async def refresh(self) -> Optional[dict]:
+        """Опрашивает провайдеров и сохраняет новую версию снимка. None — ни один провайдер не ответил."""
+        started = time.monotonic()
+        previous = load_snapshot(self.path) or {}
+        previous_providers = previous.get("providers", {}) if isinstance(previous.get("providers"), dict) else {}
+        results = await asyncio.gather(*(self._fetch(name, fetcher) for name, fetcher in self.fetchers.items()))
+
+        providers = {}
+        fetched_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        for name, models, info, error, duration in results:
+            if models is not None:
+                providers[name] = {"fetched_at": fetched_at, "stale": False, "error": None,
+                                   "duration": round(duration, 3), **info, "models": models}
+            elif name in previous_providers:
+                providers[name] = {**previous_providers[name], "stale": True, "error": error}
+            else:
+                providers[name] = {"fetched_at": None, "stale": True, "error": error, "models": {}}
+
+        if not any(models is not None for _, models, _, _, _ in results):
+            self.stats["failures"] += 1
+            logger.error("Каталог моделей: ни один провайдер не ответил, снимок не обновлён")
+            return None
+
+        snapshot = {
+            "schema": SNAPSHOT_SCHEMA,
+            "version": int(previous.get("version") or 0) + 1,
+            "generated_at": fetched_at,
+            "providers": providers,
+        }
+        validate_snapshot(snapshot)
+        await asyncio.to_thread(write_snapshot, snapshot, self.path)
+        self.stats["refreshes"] += 1
+        self.stats["last_duration"] = time.monotonic() - started
+        logger.info(
+            f"Каталог моделей: снимок v{snapshot['version']} за {self.stats['last_duration']:.1f} с — "
+            + ", ".join(f"{name}: {len(p.get('models', {}))}{' (stale)' if p['stale'] else ''}" for name, p in providers.items())
+        )
+        return snapshot
+
+    def _snapshot_age(self) -> Optional[float]:
+        try:
+            return time.time() - os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    async def _run(self):
+        # Первое обновление — когда снимок устареет (или сразу, если его нет)
+        age = self._snapshot_age()
+        delay = 0.0 if age is None else max(0.0, self.interval - age)
+        while True:
+            await asyncio.sleep(delay)
+            delay = self.interval
+            try:
+                snapshot = await self.refresh()
+                if snapshot is not None:
+                    # Перечитывание каталога и сборка реестра — в потоке, не в event loop
+                    registry = await asyncio.to_thread(apply_snapshot, snapshot)
+                    logger.info(f"Реестр моделей обновлён до снимка v{registry.snapshot_version}")
+            except Exception as e:
+                self.stats["failures"] += 1
+                logger.error(f"Ошибка обновления каталога моделей: {e}", exc_info=True)
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+# Синглтон обновления каталога
+_refresher_instance: Optional[CatalogRefresher] = None
+
+def get_catalog_refresher() -> CatalogRefresher:
+    global _refresher_instance
+    if _refresher_instance is None:
+        _refresher_instance = CatalogRefresher()
+    return _refresher_instance
@@ -1,5 +1,6 @@
 # services/context_service.py
 import logging
+import threading
 from collections import defaultdict
 from datetime import datetime, timedelta
 # Импортируем DEFAULT_MODEL и функции из mod_llm
@@ -8,6 +9,8 @@ from mod_llm import DEFAULT_MODEL, get_model_info
 from config import MAX_HISTORY, CONTEXT_TIMEOUT
 # Импортируем новые модели данных
 from models.chat_models import ChatMessage, ChatSettings
+from services.cancellation import current_token
+from services.long_term_memory import get_long_term_memory
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +26,9 @@ chat_settings: defaultdict[int, ChatSettings] = defaultdict(ChatSettings)
 # chat_models теперь не нужно, так как модель хранится в chat_settings
 # chat_models = defaultdict(lambda: DEFAULT_MODEL) # Устаревшее
 
+# Вытеснение старых сообщений в долговременную память (get_context зовётся из потоков генерации)
+_evict_lock = threading.Lock()
+
 # voice_states можно тоже перенести в ChatSettings, но пока оставим отдельно
 voice_states = defaultdict(bool)  # Словарь для отслеживания режима дублирования
 # --- Конец обновлённых хранилищ ---
@@ -56,6 +62,18 @@ def is_role_context_initialized(chat_id: int) -> bool:
     # Пока используем старый способ для совместимости
     return chat_settings[chat_id].__dict__.get('role_initialized', False)
 
+# --- Функции для работы с ролью чата ---
+def get_chat_role(chat_id: int):
+    """Роль чата: имя папки в person/, None — роль по умолчанию, '' — без роли"""
+    settings = chat_settings.get(chat_id)
+    return settings.role if settings else None
+
+def set_chat_role(chat_id: int, role):
+    """Установка роли чата; инструкции новой роли заново инициализируют контекст"""
+    chat_settings[chat_id].role = role
+    chat_settings[chat_id].__dict__['role_initialized'] = False
+    logger.info(f"Роль для чата {chat_id} установлена на '{role}'")
+
 # --- Обновлённые функции для работы с моделью ---
 def get_chat_model_info(chat_id: int) -> dict:
     """
@@ -128,14 +146,29 @@ def get_context(chat_id: int) -> list:
     max_history = settings.max_history # Берем из объекта
     context_ttl = settings.context_ttl # Берем из объекта
     
-    # Фильтруем сообщения по времени и ограничению истории
-    filtered_context = [
-        m for m in chat_contexts[chat_id]
-        if now - m['timestamp'] < timedelta(seconds=context_ttl)
-    ]
-    
-    # Возвращаем последние max_history сообщений
-    return filtered_context[-max_history:] if max_history else filtered_context
+    with _evict_lock:
+        # Фильтруем сообщения по времени и ограничению истории
+        messages = chat_contexts[chat_id]
+        snapshot = list(messages)
+        filtered_context = [
+            m for m in snapshot
+            if now - m['timestamp'] < timedelta(seconds=context_ttl)
+        ]
+        if max_history:
+            filtered_context = filtered_context[-max_history:]
+
+        # Вытесненные сообщения не теряются — они уходят в долговременную память чата.
+        # Сообщения идут по времени, так что вытесняется всегда начало списка; удаляем его на месте,
+        # чтобы не потерять ход, который параллельно дописывает add_to_context
+        evicted_count = len(snapshot) - len(filtered_context)
+        evicted = messages[:evicted_count]
+        del messages[:evicted_count]
+        # Поколение памяти на момент вытеснения: если между ним и записью был /clear, ходы не сохранятся
+        generation = get_long_term_memory().generation(chat_id) if evicted else None
+    if evicted:
+        get_long_term_memory().remember(chat_id, evicted, generation)
+
+    return filtered_context
 
 def add_to_context(chat_id: int, role: str, content: str):
     """
@@ -146,6 +179,12 @@ def add_to_context(chat_id: int, role: str, content: str):
         role: Роль (user/assistant)
         content: Содержание сообщения
     """
+    # Отменённый запрос (/clear, новое сообщение) не должен дописывать устаревшие ходы в контекст
+    token = current_token()
+    if token is not None and token.cancelled:
+        logger.info(f"Запрос в чате {chat_id} отменён ({token.reason}), запись в контекст пропущена")
+        return
+
     # Инициализируем пустой список если chat_id отсутствует
     if chat_id not in chat_contexts:
         chat_contexts[chat_id] = []
@@ -157,9 +196,11 @@ def add_to_context(chat_id: int, role: str, content: str):
         'timestamp': datetime.now(),
     })
 
-def clear_chat_history(chat_id: int):
-    """Очистка истории диалога для чата"""
-    chat_contexts[chat_id] = []
+async def clear_chat_history(chat_id: int):
+    """Очистка истории диалога для чата (вместе с долговременной памятью)"""
+    with _evict_lock:
+        chat_contexts[chat_id] = []
+    await get_long_term_memory().forget(chat_id)
 # --- Конец остальных функций ---
 
 # --- Обновлённая функция для получения лимита модели ---
@@ -170,6 +211,8 @@ def get_model_limit_for_chat(chat_id: int) -> int:
     """
     # Получаем информацию о модели прямо из настроек чата
     model_info = get_chat_model_info(chat_id)
+    # Актуальный лимит — из реестра (каталог обновляется на лету), копия в настройках — запасной вариант
+    model_info = get_model_info(model_info.get('id')) or model_info
     
     # Извлекаем лимит
     limit = model_info.get('input_token_limit')
@@ -0,0 +1,285 @@
+# services/document_service.py
+"""Документы: потоковое скачивание, извлечение текста постранично до бюджета токенов (начало документа), кэш и Gemini Files API."""
+import asyncio
+import codecs
+import io
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, Optional
+from aiogram import Bot
+from aiogram.types import Document
+from config import (
+    DOCUMENT_SPOOL_MEMORY, DOCUMENT_CONTEXT_SHARE, DOCUMENT_FILES_API_BYTES, DOCUMENT_CACHE_ITEMS,
+)
+from services.metrics import TELEGRAM_DOWNLOAD
+from services.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Тип документа по расширению и по MIME (если у файла нет имени)
+_KIND_BY_EXT = {
+    ".txt": "text", ".text": "text", ".log": "text", ".csv": "text",
+    ".md": "text", ".markdown": "text",
+    ".pdf": "pdf",
+    ".docx": "docx",
+}
+_KIND_BY_MIME = {
+    "application/pdf": "pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+}
+# Типы, которые Gemini читает сам через Files API (docx — нет)
+_FILES_API_MIME = {"pdf": "application/pdf", "text": "text/plain"}
+# Файлы Files API хранятся 48 часов; берём с запасом
+_FILES_API_TTL = 46 * 3600
+
+_TEXT_READ_CHARS = 64 * 1024
+_CHARS_PER_TOKEN = 4  # та же оценка, что и в сервисах моделей (len(text) // 4)
+
+
+@dataclass
+class ExtractedDocument:
+    """Текст документа, обрезанный по бюджету."""
+    text: str
+    truncated: bool      # текст не поместился в бюджет целиком
+    parts_read: int      # прочитано частей (страниц / блоков)
+    max_chars: int       # бюджет, с которым извлекали
+
+
+@dataclass
+class UploadedDocument:
+    """Файл в Gemini Files API."""
+    uri: str
+    mime_type: str
+    expires_at: float
+
+
+def document_kind(document: Document) -> Optional[str]:
+    """'text', 'pdf', 'docx' или None, если формат не поддерживается."""
+    ext = os.path.splitext(document.file_name or "")[1].lower()
+    if ext in _KIND_BY_EXT:
+        return _KIND_BY_EXT[ext]
+    mime = (document.mime_type or "").lower()
+    if mime in _KIND_BY_MIME:
+        return _KIND_BY_MIME[mime]
+    if mime.startswith("text/"):
+        return "text"
+    return None
+
+
+def document_budget_chars(chat_id: int) -> int:
+    """Сколько символов документа помещается в долю контекста модели чата."""
+    from services.context_service import get_model_limit_for_chat
+    return int(get_model_limit_for_chat(chat_id) * DOCUMENT_CONTEXT_SHARE) * _CHARS_PER_TOKEN
+
+
+async def download_to_spool(bot: Bot, document: Document) -> BinaryIO:
+    """
+    Скачивает файл потоком в SpooledTemporaryFile: небольшие файлы остаются в памяти,
+    крупные уходят во временный файл на диске — целиком в RAM документ не держится.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=DOCUMENT_SPOOL_MEMORY)
+    try:
+        with TELEGRAM_DOWNLOAD.time(kind="document"), span("telegram.download", kind="document"):
+            file_info = await bot.get_file(document.file_id)
+            await bot.download_file(file_info.file_path, destination=spool)
+        spool.seek(0)
+        return spool
+    except Exception:
+        spool.close()
+        raise
+
+
+# --- Извлечение текста (синхронно, вызывать через asyncio.to_thread) ---
+def _detect_encoding(fileobj: BinaryIO) -> str:
+    sample = fileobj.read(_TEXT_READ_CHARS)
+    fileobj.seek(0)
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        # Последний символ мог разрезаться границей выборки — его не проверяем
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1251"
+
+
+def _iter_text(fileobj: BinaryIO) -> Iterator[str]:
+    reader = io.TextIOWrapper(fileobj, encoding=_detect_encoding(fileobj), errors="replace", newline="")
+    try:
+        while True:
+            piece = reader.read(_TEXT_READ_CHARS)
+            if not piece:
+                break
+            yield piece
+    finally:
+        reader.detach()  # spool закрывает вызывающий код
+
+
+def _iter_pdf(fileobj: BinaryIO) -> Iterator[str]:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise RuntimeError("Для PDF нужен пакет pypdf (pip install pypdf)")
+    reader = PdfReader(fileobj)
+    for number, page in enumerate(reader.pages, start=1):
+        # Страницы разбираются по одной — следующая не читается, если бюджет уже исчерпан
+        yield f"\n[Страница {number}]\n{page.extract_text() or ''}\n"
+
+
+def _iter_docx(fileobj: BinaryIO) -> Iterator[str]:
+    try:
+        import docx
+    except ImportError:
+        raise RuntimeError("Для DOCX нужен пакет python-docx (pip install python-docx)")
+    document = docx.Document(fileobj)
+    for paragraph in document.paragraphs:
+        yield paragraph.text + "\n"
+    for table in document.tables:
+        yield "\n"
+        for row in table.rows:
+            yield " | ".join(cell.text.strip() for cell in row.cells) + "\n"
+
+
+_EXTRACTORS = {"text": _iter_text, "pdf": _iter_pdf, "docx": _iter_docx}
+
+
+def extract_text_sync(fileobj: BinaryIO, kind: str, max_chars: int) -> ExtractedDocument:
+    """Читает документ частями, пока не наберётся max_chars; остальное не разбирается."""
+    pieces: list[str] = []
+    total = 0
+    parts = 0
+    truncated = False
+    for piece in _EXTRACTORS[kind](fileobj):
+        parts += 1
+        if total + len(piece) > max_chars:
+            pieces.append(piece[:max_chars - total])
+            truncated = True
+            break
+        pieces.append(piece)
+        total += len(piece)
+    return ExtractedDocument("".join(pieces).strip(), truncated, parts, max_chars)
+
+
+# --- Gemini Files API ---
+def upload_to_gemini_sync(fileobj: BinaryIO, kind: str, display_name: str) -> UploadedDocument:
+    """Загружает файл в Gemini Files API прямо из spool (без чтения в память целиком)."""
+    from google import genai
+    from google.genai import types
+
+    client = genai.Client()
+    mime_type = _FILES_API_MIME[kind]
+    uploaded = client.files.upload(
+        file=fileobj,
+        config=types.UploadFileConfig(mime_type=mime_type, display_name=display_name),
+    )
+    # Крупные файлы Gemini обрабатывает асинхронно — ждём готовности
+    deadline = time.monotonic() + 60
+    while getattr(uploaded.state, "name", "ACTIVE") == "PROCESSING" and time.monotonic() < deadline:
+        time.sleep(1)
+        uploaded = client.files.get(name=uploaded.name)
+    if getattr(uploaded.state, "name", "ACTIVE") != "ACTIVE":
+        raise RuntimeError(f"Files API: файл {uploaded.name} в состоянии {uploaded.state}")
+    return UploadedDocument(uploaded.uri, uploaded.mime_type or mime_type, time.time() + _FILES_API_TTL)
+
+
+def use_files_api(kind: str, size: int, model_family: str) -> bool:
+    return model_family == "gemini" and kind in _FILES_API_MIME and size >= DOCUMENT_FILES_API_BYTES
+
+
+# --- Кэш по file_unique_id ---
+class DocumentCache:
+    """LRU извлечённых текстов и загруженных в Files API файлов; ключ — file_unique_id Telegram."""
+
+    def __init__(self, max_items: int = DOCUMENT_CACHE_ITEMS):
+        self.max_items = max_items
+        self._items: OrderedDict[str, ExtractedDocument | UploadedDocument] = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get_text(self, key: str, max_chars: int) -> Optional[ExtractedDocument]:
+        item = self._items.get(key)
+        # Текст, обрезанный под меньший бюджет, не подходит модели с большим контекстом
+        if isinstance(item, ExtractedDocument) and not (item.truncated and item.max_chars < max_chars):
+            if len(item.text) <= max_chars:
+                return self._hit(key, item)
+            # Бюджет модели чата меньше, чем при извлечении, — обрезаем копию, кэш не трогаем
+            self._hit(key, item)
+            return ExtractedDocument(item.text[:max_chars], True, item.parts_read, max_chars)
+        self.stats["misses"] += 1
+        return None
+
+    def get_upload(self, key: str) -> Optional[UploadedDocument]:
+        item = self._items.get(key)
+        if isinstance(item, UploadedDocument) and item.expires_at > time.time():
+            return self._hit(key, item)
+        self.stats["misses"] += 1
+        return None
+
+    def _hit(self, key, item):
+        self._items.move_to_end(key)
+        self.stats["hits"] += 1
+        return item
+
+    def put(self, key: str, item: ExtractedDocument | UploadedDocument):
+        self._items[key] = item
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+
+# Синглтон кэша
+_document_cache_instance: Optional[DocumentCache] = None
+
+def get_document_cache() -> DocumentCache:
+    global _document_cache_instance
+    if _document_cache_instance is None:
+        _document_cache_instance = DocumentCache()
+    return _document_cache_instance
+
+
+async def prepare_document(bot: Bot, chat_id: int, document: Document, kind: str, model_family: str):
+    """
+    Возвращает ExtractedDocument или UploadedDocument для запроса к модели.
+    Скачивание — потоком в spool, разбор и загрузка — в потоке, event loop не блокируется.
+    """
+    cache = get_document_cache()
+    key = document.file_unique_id
+    size = document.file_size or 0
+    max_chars = document_budget_chars(chat_id)
+
+    files_api = use_files_api(kind, size, model_family)
+    if files_api:
+        cached = cache.get_upload(key)
+        if cached:
+            return cached
+    else:
+        cached = cache.get_text(key, max_chars)
+        if cached:
+            return cached
+
+    spool = await download_to_spool(bot, document)
+    try:
+        if files_api:
+            try:
+                uploaded = await asyncio.to_thread(
+                    upload_to_gemini_sync, spool, kind, document.file_name or key
+                )
+                cache.put(key, uploaded)
+                logger.info(f"Документ {document.file_name} ({size} байт) загружен в Files API")
+                return uploaded
+            except Exception as e:
+                logger.warning(f"Files API недоступен ({e}), извлекаю текст локально")
+                spool.seek(0)
+        extracted = await asyncio.to_thread(extract_text_sync, spool, kind, max_chars)
+    finally:
+        spool.close()
+
+    cache.put(key, extracted)
+    logger.info(
+        f"Документ {document.file_name}: {len(extracted.text)} символов из {extracted.parts_read} частей"
+        f"{' (обрезан по бюджету)' if extracted.truncated else ''}"
+    )
+    return extracted
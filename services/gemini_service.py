@@ -1,12 +1,18 @@
 # services/gemini_service.py
 """Сервис для генерации ответов моделями семейства Gemini с включённым поиском."""
 import logging
+import time
 from google import genai
 from google.genai import types
 from services.context_service import (
     get_context, add_to_context, get_chat_model,
     get_model_limit_for_chat,
 )
+from services.model_service import image_list
+from services.cancellation import cancellable_stream
+from services.metrics import CONTEXT_PREPARE, count_error, timed_stream
+from services.tracing import record_span
+from services.long_term_memory import get_long_term_memory
 
 logger = logging.getLogger(__name__)
 
@@ -62,10 +68,13 @@ def truncate_context(context_messages: list[types.Content],
         total_needed -= removed_tokens
     return truncated
 
-def generate_response_gemini(chat_id: int, prompt: str, image_bytes: bytes | None = None) -> str:
+def generate_response_gemini(chat_id: int, prompt: str, image_bytes: bytes | list[bytes] | None = None,
+                             files: list | None = None, history_prompt: str | None = None) -> str:
     """
     Синхронная генерация ответа для Gemini.
     Вызывать из async-кода через asyncio.to_thread(...).
+    files — документы, загруженные в Files API (uri, mime_type); в историю не попадают.
+    history_prompt — что сохранить в историю вместо prompt (например, без текста документа).
     """
     try:
         model_id = get_chat_model(chat_id)
@@ -77,16 +86,21 @@ def generate_response_gemini(chat_id: int, prompt: str, image_bytes: bytes | Non
         user_parts: list[types.Part] = [types.Part.from_text(text=prompt_str)]
         image_tokens = 0
 
-        # Картинка только как bytes → Part.from_bytes
-        if isinstance(image_bytes, (bytes, bytearray)) and len(image_bytes) > 0:
+        # Картинки (одна или альбом) как bytes → Part.from_bytes, все в одном сообщении пользователя
+        for image in image_list(image_bytes):
             try:
-                img_part = types.Part.from_bytes(data=bytes(image_bytes), mime_type="image/jpeg")
+                img_part = types.Part.from_bytes(data=image, mime_type="image/jpeg")
             except Exception:
-                img_part = types.Part(inline_data=types.Blob(data=bytes(image_bytes), mime_type="image/jpeg"))
+                img_part = types.Part(inline_data=types.Blob(data=image, mime_type="image/jpeg"))
             user_parts.append(img_part)
-            image_tokens = 256
+            image_tokens += 256
+
+        # Документы из Files API передаются ссылкой; их размер модель учитывает сама
+        for doc in files or []:
+            user_parts.append(types.Part.from_uri(file_uri=doc.uri, mime_type=doc.mime_type))
 
         # История → только роли user/model
+        context_started = time.monotonic()
         history = get_context(chat_id)
         ctx_contents: list[types.Content] = []
         for m in history:
@@ -96,49 +110,48 @@ def generate_response_gemini(chat_id: int, prompt: str, image_bytes: bytes | Non
                 types.Content(role=role_norm, parts=[types.Part.from_text(text=content_text)])
             )
 
+        # Долговременная память: прошлые разговоры, относящиеся к вопросу, — в system_instruction;
+        # её объём учитывается при обрезке контекста
+        memory_block = get_long_term_memory().recall_block(chat_id, prompt_str)
         max_ctx_tokens = get_model_limit_for_chat(chat_id)
-        prompt_tokens = len(prompt_str) // 4
+        prompt_tokens = (len(prompt_str) + len(memory_block or "")) // 4
         trimmed_ctx = truncate_context(ctx_contents, max_ctx_tokens, prompt_tokens, image_tokens)
+        CONTEXT_PREPARE.observe(time.monotonic() - context_started, family="gemini")
+        record_span("context", context_started, family="gemini")
 
         # ВКЛЮЧАЕМ ПОИСК GOOGLE как tool
         google_search_tool = types.Tool(google_search=types.GoogleSearch())
         config = types.GenerateContentConfig(
             tools=[google_search_tool],
             response_modalities=["TEXT"],
+            system_instruction=memory_block,
         )
 
         contents: list[types.Content] = []
         contents.extend(trimmed_ctx)
         contents.append(types.Content(role="user", parts=user_parts))
 
-        resp = client.models.generate_content(
+        # Ответ потоком: при отмене запроса (/clear, новое сообщение) поток закрывается,
+        # а недописанный ответ не попадает в контекст
+        request_started = time.monotonic()
+        stream = client.models.generate_content_stream(
             model=model_id,
             contents=contents,
             config=config,
         )
+        texts = (
+            chunk.text for chunk in cancellable_stream(stream, close=getattr(client, "close", None))
+            if getattr(chunk, "text", None)
+        )
+        pieces: list[str] = list(timed_stream(texts, "gemini", model_id, request_started))
+        text_out = "".join(pieces).strip() or "❌ Не удалось получить текст из ответа модели."
 
         # Обновляем контекст
-        add_to_context(chat_id, "user", prompt_str)
-
-        text_out = ""
-        if getattr(resp, "text", None):
-            text_out = resp.text.strip()
-        elif getattr(resp, "candidates", None):
-            cand = resp.candidates
-            if cand and cand.content and cand.content.parts:
-                first_part = cand.content.parts
-                if getattr(first_part, "text", None):
-                    text_out = first_part.text.strip()
-                else:
-                    text_out = "✅ Ответ получен, но без текстовой части."
-            else:
-                text_out = "❌ Не удалось получить текст из ответа модели."
-        else:
-            text_out = "❌ Не удалось получить текст из ответа модели."
-
+        add_to_context(chat_id, "user", prompt_str if history_prompt is None else history_prompt)
         add_to_context(chat_id, "model", text_out)
         return text_out
 
     except Exception as e:
+        count_error("provider_gemini", e)
         logger.error(f"Ошибка генерации ответа (Gemini): {e}", exc_info=True)
         return f"❌ Ошибка генерации ответа: {e}"
@@ -1,9 +1,9 @@
 # services/gemma_service.py
 import logging
+import time
 from datetime import datetime
 from google import genai
 from google.genai import types
-from config import CURRENT_ROLE_SETTINGS # Импортируем настройки роли
 from services.context_service import (
     get_context, add_to_context, get_chat_model,
     is_role_context_initialized, set_role_initialized,
@@ -11,6 +11,12 @@ from services.context_service import (
 
 )
 from utils.helpers import process_content
+from services.model_service import image_list
+from services.role_manager import get_role_manager
+from services.long_term_memory import get_long_term_memory
+from services.cancellation import cancellable_stream
+from services.metrics import CONTEXT_PREPARE, count_error, timed_stream
+from services.tracing import record_span
 logger = logging.getLogger(__name__)
 
 # --- Добавленный код: Функции для работы с длиной контекста ---
@@ -90,30 +96,16 @@ def truncate_context(context_messages, max_context_tokens, prompt_tokens, image_
     return truncated_context
 # --- Конец добавленного кода ---
 
-def _format_gemma_prompt(context_messages, current_user_message_parts, instructions_text=None, knowledge_base_text=None):
+def _format_gemma_prompt(context_messages, current_user_message_parts, preamble=""):
     """
     Форматирует промпт для модели Gemma согласно её спецификации.
     Использует <start_of_turn> и <end_of_turn>.
+    preamble — первый ход с инструкциями и базой знаний роли (собирается в services/role_manager.py).
     """
     prompt_parts = []
-    # 1. Добавляем инструкции, если они есть, в самом начале как первый пользовательский ввод
-    # См. https://ai.google.dev/gemma/docs/core/prompt-structure#system_instructions
-    # "Please provide system-level instructions directly in the initial user prompt..."
-    if instructions_text:
-        # Объединяем инструкции с первым пользовательским сообщением или создаем отдельное сообщение
-        system_instruction_part = f"[ИНСТРУКЦИИ РОЛИ]\n{instructions_text}"
-        prompt_parts.append(f"<start_of_turn>user\n{system_instruction_part}")
-        # Базу знаний, если она есть, добавляем после инструкций в том же сообщении
-        if knowledge_base_text:
-             kb_part = f"\n[БАЗА ЗНАНИЙ РОЛИ]\n{knowledge_base_text}"
-             prompt_parts[-1] += kb_part # Добавляем к последнему (инструкции) элементу
-        prompt_parts[-1] += "\n<end_of_turn>" # Завершаем первый пользовательский ход
-    else:
-        # Если инструкций нет, базу знаний добавляем как первый пользовательский ввод
-        if knowledge_base_text:
-            kb_part = f"<start_of_turn>user\n[БАЗА ЗНАНИЙ РОЛИ]\n{knowledge_base_text}\n<end_of_turn>"
-            prompt_parts.append(kb_part)
-        # Если нет ни инструкций, ни базы знаний, ничего не добавляем в начало
+    # 1. Инструкции роли идут в самом начале как первый пользовательский ввод
+    if preamble:
+        prompt_parts.append(preamble)
     # 2. Добавляем историю контекста
     for msg in context_messages:
         role = msg['role']
@@ -139,16 +131,19 @@ def _format_gemma_prompt(context_messages, current_user_message_parts, instructi
     logger.debug(f"Сформированный промпт для Gemma:\n{full_prompt}")
     return full_prompt
 
-def generate_response_gemma(chat_id: int, prompt: str, image_bytes: bytes = None) -> str:
+def generate_response_gemma(chat_id: int, prompt: str, image_bytes: bytes | list[bytes] = None,
+                            history_prompt: str | None = None) -> str:
     """
     Генерация ответа с помощью модели Gemma через Gemini API.
     Args:
         chat_id: ID чата
         prompt: Текст запроса
-        image_bytes: Байты изображения (опционально)
+        image_bytes: Байты изображения или список байтов (альбом) (опционально)
+        history_prompt: Что сохранить в историю вместо prompt (опционально)
     Returns:
         str: Ответ от модели
     """
+    images = image_list(image_bytes)
     try:
         model_id = get_chat_model(chat_id)
         client = genai.Client()
@@ -167,10 +162,16 @@ def generate_response_gemma(chat_id: int, prompt: str, image_bytes: bytes = None
 
         # 3. Оценить размер токенов в новом сообщении
         estimated_prompt_tokens = estimate_content_tokens([types.Part(text=prompt)])
-        estimated_image_tokens = estimate_content_tokens([types.Part(inline_data=types.Blob(mime_type='image/jpeg', data=image_bytes))]) if image_bytes else 0
+        # Долговременная память: прошлые разговоры, относящиеся к вопросу, — отдельным ходом после роли;
+        # её объём учитывается при обрезке контекста вместе с запросом
+        memory_block = get_long_term_memory().recall_block(chat_id, prompt)
+        if memory_block:
+            estimated_prompt_tokens += estimate_content_tokens([types.Part(text=memory_block)])
+        estimated_image_tokens = estimate_content_tokens([types.Part(inline_data=types.Blob(mime_type='image/jpeg', data=image)) for image in images]) if images else 0
         logger.debug(f"Оценка токенов: Prompt={estimated_prompt_tokens}, Image={estimated_image_tokens}")
 
         # 4. Получить текущий контекст
+        context_started = time.monotonic()
         context_messages = get_context(chat_id)
         logger.debug(f"Получено {len(context_messages)} сообщений из контекста.")
 
@@ -190,6 +191,8 @@ def generate_response_gemma(chat_id: int, prompt: str, image_bytes: bytes = None
             # Это означает, что новое сообщение слишком велико или ошибка после обрезки
             logger.error(f"Ошибка длины контекста: {ve}")
             return f"❌ {str(ve)}" # Возвращаем сообщение пользователю
+        CONTEXT_PREPARE.observe(time.monotonic() - context_started, family="gemma")
+        record_span("context", context_started, family="gemma")
         # --- Конец добавленного кода ---
 
         # --- Подготовка данных для промпта ---
@@ -197,45 +200,45 @@ def generate_response_gemma(chat_id: int, prompt: str, image_bytes: bytes = None
         # context_messages = get_context(chat_id) # Уже получили выше
         # 2. Подготавливаем текущий ввод
         current_parts = [types.Part(text=prompt)]
-        if image_bytes:
+        for image in images:
             # Используем Blob для передачи изображения
             image_part = types.Part(
                 inline_data=types.Blob(
                     mime_type='image/jpeg', # Уточните MIME-тип, если он другой
-                    data=image_bytes
+                    data=image
                 )
             )
             current_parts.append(image_part)
-        # 3. Получаем настройки роли
-        instructions_text = None
-        knowledge_base_text = None
-        if CURRENT_ROLE_SETTINGS.get('name'):
-            logger.info(f"Используется роль: {CURRENT_ROLE_SETTINGS['name']} для модели Gemma")
-            instructions_text = CURRENT_ROLE_SETTINGS.get('instructions')
-            knowledge_base_text = CURRENT_ROLE_SETTINGS.get('knowledge_base')
+        # 3. Получаем настройки роли (снимок на весь запрос)
+        role = get_role_manager().for_chat(chat_id)
+        preamble = ""
+        if role.active:
+            logger.info(f"Используется роль: {role.name} для модели Gemma")
+            # Преамбула собрана заранее; большая база знаний — только фрагменты под вопрос
+            preamble = role.gemma_preamble(prompt)
             # Инициализация (добавление KB к первому запросу)
             if not is_role_context_initialized(chat_id):
-                 logger.info(f"Инициализируем контекст для роли '{CURRENT_ROLE_SETTINGS['name']}' в чате {chat_id} (Gemma)")
+                 logger.info(f"Инициализируем контекст для роли '{role.name}' в чате {chat_id} (Gemma)")
                  # Помечаем инициализацию
                  set_role_initialized(chat_id)
-                 # База знаний будет добавлена в промпт ниже
         else:
             logger.info("Используется стандартный режим для модели Gemma.")
+        if memory_block:
+            preamble += f"<start_of_turn>user\n{memory_block}\n<end_of_turn>"
         # --- Формирование промпта и contents ---
         # Для Gemma мы формируем специальный текстовый промпт
         # и передаем его как одну текстовую часть в Contents
         gemma_prompt = _format_gemma_prompt(
             context_messages, 
             current_parts, # Передаем все части, чтобы _format мог обработать текст
-            instructions_text, 
-            knowledge_base_text
+            preamble
         )
         # Contents для Gemma будет содержать:
         # 1. Сформированный текстовый промпт
         # 2. Опционально, изображение (если оно было)
         gemma_contents = [types.Part(text=gemma_prompt)]
-        # Добавляем изображение, если оно было (оно не попадет в текстовый промпт)
-        if image_bytes:
+        # Добавляем изображения, если они были (они не попадут в текстовый промпт)
+        if images:
             # Убираем текстовую часть с промптом, если есть изображение,
             # и передаем промпт и изображение отдельно
             # См. примеры в https://ai.google.dev/gemma/docs/core/gemma_on_gemini_api
@@ -245,15 +248,15 @@ def generate_response_gemma(chat_id: int, prompt: str, image_bytes: bytes = None
             # Но API ожидает список parts. 
             # Давайте пересоздадим contents.
             gemma_contents = [types.Part(text=gemma_prompt)]
-            if image_bytes:
-                 # Добавляем изображение как отдельную часть
+            for image in images:
+                 # Добавляем каждое изображение альбома как отдельную часть
                  image_part = types.Part(
                     inline_data=types.Blob(
                         mime_type='image/jpeg',
-                        data=image_bytes
+                        data=image
                     )
                  )
-                 gemma_contents.append(image_part) # Промпт + изображение
+                 gemma_contents.append(image_part) # Промпт + изображения
         # --- Подготовка конфигурации ---
         # ВАЖНО: Модели Gemma НЕ поддерживают system_instruction и tools!
         # См. https://ai.google.dev/gemma/docs/core/prompt-structure#unsupported_features
@@ -265,30 +268,23 @@ def generate_response_gemma(chat_id: int, prompt: str, image_bytes: bytes = None
         }
         # --- Генерация ответа ---
         logger.info(f"Отправляем запрос к модели Gemma '{model_id}'...")
-        response = client.models.generate_content(
+        # Ответ потоком: при отмене запроса (/clear, новое сообщение) поток закрывается
+        request_started = time.monotonic()
+        stream = client.models.generate_content_stream(
             model=model_id,
             contents=gemma_contents, # Передаем сформированные contents
             config=types.GenerateContentConfig(**config_kwargs)
         )
         # --- Обработка ответа ---
-        try:
-            if hasattr(response, 'text') and response.text is not None:
-                gemma_raw_answer = response.text.strip()
-            elif (
-                hasattr(response, 'candidates') and response.candidates and
-                hasattr(response.candidates[0], 'content') and
-                response.candidates[0].content and
-                hasattr(response.candidates[0].content, 'parts') and
-                response.candidates[0].content.parts and
-                response.candidates[0].content.parts[0].text is not None
-            ):
-                gemma_raw_answer = response.candidates[0].content.parts[0].text.strip()
-            else:
-                gemma_raw_answer = "Извините, не удалось сформулировать ответ (пустой ответ от модели Gemma)."
-                logger.warning("Gemma вернула пустой или некорректный ответ.")
-        except Exception as e:
-            gemma_raw_answer = "Произошла ошибка при обработке ответа модели Gemma."
-            logger.exception(f"Ошибка при извлечении текста из ответа Gemma: {e}")
+        texts = (
+            chunk.text for chunk in cancellable_stream(stream, close=getattr(client, "close", None))
+            if getattr(chunk, 'text', None)
+        )
+        pieces = list(timed_stream(texts, "gemma", model_id, request_started))
+        gemma_raw_answer = "".join(pieces).strip()
+        if not gemma_raw_answer:
+            gemma_raw_answer = "Извините, не удалось сформулировать ответ (пустой ответ от модели Gemma)."
+            logger.warning("Gemma вернула пустой или некорректный ответ.")
         # === ДОБАВИТЬ ЭТИ СТРОКИ ===
         # Очищаем ответ перед отправкой пользователю
         import re
@@ -304,11 +300,12 @@ def generate_response_gemma(chat_id: int, prompt: str, image_bytes: bytes = None
         logger.info(f"Ответ от модели Gemma получен. Длина (сырого): {len(gemma_raw_answer)} символов.")
         # --- Сохранение в контекст ---
         # Сохраняем оригинальный запрос пользователя (без тегов)
-        add_to_context(chat_id, 'user', prompt)
+        add_to_context(chat_id, 'user', prompt if history_prompt is None else history_prompt)
         # Сохраняем СЫРОЙ ответ модели (с тегами) в контекст, так как _format_gemma_prompt ожидает их
         add_to_context(chat_id, 'assistant', gemma_raw_answer) # <-- Сохраняем с тегами
         # Возвращаем ОЧИЩЕННЫЙ ответ пользователю
         return gemma_clean_answer # <-- Возвращаем без тегов
     except Exception as e:
+        count_error("provider_gemma", e)
         logger.error(f"Ошибка генерации ответа моделью Gemma: {e}", exc_info=True)
         return f"❌ Ошибка генерации (Gemma): {str(e)}"
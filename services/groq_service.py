@@ -4,9 +4,14 @@ import logging
 import base64
 import os
 import re # Добавлен импорт re
+import time
 from typing import List, Dict, Any, Optional
 from groq import Groq # Импорт клиента Groq
-from config import CURRENT_ROLE_SETTINGS
+from services.role_manager import get_role_manager
+from services.long_term_memory import get_long_term_memory
+from services.cancellation import cancellable_stream, raise_if_cancelled
+from services.metrics import CONTEXT_PREPARE, count_error, timed_stream
+from services.tracing import record_span
 from services.context_service import (
     get_context, add_to_context, get_chat_model,
     is_role_context_initialized, set_role_initialized,
@@ -98,7 +103,8 @@ def process_groq_response(groq_raw_answer: str) -> str:
     return processed_answer
 # --- Конец новой функции ---
 
-def generate_response_groq(chat_id: int, prompt: str, image_bytes: Optional[bytes] = None) -> str:
+def generate_response_groq(chat_id: int, prompt: str, image_bytes: Optional[bytes] = None,
+                           history_prompt: Optional[str] = None) -> str:
     """
     Генерация ответа с помощью модели через Groq API.
     
@@ -106,6 +112,7 @@ def generate_response_groq(chat_id: int, prompt: str, image_bytes: Optional[byte
         chat_id: ID чата
         prompt: Текст запроса
         image_bytes: Байты изображения (опционально)
+        history_prompt: Что сохранить в историю вместо prompt (опционально)
         
     Returns:
         str: Ответ от модели
@@ -138,6 +145,7 @@ def generate_response_groq(chat_id: int, prompt: str, image_bytes: Optional[byte
         user_message_content = prompt # Groq ожидает строку для текста
         
         # --- Подготовка контекста ---
+        context_started = time.monotonic()
         context_messages = get_context(chat_id)
         logger.debug(f"Получено {len(context_messages)} сообщений из контекста.")
 
@@ -150,10 +158,14 @@ def generate_response_groq(chat_id: int, prompt: str, image_bytes: Optional[byte
             groq_role = 'user' if role == 'user' else 'assistant'
             groq_messages.append({"role": groq_role, "content": content})
 
+        # --- Долговременная память: прошлые разговоры, относящиеся к вопросу ---
+        # Блок уйдёт в системное сообщение — его объём учитывается при обрезке контекста
+        memory_block = get_long_term_memory().recall_block(chat_id, prompt)
+
         # --- Обрезка контекста ---
         estimated_prompt_tokens = estimate_tokens(prompt)
         # estimated_image_tokens = 256 if image_bytes else 0 # Игнорируем изображения
-        total_new_tokens = estimated_prompt_tokens # + estimated_image_tokens
+        total_new_tokens = estimated_prompt_tokens + estimate_tokens(memory_block or "") # + estimated_image_tokens
 
         try:
             truncated_messages = truncate_context_groq(
@@ -166,33 +178,35 @@ def generate_response_groq(chat_id: int, prompt: str, image_bytes: Optional[byte
         except ValueError as ve:
             logger.error(f"Ошибка длины контекста: {ve}")
             return f"❌ {str(ve)}"
+        CONTEXT_PREPARE.observe(time.monotonic() - context_started, family="groq")
+        record_span("context", context_started, family="groq")
 
         # --- Настройка роли ---
+        # Снимок роли берётся один раз: перезагрузка person.set не меняет роль посреди запроса
+        role = get_role_manager().for_chat(chat_id)
         system_message = None
-        if CURRENT_ROLE_SETTINGS.get('name'):
-            logger.info(f"Используется роль: {CURRENT_ROLE_SETTINGS['name']}")
-            
-            role_parts = []
-            instructions = CURRENT_ROLE_SETTINGS.get('instructions')
-            knowledge_base = CURRENT_ROLE_SETTINGS.get('knowledge_base')
-            
-            if instructions:
-                role_parts.append(f"[ИНСТРУКЦИИ РОЛИ]\n{instructions}")
-            if knowledge_base:
-                role_parts.append(f"[БАЗА ЗНАНИЙ РОЛИ]\n{knowledge_base}")
-            
-            if role_parts:
-                system_content = "\n\n".join(role_parts)
+        if role.active:
+            logger.info(f"Используется роль: {role.name}")
+            # Промпт собран заранее; большая база знаний — только фрагменты под вопрос (KB_TOKEN_BUDGET)
+            system_content = role.system_message(prompt)
+            if system_content:
                 system_message = {"role": "system", "content": system_content}
                 logger.debug("Системное сообщение с ролью подготовлено.")
             
             # Инициализация (добавление KB к первому запросу в чате)
             if not is_role_context_initialized(chat_id):
-                logger.info(f"Инициализируем контекст для роли '{CURRENT_ROLE_SETTINGS['name']}' в чате {chat_id}")
+                logger.info(f"Инициализируем контекст для роли '{role.name}' в чате {chat_id}")
                 set_role_initialized(chat_id)
         else:
             logger.info("Используется стандартный режим.")
 
+        # --- Долговременная память (блок получен до обрезки контекста) ---
+        if memory_block:
+            if system_message:
+                system_message["content"] += f"\n\n{memory_block}"
+            else:
+                system_message = {"role": "system", "content": memory_block}
+
         # --- Формирование финального списка сообщений ---
         final_messages = []
         if system_message:
@@ -206,26 +220,28 @@ def generate_response_groq(chat_id: int, prompt: str, image_bytes: Optional[byte
         logger.info(f"Отправляем запрос к модели Groq '{model_id}'...")
         # logger.debug(f"Запрос к Groq: messages={final_messages}") # Для отладки
 
+        raise_if_cancelled()  # запрос отменили, пока готовили контекст — не тратим квоту
+        request_started = time.monotonic()
         # Groq.ChatCompletion.create -> client.chat.completions.create (v1.0+)
-        chat_completion = client.chat.completions.create(
+        # Ответ потоком: при отмене запроса (/clear, новое сообщение) поток закрывается
+        stream = client.chat.completions.create(
             messages=final_messages,
             model=model_id,
+            stream=True,
             # Можно добавить другие параметры, например:
             # temperature=0.7,
             # max_tokens=1000,
         )
 
         # --- Обработка ответа ---
-        if chat_completion.choices and len(chat_completion.choices) > 0:
-            choice = chat_completion.choices[0]
-            if choice.message and choice.message.content:
-                groq_raw_answer = choice.message.content.strip() # <-- Получаем "сырой" ответ
-            else:
-                groq_raw_answer = "Извините, не удалось сформулировать ответ (пустой ответ от модели Groq)."
-                logger.warning("Groq вернул пустой или некорректный ответ.")
-        else:
-            groq_raw_answer = "Извините, не удалось сформулировать ответ (некорректная структура ответа от Groq)."
-            logger.warning("Некорректная структура ответа от Groq.")
+        pieces = []
+        for chunk in timed_stream(cancellable_stream(stream, close=stream.close), "groq", model_id, request_started):
+            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                pieces.append(chunk.choices[0].delta.content)
+        groq_raw_answer = "".join(pieces).strip() # <-- Получаем "сырой" ответ
+        if not groq_raw_answer:
+            groq_raw_answer = "Извините, не удалось сформулировать ответ (пустой ответ от модели Groq)."
+            logger.warning("Groq вернул пустой или некорректный ответ.")
 
         # === Обработка ответа с помощью новой функции ===
         groq_answer = process_groq_response(groq_raw_answer) # <-- Обрабатываем ответ
@@ -235,7 +251,7 @@ def generate_response_groq(chat_id: int, prompt: str, image_bytes: Optional[byte
         # ВАЖНО: Сохраняем в историю "сырой" ответ, так как он может содержать теги,
         # которые нужны для формирования будущих промптов (например, для Gemma)
         # или для отладки.
-        add_to_context(chat_id, 'user', prompt) # Сохраняем оригинальный текст запроса
+        add_to_context(chat_id, 'user', prompt if history_prompt is None else history_prompt) # Сохраняем оригинальный текст запроса
         add_to_context(chat_id, 'assistant', groq_raw_answer) # <-- Сохраняем СЫРОЙ ответ
 
         logger.info(f"Ответ от модели Groq получен и обработан. Длина (сырого): {len(groq_raw_answer)} символов.")
@@ -243,6 +259,7 @@ def generate_response_groq(chat_id: int, prompt: str, image_bytes: Optional[byte
         return groq_answer # <-- Возвращаем обработанный ответ
 
     except Exception as e:
+        count_error("provider_groq", e)
         error_msg = f"❌ Ошибка генерации (Groq): {str(e)}"
         logger.error(error_msg, exc_info=True)
         return error_msg
@@ -0,0 +1,285 @@
+# services/knowledge_index.py
+"""Поисковый индекс по базе знаний роли: фрагменты + BM25 на numpy, файлы индекса на диске (memory-mapped)."""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter
+from typing import Optional
+import numpy as np
+from config import KB_INDEX_DIR, KB_CHUNK_CHARS, KB_TOP_K, KB_TOKEN_BUDGET
+
+logger = logging.getLogger(__name__)
+
+# Параметры BM25
+_K1 = 1.5
+_B = 0.75
+# Версия формата: при изменении разбиения/токенизации индексы перестраиваются
+_INDEX_VERSION = 1
+# Грубый стемминг для русского/английского: слово обрезается до префикса
+_STEM_CHARS = 6
+_CHARS_PER_TOKEN = 4  # та же оценка, что и в сервисах моделей (len(text) // 4)
+
+_WORD_RE = re.compile(r"\w+")
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+|\n")
+
+_ARRAYS = ("postings_ptr", "postings_doc", "postings_tf", "doc_len", "idf", "offsets")
+
+
+def tokenize(text: str) -> list[str]:
+    return [w[:_STEM_CHARS] for w in _WORD_RE.findall(text.lower().replace("ё", "е")) if len(w) > 1 or w.isdigit()]
+
+
+def split_chunks(text: str, chunk_chars: int = KB_CHUNK_CHARS) -> list[str]:
+    """Фрагменты по границам абзацев (длинные абзацы — по предложениям), не длиннее chunk_chars."""
+    pieces: list[str] = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= chunk_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in _SENTENCE_RE.split(paragraph):
+            sentence = sentence.strip()
+            while len(sentence) > chunk_chars:
+                cut = sentence.rfind(" ", 0, chunk_chars)
+                cut = cut if cut > 0 else chunk_chars
+                pieces.append(sentence[:cut].strip())
+                sentence = sentence[cut:].strip()
+            if sentence:
+                pieces.append(sentence)
+
+    chunks: list[str] = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + 2 + len(piece) > chunk_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class KnowledgeIndex:
+    """
+    Индекс одной базы знаний.
+
+    На диске (KB_INDEX_DIR/<hash пути>/): текст фрагментов подряд в chunks.txt и их смещения,
+    инвертированный индекс BM25 (postings по терминам), длины фрагментов и idf — в .npy,
+    словарь терминов — в vocab.json, mtime/размер исходного файла — в meta.json.
+    Массивы открываются через np.load(mmap_mode='r'): в памяти процесса остаётся только словарь.
+    """
+
+    def __init__(self, source_path: str, index_dir: str = KB_INDEX_DIR):
+        self.source_path = source_path
+        key = hashlib.sha1(os.path.abspath(source_path).encode("utf-8")).hexdigest()[:16]
+        self.dir = os.path.join(index_dir, key)
+        self.source_stamp: Optional[tuple[int, int]] = None
+        self.total_chars = 0
+        self._vocab: dict[str, int] = {}
+        self._arrays: dict[str, np.ndarray] = {}
+        self._avg_len = 1.0
+
+    # --- Построение и загрузка ---
+    @staticmethod
+    def _stamp(path: str) -> tuple[int, int]:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def load_or_build(self):
+        """Открывает индекс с диска; перестраивает, если исходный файл изменился (mtime/размер)."""
+        stamp = self._stamp(self.source_path)
+        meta = self._read_meta()
+        if not meta or meta.get("version") != _INDEX_VERSION or tuple(meta.get("source_stamp", ())) != stamp:
+            self._build(stamp)
+            meta = self._read_meta()
+        self._open(meta)
+        self.source_stamp = stamp
+
+    def _read_meta(self) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.dir, "meta.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _build(self, stamp: tuple[int, int]):
+        with open(self.source_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        chunks = split_chunks(text)
+        vocab: dict[str, int] = {}
+        term_ids: list[int] = []
+        doc_ids: list[int] = []
+        tfs: list[int] = []
+        doc_len = np.zeros(len(chunks), dtype=np.float32)
+        for doc, chunk in enumerate(chunks):
+            counts = Counter(tokenize(chunk))
+            doc_len[doc] = sum(counts.values())
+            for term, tf in counts.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(doc)
+                tfs.append(tf)
+
+        # Инвертированный индекс: postings отсортированы по термину, postings_ptr[t]..[t+1] — его фрагменты
+        term_arr = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_arr, kind="stable")
+        df = np.bincount(term_arr, minlength=len(vocab))
+        postings_ptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df, out=postings_ptr[1:])
+        n_docs = max(1, len(chunks))
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+        encoded = [chunk.encode("utf-8") for chunk in chunks]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+
+        arrays = {
+            "postings_ptr": postings_ptr,
+            "postings_doc": np.asarray(doc_ids, dtype=np.int32)[order],
+            "postings_tf": np.asarray(tfs, dtype=np.float32)[order],
+            "doc_len": doc_len,
+            "idf": idf,
+            "offsets": offsets,
+        }
+        os.makedirs(self.dir, exist_ok=True)
+        # meta.json пишется последним: без него индекс считается недостроенным
+        self._write_atomic("chunks.txt", b"".join(encoded))
+        for name, array in arrays.items():
+            tmp = os.path.join(self.dir, f"{name}.tmp.npy")
+            np.save(tmp, array)
+            os.replace(tmp, os.path.join(self.dir, f"{name}.npy"))
+        self._write_atomic("vocab.json", json.dumps(vocab, ensure_ascii=False).encode("utf-8"))
+        meta = {
+            "version": _INDEX_VERSION,
+            "source_stamp": list(stamp),
+            "chunks": len(chunks),
+            "total_chars": len(text),
+        }
+        self._write_atomic("meta.json", json.dumps(meta).encode("utf-8"))
+        logger.info(f"Индекс базы знаний {self.source_path}: {len(chunks)} фрагментов, {len(vocab)} терминов")
+
+    def _write_atomic(self, name: str, data: bytes):
+        tmp = os.path.join(self.dir, f"{name}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.dir, name))
+
+    def _open(self, meta: dict):
+        with open(os.path.join(self.dir, "vocab.json"), "r", encoding="utf-8") as f:
+            self._vocab = json.load(f)
+        self._arrays = {name: np.load(os.path.join(self.dir, f"{name}.npy"), mmap_mode="r") for name in _ARRAYS}
+        doc_len = self._arrays["doc_len"]
+        self._avg_len = float(doc_len.mean()) if len(doc_len) else 1.0
+        self.total_chars = int(meta.get("total_chars", 0))
+
+    # --- Поиск ---
+    @property
+    def chunk_count(self) -> int:
+        return max(0, len(self._arrays.get("offsets", ())) - 1)
+
+    def read_chunk(self, index: int) -> str:
+        offsets = self._arrays["offsets"]
+        start, end = int(offsets[index]), int(offsets[index + 1])
+        with open(os.path.join(self.dir, "chunks.txt"), "rb") as f:
+            f.seek(start)
+            return f.read(end - start).decode("utf-8")
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25-оценки всех фрагментов для запроса."""
+        a = self._arrays
+        scores = np.zeros(self.chunk_count, dtype=np.float32)
+        if not scores.size:
+            return scores
+        for term in set(tokenize(query)):
+            term_id = self._vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = a["postings_ptr"][term_id], a["postings_ptr"][term_id + 1]
+            docs = a["postings_doc"][start:end]
+            tf = a["postings_tf"][start:end]
+            norm = _K1 * (1 - _B + _B * a["doc_len"][docs] / self._avg_len)
+            scores[docs] += a["idf"][term_id] * tf * (_K1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, top_k: int = KB_TOP_K, budget_tokens: int = KB_TOKEN_BUDGET) -> list[str]:
+        """Наиболее релевантные фрагменты в пределах бюджета, в порядке следования в базе знаний."""
+        scores = self.scores(query)
+        budget = budget_tokens * _CHARS_PER_TOKEN
+        picked: dict[int, str] = {}
+        used = 0
+        for index in np.argsort(-scores, kind="stable"):
+            if scores[index] <= 0 or len(picked) >= top_k:
+                break
+            chunk = self.read_chunk(int(index))
+            if used + len(chunk) > budget:
+                continue  # не влезает — пробуем следующий по релевантности (он может быть короче)
+            picked[int(index)] = chunk
+            used += len(chunk)
+        return [picked[i] for i in sorted(picked)]
+
+
+# Индексы по пути файла; перестраиваются при изменении mtime/размера
+_indexes: dict[str, KnowledgeIndex] = {}
+_indexes_lock = threading.Lock()
+
+def get_knowledge_index(path: str) -> Optional[KnowledgeIndex]:
+    """Открытый индекс базы знаний (строится при первом обращении и после изменения файла)."""
+    try:
+        stamp = KnowledgeIndex._stamp(path)
+    except OSError:
+        return None
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None or index.source_stamp != stamp:
+            index = KnowledgeIndex(path)
+            try:
+                index.load_or_build()
+            except Exception as e:
+                logger.error(f"Не удалось построить индекс базы знаний {path}: {e}", exc_info=True)
+                return None
+            _indexes[path] = index
+        return index
+
+
+def release_knowledge_index(path: str):
+    """Закрывает индекс (освобождает memory-mapped массивы); при следующем обращении он откроется снова."""
+    with _indexes_lock:
+        _indexes.pop(path, None)
+
+
+def retrieve_knowledge(path: str, query: str, budget_tokens: int = KB_TOKEN_BUDGET) -> Optional[str]:
+    """Фрагменты базы знаний из файла path, найденные по вопросу. None — ничего не найдено."""
+    index = get_knowledge_index(path)
+    if index is None:
+        # Индекс недоступен — берём начало базы по бюджету, а не отправляем её целиком
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read(budget_tokens * _CHARS_PER_TOKEN).strip() or None
+        except OSError:
+            return None
+    chunks = index.search(query, budget_tokens=budget_tokens)
+    if not chunks:
+        return None
+    logger.debug(f"База знаний: {len(chunks)} фрагментов из {index.chunk_count} для запроса")
+    return "\n\n---\n\n".join(chunks)
+
+
+def knowledge_for_prompt(role_settings: dict, query: str, budget_tokens: int = KB_TOKEN_BUDGET) -> Optional[str]:
+    """
+    Текст базы знаний для запроса: целиком, если база укладывается в бюджет, иначе —
+    найденные по вопросу фрагменты. None — в базе нет ничего, относящегося к вопросу.
+    """
+    knowledge_base = role_settings.get("knowledge_base")
+    if not knowledge_base:
+        return None
+    if len(knowledge_base) // _CHARS_PER_TOKEN <= budget_tokens:
+        return knowledge_base
+    path = role_settings.get("knowledge_base_path")
+    if not path:
+        return knowledge_base[:budget_tokens * _CHARS_PER_TOKEN]
+    return retrieve_knowledge(path, query, budget_tokens)
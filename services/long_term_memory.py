@@ -0,0 +1,267 @@
+# services/long_term_memory.py
+"""Долговременная память чата: вытесненные из контекста ходы в локальном векторном индексе (numpy, memory-mapped)."""
+import asyncio
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict
+from typing import Iterable, Optional
+import numpy as np
+from config import (
+    MEMORY_ENABLED, MEMORY_DIR, MEMORY_DIM, MEMORY_TOP_K, MEMORY_TOKEN_BUDGET,
+    MEMORY_MIN_SCORE, MEMORY_SNIPPET_CHARS,
+)
+from services.knowledge_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+_CHARS_PER_TOKEN = 4  # та же оценка, что и в сервисах моделей (len(text) // 4)
+# Запись индекса: смещение текста, длина текста, время (unix) — int64
+_RECORD = np.dtype([("offset", "<i8"), ("length", "<i8"), ("time", "<i8")])
+_VECTOR_DTYPE = np.dtype("<f2")
+
+# Частые слова почти не несут смысла, но в хешированном векторе перевешивают редкие
+_STOPWORDS = frozenset((
+    "что", "как", "это", "так", "для", "или", "но", "не", "на", "по", "из", "от", "до", "за", "то",
+    "ты", "мне", "меня", "мы", "вы", "он", "она", "они", "его", "ее", "был", "была", "было", "есть",
+    "все", "уже", "еще", "там", "тут", "вот", "ну", "да", "нет", "бы", "же", "ли", "при", "если",
+    "the", "and", "you", "are", "is", "of", "to", "in", "it", "for", "on", "that", "this", "with",
+))
+_TURN_TAGS_RE = re.compile(r"<(?:start|end)_of_turn>(?:user|model)?")
+_SPEAKERS = {"user": "Пользователь", "assistant": "Ассистент", "model": "Ассистент"}
+
+
+def embed(text: str, dim: int = MEMORY_DIM) -> np.ndarray:
+    """
+    Вектор текста без внешних моделей: слова (со стеммингом) и пары соседних слов хешируются
+    в dim корзин со знаком (crc32 — стабилен между запусками), вес 1 + log(tf), L2-нормировка.
+    """
+    words = [w for w in tokenize(text) if w not in _STOPWORDS]
+    features = Counter(words)
+    features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, tf in features.items():
+        h = zlib.crc32(feature.encode("utf-8"))
+        vector[h % dim] += (1.0 if h & 0x80000000 else -1.0) * (1.0 + np.log(tf))
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+def turns_to_snippets(messages: Iterable[dict], max_chars: int = MEMORY_SNIPPET_CHARS) -> list[tuple[str, float]]:
+    """Сообщения контекста -> фрагменты «вопрос + ответ» (text, время) для индекса."""
+    snippets: list[tuple[str, float]] = []
+    current: list[str] = []
+    started: Optional[float] = None
+
+    def flush():
+        nonlocal current, started
+        if current:
+            text = "\n".join(current)
+            if len(text) > max_chars:
+                text = text[:max_chars].rstrip() + "…"
+            snippets.append((text, started or time.time()))
+        current, started = [], None
+
+    for message in messages:
+        role = message.get("role", "user")
+        content = _TURN_TAGS_RE.sub("", str(message.get("content", ""))).strip()
+        if not content:
+            continue
+        # Новый вопрос пользователя начинает новый фрагмент
+        if role == "user" and current:
+            flush()
+        if started is None:
+            timestamp = message.get("timestamp")
+            started = timestamp.timestamp() if hasattr(timestamp, "timestamp") else None
+        current.append(f"{_SPEAKERS.get(role, role)}: {content}")
+    flush()
+    return snippets
+
+
+class ChatMemory:
+    """
+    Память одного чата в MEMORY_DIR/<chat_id>/: тексты фрагментов подряд (texts.bin),
+    записи (смещение, длина, время) — index.bin, векторы float16 — vectors.bin.
+    Файлы только дописываются; при поиске vectors.bin открывается через np.memmap.
+    Число фрагментов — по самому короткому файлу, так что оборванная запись не видна.
+    """
+
+    def __init__(self, chat_id: int, base_dir: str = MEMORY_DIR, dim: int = MEMORY_DIM):
+        self.chat_id = chat_id
+        self.dim = dim
+        self.dir = os.path.join(base_dir, str(chat_id))
+        self._lock = threading.Lock()
+        # Увеличивается при очистке памяти (/clear): ходы, вытесненные до неё, не записываются
+        self.generation = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def _count(self) -> int:
+        try:
+            records = os.path.getsize(self._path("index.bin")) // _RECORD.itemsize
+            vectors = os.path.getsize(self._path("vectors.bin")) // (_VECTOR_DTYPE.itemsize * self.dim)
+        except OSError:
+            return 0
+        return min(records, vectors)
+
+    def __len__(self) -> int:
+        return self._count()
+
+    def add(self, snippets: list[tuple[str, float]], generation: Optional[int] = None) -> int:
+        """generation — поколение памяти на момент вытеснения ходов (по умолчанию текущее)."""
+        if not snippets:
+            return 0
+        generation = self.generation if generation is None else generation
+        encoded = [text.encode("utf-8") for text, _ in snippets]
+        vectors = np.stack([embed(text, self.dim) for text, _ in snippets]).astype(_VECTOR_DTYPE)
+        with self._lock:
+            if generation != self.generation:
+                return 0  # память чата очистили после вытеснения этих ходов
+            os.makedirs(self.dir, exist_ok=True)
+            count = self._count()
+            # Хвосты после оборванной записи отбрасываем, чтобы записи и векторы шли в ногу
+            self._truncate("index.bin", count * _RECORD.itemsize)
+            self._truncate("vectors.bin", count * _VECTOR_DTYPE.itemsize * self.dim)
+            with open(self._path("texts.bin"), "ab") as f:
+                offset = f.tell()
+                f.write(b"".join(encoded))
+            records = np.zeros(len(encoded), dtype=_RECORD)
+            records["length"] = [len(b) for b in encoded]
+            records["offset"] = offset + np.concatenate(([0], np.cumsum(records["length"])[:-1]))
+            records["time"] = [int(ts) for _, ts in snippets]
+            # Порядок важен: текст -> векторы -> записи (запись делает фрагмент видимым)
+            with open(self._path("vectors.bin"), "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self._path("index.bin"), "ab") as f:
+                f.write(records.tobytes())
+        return len(encoded)
+
+    def _truncate(self, name: str, size: int):
+        path = self._path(name)
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def search(self, query: str, top_k: int = MEMORY_TOP_K, budget_tokens: int = MEMORY_TOKEN_BUDGET,
+               min_score: float = MEMORY_MIN_SCORE) -> list[str]:
+        """Самые похожие на вопрос фрагменты в пределах бюджета, в хронологическом порядке."""
+        with self._lock:
+            count = self._count()
+            if not count:
+                return []
+            query_vector = embed(query, self.dim)
+            if not query_vector.any():
+                return []
+            vectors = np.memmap(self._path("vectors.bin"), dtype=_VECTOR_DTYPE, mode="r", shape=(count, self.dim))
+            scores = vectors @ query_vector  # float16 -> float32
+            del vectors
+            candidates = np.argsort(-scores, kind="stable")[:top_k * 4]
+            records = np.fromfile(self._path("index.bin"), dtype=_RECORD, count=count)
+            budget = budget_tokens * _CHARS_PER_TOKEN
+            picked: dict[int, str] = {}
+            used = 0
+            with open(self._path("texts.bin"), "rb") as f:
+                for index in candidates:
+                    if float(scores[index]) < min_score or len(picked) >= top_k:
+                        break
+                    record = records[index]
+                    f.seek(int(record["offset"]))
+                    text = f.read(int(record["length"])).decode("utf-8", errors="replace")
+                    if used + len(text) > budget:
+                        continue  # не влезает — пробуем следующий (он может быть короче)
+                    picked[int(index)] = text
+                    used += len(text)
+        return [picked[i] for i in sorted(picked)]
+
+    def clear(self):
+        """Удаляет файлы памяти под той же блокировкой, что и запись."""
+        with self._lock:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class LongTermMemory:
+    """
+    Долговременная память всех чатов. Ходы, вытесненные из контекста по context_ttl/max_history,
+    сохраняются фрагментами «вопрос + ответ»; к новому запросу подмешиваются несколько самых
+    похожих фрагментов в пределах MEMORY_TOKEN_BUDGET — вместо того чтобы держать всю историю в промпте.
+    """
+
+    def __init__(self, enabled: bool = MEMORY_ENABLED):
+        self.enabled = enabled
+        self._chats: dict[int, ChatMemory] = {}
+        self._chats_lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def chat(self, chat_id: int) -> ChatMemory:
+        with self._chats_lock:
+            memory = self._chats.get(chat_id)
+            if memory is None:
+                memory = self._chats[chat_id] = ChatMemory(chat_id)
+            return memory
+
+    def generation(self, chat_id: int) -> int:
+        return self.chat(chat_id).generation
+
+    def remember(self, chat_id: int, messages: list[dict], generation: Optional[int] = None) -> int:
+        """Сохраняет вытесненные из контекста сообщения (если память не очищали после generation)."""
+        if not self.enabled or not messages:
+            return 0
+        try:
+            added = self.chat(chat_id).add(turns_to_snippets(messages), generation)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Не удалось сохранить память чата {chat_id}: {e}", exc_info=True)
+            return 0
+        self.stats["stored"] += added
+        logger.debug(f"Чат {chat_id}: в долговременную память записано фрагментов — {added}")
+        return added
+
+    def recall(self, chat_id: int, query: str) -> list[str]:
+        """Фрагменты прошлых разговоров, относящиеся к вопросу."""
+        if not self.enabled or not query:
+            return []
+        try:
+            snippets = self.chat(chat_id).search(query)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Ошибка поиска в памяти чата {chat_id}: {e}", exc_info=True)
+            return []
+        self.stats["queries"] += 1
+        if snippets:
+            self.stats["hits"] += 1
+            self.stats["recalled"] += len(snippets)
+        return snippets
+
+    def recall_block(self, chat_id: int, query: str) -> Optional[str]:
+        """Блок для системного сообщения/преамбулы; None — вспомнить нечего."""
+        snippets = self.recall(chat_id, query)
+        if not snippets:
+            return None
+        return "[ИЗ ПРОШЛЫХ РАЗГОВОРОВ С ПОЛЬЗОВАТЕЛЕМ]\n" + "\n---\n".join(snippets)
+
+    async def forget(self, chat_id: int):
+        """
+        Удаляет память чата. Новое поколение — сразу: ходы, вытесненные раньше, уже не запишутся;
+        файлы удаляются в потоке под блокировкой записи, не в event loop.
+        """
+        memory = self.chat(chat_id)
+        memory.generation += 1
+        await asyncio.to_thread(memory.clear)
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "chats": len(self._chats)}
+
+
+# Синглтон памяти
+_memory_instance: Optional[LongTermMemory] = None
+
+def get_long_term_memory() -> LongTermMemory:
+    global _memory_instance
+    if _memory_instance is None:
+        _memory_instance = LongTermMemory()
+    return _memory_instance
@@ -0,0 +1,42 @@
+# services/media_group.py
+"""Сбор альбомов (media group): сообщения с одним media_group_id объединяются в одно."""
+import logging
+from typing import Optional
+from aiogram.types import Message
+from config import MEDIA_GROUP_WINDOW, MEDIA_GROUP_MAX_WAIT
+from services.burst_collector import BurstCollector
+
+logger = logging.getLogger(__name__)
+
+
+class MediaGroupCollector:
+    """
+    Telegram присылает альбом отдельными обновлениями с общим media_group_id.
+
+    Первое сообщение альбома становится «ведущим»: его обработчик ждёт, пока новые части
+    перестанут приходить (MEDIA_GROUP_WINDOW после последней, но не дольше MEDIA_GROUP_MAX_WAIT),
+    и получает весь альбом. Обработчики остальных частей получают None и ничего не делают.
+    """
+
+    def __init__(self, window: float = MEDIA_GROUP_WINDOW, max_wait: float = MEDIA_GROUP_MAX_WAIT):
+        self.window = window
+        # Ключ пачки — (chat_id, media_group_id)
+        self._bursts = BurstCollector(max_wait)
+
+    async def collect(self, message: Message) -> Optional[list[Message]]:
+        """Возвращает все сообщения альбома (по порядку) для ведущего сообщения, иначе None."""
+        messages = await self._bursts.collect((message.chat.id, message.media_group_id), message, self.window)
+        if messages is None:
+            return None
+        logger.info(f"Альбом {message.media_group_id} в чате {message.chat.id}: {len(messages)} сообщений")
+        return messages
+
+
+# Синглтон сборщика
+_collector_instance: Optional[MediaGroupCollector] = None
+
+def get_media_group_collector() -> MediaGroupCollector:
+    global _collector_instance
+    if _collector_instance is None:
+        _collector_instance = MediaGroupCollector()
+    return _collector_instance
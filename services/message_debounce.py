@@ -0,0 +1,104 @@
+# services/message_debounce.py
+"""Склейка быстрых последовательных текстовых сообщений чата в один запрос к модели."""
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+from aiogram.types import Message
+from config import (
+    TEXT_DEBOUNCE_MIN, TEXT_DEBOUNCE_MAX, TEXT_DEBOUNCE_MAX_WAIT, TEXT_DEBOUNCE_SPLIT_CHARS,
+    TEXT_DEBOUNCE_TRACKED_CHATS,
+)
+from services.burst_collector import BurstCollector
+
+logger = logging.getLogger(__name__)
+
+# Окно = средний интервал между сообщениями «очереди» × запас
+_CADENCE_FACTOR = 1.5
+# Коэффициент сглаживания скользящего среднего интервала
+_EWMA_ALPHA = 0.3
+
+
+class MessageDebouncer:
+    """
+    Клиенты Telegram режут длинную вставку на несколько сообщений, а пользователи часто пишут
+    несколько коротких строк подряд. Первое сообщение становится «ведущим»: его обработчик ждёт,
+    пока новые сообщения чата перестанут приходить, и получает их все. Обработчики остальных
+    получают None и ничего не делают — модель вызывается один раз.
+
+    Окно ожидания адаптивное: по каждому чату считается средний интервал между сообщениями,
+    пришедшими «очередью», и окно растягивается под медленный набор (в пределах MIN..MAX).
+    После сообщения длиной около лимита Telegram ждём максимум — скорее всего, будет продолжение.
+    Интервалы хранятся для TEXT_DEBOUNCE_TRACKED_CHATS последних активных чатов (LRU).
+
+    Пачка и темп набора — на автора в чате (chat_id, from_user.id): в группе сообщения
+    разных людей не склеиваются в один запрос.
+    """
+
+    def __init__(self, min_window: float = TEXT_DEBOUNCE_MIN, max_window: float = TEXT_DEBOUNCE_MAX,
+                 max_wait: float = TEXT_DEBOUNCE_MAX_WAIT, tracked_chats: int = TEXT_DEBOUNCE_TRACKED_CHATS):
+        self.min_window = min_window
+        self.max_window = max(min_window, max_window)
+        self.tracked_chats = tracked_chats
+        self._bursts = BurstCollector(max_wait)
+        # (chat_id, user_id) -> [момент последнего сообщения, средний интервал или None]
+        self._cadence: OrderedDict[tuple, list] = OrderedDict()
+        self.stats = {"messages": 0, "batches": 0, "merged": 0}
+
+    @staticmethod
+    def _key(message: Message) -> tuple:
+        """Автор в чате; у сообщений без from_user (посты каналов) — общий ключ чата."""
+        return message.chat.id, getattr(message.from_user, "id", None)
+
+    def _observe(self, key: tuple, now: float):
+        """Обновляет средний интервал набора автора в чате."""
+        cadence = self._cadence.get(key)
+        if cadence is None:
+            self._cadence[key] = [now, None]
+            while len(self._cadence) > self.tracked_chats:
+                self._cadence.popitem(last=False)
+            return
+        self._cadence.move_to_end(key)
+        gap = now - cadence[0]
+        cadence[0] = now
+        if gap > self.max_window * 2:
+            return  # это уже не «очередь» сообщений — в среднее не берём
+        avg = cadence[1]
+        cadence[1] = gap if avg is None else avg + _EWMA_ALPHA * (gap - avg)
+
+    def window_for(self, message: Message) -> float:
+        if len(message.text or "") >= TEXT_DEBOUNCE_SPLIT_CHARS:
+            return self.max_window
+        cadence = self._cadence.get(self._key(message))
+        if cadence is None or cadence[1] is None:
+            return self.min_window
+        return min(self.max_window, max(self.min_window, cadence[1] * _CADENCE_FACTOR))
+
+    async def collect(self, message: Message) -> Optional[list[Message]]:
+        """Возвращает все сообщения «очереди» (по порядку) для ведущего сообщения, иначе None."""
+        chat_id = message.chat.id
+        key = self._key(message)
+        self._observe(key, time.monotonic())
+        self.stats["messages"] += 1
+
+        messages = await self._bursts.collect(key, message, self.window_for(message))
+        if messages is None:
+            return None
+        self.stats["batches"] += 1
+        if len(messages) > 1:
+            self.stats["merged"] += len(messages) - 1
+            logger.info(f"Чат {chat_id}: {len(messages)} сообщений склеены в один запрос")
+        return messages
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "pending_chats": len(self._bursts), "tracked_chats": len(self._cadence)}
+
+
+# Синглтон склейки
+_debouncer_instance: Optional[MessageDebouncer] = None
+
+def get_message_debouncer() -> MessageDebouncer:
+    global _debouncer_instance
+    if _debouncer_instance is None:
+        _debouncer_instance = MessageDebouncer()
+    return _debouncer_instance
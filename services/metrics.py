@@ -0,0 +1,273 @@
+# services/metrics.py
+"""Метрики: гистограммы задержек по этапам и счётчики ошибок, экспорт в формате Prometheus."""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+from services.tracing import current_trace
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин (сек): от десятков миллисекунд (отправка в Telegram) до минут (длинные голосовые)
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _label_key(labelnames: tuple, labels: dict) -> tuple:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами (как histogram в Prometheus): на каждый набор меток —
+    счётчики по корзинам, сумма и количество. Потокобезопасна (наблюдения идут и из asyncio.to_thread).
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}  # метки -> [counts по корзинам (+Inf последней), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Оценка квантиля по корзинам (линейная интерполяция внутри корзины)."""
+        with self._lock:
+            series = self._series.get(_label_key(self.labelnames, labels))
+            if not series or not series[2]:
+                return None
+            counts = list(series[0])
+            total = series[2]
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def series(self) -> list[tuple[dict, int, float]]:
+        """Наборы меток с количеством и суммой наблюдений."""
+        with self._lock:
+            items = [(key, s[2], s[1]) for key, s in self._series.items()]
+        return [(dict(zip(self.labelnames, key)), count, total) for key, count, total in items]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(key, list(s[0]), s[1], s[2]) for key, s in self._series.items()]
+        for key, counts, total, count in sorted(snapshot):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Counter:
+    """Монотонный счётчик с метками."""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def series(self) -> list[tuple[dict, float]]:
+        with self._lock:
+            items = list(self._values.items())
+        return [(dict(zip(self.labelnames, key)), value) for key, value in items]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.series(), key=lambda item: tuple(item[0].values())):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels.values())} {value:g}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Все метрики бота. Кроме гистограмм и счётчиков экспортирует числовые показатели
+    get_stats() компонентов (очередь голосовых, исходящие запросы, отмены, пул аудио...) как gauge.
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+        self._collectors: dict[str, Callable[[], dict]] = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Histogram(name, help_text, labelnames, buckets)
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Counter(name, help_text, labelnames)
+            return metric
+
+    def register_collector(self, component: str, get_stats: Callable[[], dict]):
+        """get_stats вызывается при каждом экспорте; вложенные словари разворачиваются через '_'."""
+        self._collectors[component] = get_stats
+
+    def metrics(self) -> list:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def collect_gauges(self) -> list[tuple[str, float]]:
+        gauges = []
+        for component, get_stats in list(self._collectors.items()):
+            try:
+                stats = get_stats() or {}
+            except Exception as e:
+                logger.debug(f"Метрики: не удалось получить показатели '{component}': {e}")
+                continue
+            gauges.extend(_flatten(f"bot_{component}", stats))
+        return gauges
+
+    def render_prometheus(self) -> str:
+        lines = [
+            "# HELP bot_uptime_seconds Время работы процесса",
+            "# TYPE bot_uptime_seconds gauge",
+            f"bot_uptime_seconds {time.time() - self.started_at:.0f}",
+        ]
+        for metric in self.metrics():
+            lines.extend(metric.render())
+        for name, value in self.collect_gauges():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _flatten(prefix: str, stats: dict) -> list[tuple[str, float]]:
+    values = []
+    for key, value in stats.items():
+        name = f"{prefix}_{_metric_name(str(key))}"
+        if isinstance(value, bool):
+            values.append((name, float(value)))
+        elif isinstance(value, (int, float)):
+            values.append((name, float(value)))
+        elif isinstance(value, dict):
+            values.extend(_flatten(name, value))
+    return values
+
+
+def _metric_name(key: str) -> str:
+    return "".join(ch if ch.isalnum() or ch == "_" else "_" for ch in key).strip("_").lower() or "value"
+
+
+# Синглтон реестра метрик
+_metrics_instance: Optional[MetricsRegistry] = None
+_metrics_lock = threading.Lock()
+
+def get_metrics() -> MetricsRegistry:
+    global _metrics_instance
+    if _metrics_instance is None:
+        with _metrics_lock:
+            if _metrics_instance is None:
+                _metrics_instance = MetricsRegistry()
+    return _metrics_instance
+
+
+# --- Метрики этапов ---
+TELEGRAM_DOWNLOAD = get_metrics().histogram(
+    "bot_telegram_download_seconds", "Скачивание файла из Telegram", ("kind",))
+TRANSCRIPTION = get_metrics().histogram(
+    "bot_transcription_seconds", "Транскрибация голосового", ("mode",))
+QUEUE_WAIT = get_metrics().histogram(
+    "bot_queue_wait_seconds", "Ожидание в очереди этапа конвейера голосовых", ("stage",))
+STAGE_SERVICE = get_metrics().histogram(
+    "bot_stage_seconds", "Обработка задачи этапом конвейера голосовых", ("stage",))
+CONTEXT_PREPARE = get_metrics().histogram(
+    "bot_context_seconds", "Получение и обрезка контекста перед запросом к модели", ("family",))
+PROVIDER_LATENCY = get_metrics().histogram(
+    "bot_provider_seconds", "Полное время ответа модели", ("family", "model"))
+PROVIDER_TTFT = get_metrics().histogram(
+    "bot_provider_ttft_seconds", "Время до первого фрагмента ответа модели", ("family", "model"))
+TTS_SYNTHESIS = get_metrics().histogram(
+    "bot_tts_synthesis_seconds", "Синтез речи (PCM) моделью", ())
+TTS_ENCODE = get_metrics().histogram(
+    "bot_tts_encode_seconds", "Кодирование PCM в OGG/Opus", ())
+TELEGRAM_REQUEST = get_metrics().histogram(
+    "bot_telegram_request_seconds", "Запрос к Bot API (отправка, правка, удаление...)", ("method",))
+ERRORS = get_metrics().counter(
+    "bot_errors_total", "Ошибки по этапам и классам исключений", ("stage", "error"))
+
+
+def count_error(stage: str, error: BaseException):
+    ERRORS.inc(stage=stage, error=type(error).__name__)
+
+
+def timed_stream(stream: Iterable, family: str, model: str, started: Optional[float] = None) -> Iterator:
+    """
+    Пропускает поток ответа провайдера, замеряя время до первого фрагмента и полное время.
+    started — момент отправки запроса (time.monotonic()), если запрос ушёл до начала итерации.
+    Ошибки не считает: их учитывают сервисы моделей (count_error в своих обработчиках).
+    В текущую трассу пишется спан provider.<family> — и для оборванных ответов тоже.
+    """
+    started = time.monotonic() if started is None else started
+    # Трасса запоминается сразу: закрытие генератора может случиться в чужом контексте
+    trace = current_trace()
+    first_at = None
+    completed = False
+    try:
+        for item in stream:
+            if first_at is None:
+                first_at = time.monotonic()
+                PROVIDER_TTFT.observe(first_at - started, family=family, model=model)
+            yield item
+        completed = True
+        # Сюда доходят только завершённые ответы: отменённые и оборванные исказили бы распределение
+        PROVIDER_LATENCY.observe(time.monotonic() - started, family=family, model=model)
+    finally:
+        if trace is not None:
+            ttft = round(first_at - started, 3) if first_at is not None else None
+            trace.add_span(f"provider.{family}", started, attrs={"model": model, "ttft": ttft, "completed": completed})
@@ -2,18 +2,29 @@
 """Нейтральная точка входа для генерации ответов моделью."""
 import logging
 from mod_llm import get_model_family
+from services.tracing import span
 
 logger = logging.getLogger(__name__)
 
-def generate_model_response(chat_id: int, prompt: str, image_bytes: bytes = None, **kwargs) -> str:
+def image_list(image_bytes) -> list[bytes]:
+    """Приводит image_bytes (None, bytes или список bytes для альбома) к списку непустых изображений."""
+    if not image_bytes:
+        return []
+    if isinstance(image_bytes, (bytes, bytearray)):
+        return [bytes(image_bytes)]
+    return [bytes(img) for img in image_bytes if img]
+
+def generate_model_response(chat_id: int, prompt: str, image_bytes: bytes | list[bytes] = None, **kwargs) -> str:
     """
     Генерация ответа. Выбирает правильный сервис в зависимости от модели.
 
     Args:
         chat_id: ID чата
         prompt: Текст запроса
-        image_bytes: Байты изображения (опционально)
-        **kwargs: Для обратной совместимости (например, image_data)
+        image_bytes: Байты изображения или список байтов (альбом) — одним запросом (опционально)
+        **kwargs: files — документы в Gemini Files API (только семейство gemini);
+                  history_prompt — текст запроса для истории вместо prompt (например, без документа);
+                  image_data — для обратной совместимости
 
     Returns:
         str: Ответ от модели
@@ -29,23 +40,26 @@ def generate_model_response(chat_id: int, prompt: str, image_bytes: bytes = None
 
     logger.info(f"Выбрана модель '{model_id}' семейства '{model_family}' для генерации ответа.")
 
-    if model_family == "gemma":
-        from services.gemma_service import generate_response_gemma
-        logger.debug("Вызов generate_response_gemma...")
-        return generate_response_gemma(chat_id, prompt, image_bytes)
-    elif model_family == "gemini":
-        from services.gemini_service import generate_response_gemini
-        logger.debug("Вызов generate_response_gemini...")
-        return generate_response_gemini(chat_id, prompt, image_bytes)
-    elif model_family == "openrouter":
-        from services.openrouter_service import generate_response_openrouter
-        logger.debug("Вызов generate_response_openrouter...")
-        return generate_response_openrouter(chat_id, prompt, image_bytes)
-    elif model_family == "groq":
-        from services.groq_service import generate_response_groq
-        logger.debug("Вызов generate_response_groq...")
-        return generate_response_groq(chat_id, prompt, image_bytes)
-    else:
-        error_msg = f"❌ Неподдерживаемое семейство моделей: {model_family} (модель: {model_id})"
-        logger.error(error_msg)
-        return error_msg
+    history_prompt = kwargs.get("history_prompt")
+    with span("generate", family=model_family, model=model_id):
+        if model_family == "gemma":
+            from services.gemma_service import generate_response_gemma
+            logger.debug("Вызов generate_response_gemma...")
+            return generate_response_gemma(chat_id, prompt, image_bytes, history_prompt=history_prompt)
+        elif model_family == "gemini":
+            from services.gemini_service import generate_response_gemini
+            logger.debug("Вызов generate_response_gemini...")
+            return generate_response_gemini(chat_id, prompt, image_bytes, files=kwargs.get("files"),
+                                            history_prompt=history_prompt)
+        elif model_family == "openrouter":
+            from services.openrouter_service import generate_response_openrouter
+            logger.debug("Вызов generate_response_openrouter...")
+            return generate_response_openrouter(chat_id, prompt, image_bytes, history_prompt=history_prompt)
+        elif model_family == "groq":
+            from services.groq_service import generate_response_groq
+            logger.debug("Вызов generate_response_groq...")
+            return generate_response_groq(chat_id, prompt, image_bytes, history_prompt=history_prompt)
+        else:
+            error_msg = f"❌ Неподдерживаемое семейство моделей: {model_family} (модель: {model_id})"
+            logger.error(error_msg)
+            return error_msg
@@ -2,15 +2,22 @@
 """Сервис для генерации ответов моделями через OpenRouter API."""
 import logging
 import base64
+import json
 import requests
 import os # Добавлен импорт os
+import time
 from typing import List, Dict, Any, Optional
-from config import  CURRENT_ROLE_SETTINGS
 from services.context_service import (
     get_context, add_to_context, get_chat_model,
     is_role_context_initialized, set_role_initialized,
     get_model_limit_for_chat # Импортируем для проверки длины контекста
 )
+from services.model_service import image_list
+from services.role_manager import get_role_manager
+from services.long_term_memory import get_long_term_memory
+from services.cancellation import cancellable_stream, raise_if_cancelled
+from services.metrics import CONTEXT_PREPARE, count_error, timed_stream
+from services.tracing import record_span
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
@@ -57,14 +64,38 @@ def truncate_context_openrouter(messages: List[Dict[str, Any]], max_tokens: int,
 
 logger = logging.getLogger(__name__)
 
-def generate_response_openrouter(chat_id: int, prompt: str, image_bytes: Optional[bytes] = None) -> str:
+def _iter_sse_content(response: requests.Response):
+    """Фрагменты текста из потокового ответа OpenRouter (SSE: строки `data: {...}`, в конце `data: [DONE]`)."""
+    response.encoding = "utf-8"  # без charset requests декодировал бы text/event-stream как latin-1
+    for line in cancellable_stream(response.iter_lines(decode_unicode=True), close=response.close):
+        # Пустые строки разделяют события, строки с ':' — комментарии keep-alive
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        event = json.loads(data)
+        if "error" in event:
+            raise RuntimeError(event["error"].get("message", event["error"]))
+        for choice in event.get("choices", []):
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                yield content
+
+def _read_sse_answer(response: requests.Response, model_id: str = "", started: Optional[float] = None) -> str:
+    """Собирает текст ответа; время до первого фрагмента считается по тексту, а не по keep-alive строкам."""
+    return "".join(timed_stream(_iter_sse_content(response), "openrouter", model_id, started))
+
+def generate_response_openrouter(chat_id: int, prompt: str, image_bytes: Optional[bytes | List[bytes]] = None,
+                                 history_prompt: Optional[str] = None) -> str:
     """
     Генерация ответа с помощью модели через OpenRouter API.
     
     Args:
         chat_id: ID чата
         prompt: Текст запроса
-        image_bytes: Байты изображения (опционально)
+        image_bytes: Байты изображения или список байтов (альбом) (опционально)
+        history_prompt: Что сохранить в историю вместо prompt (опционально)
         
     Returns:
         str: Ответ от модели
@@ -87,11 +118,12 @@ def generate_response_openrouter(chat_id: int, prompt: str, image_bytes: Optiona
         # Добавляем текст
         user_message_content.append({"type": "text", "text": prompt})
         
-        # Добавляем изображение, если оно есть
-        if image_bytes:
+        # Добавляем изображения, если они есть (альбом — несколько image_url в одном сообщении)
+        images = image_list(image_bytes)
+        for image in images:
             try:
                 # Кодируем изображение в base64
-                image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+                image_base64 = base64.b64encode(image).decode('utf-8')
                 user_message_content.append({
                     "type": "image_url",
                     "image_url": {
@@ -105,6 +137,7 @@ def generate_response_openrouter(chat_id: int, prompt: str, image_bytes: Optiona
                 # Продолжаем без изображения
         
         # --- Подготовка контекста ---
+        context_started = time.monotonic()
         context_messages = get_context(chat_id)
         logger.debug(f"Получено {len(context_messages)} сообщений из контекста.")
 
@@ -117,9 +150,13 @@ def generate_response_openrouter(chat_id: int, prompt: str, image_bytes: Optiona
             openrouter_role = 'user' if role == 'user' else 'assistant'
             openrouter_messages.append({"role": openrouter_role, "content": content})
 
+        # --- Долговременная память: прошлые разговоры, относящиеся к вопросу ---
+        # Блок уйдёт в системное сообщение — его объём учитывается при обрезке контекста
+        memory_block = get_long_term_memory().recall_block(chat_id, prompt)
+
         # --- Обрезка контекста ---
-        estimated_prompt_tokens = estimate_tokens(prompt)
-        estimated_image_tokens = 256 if image_bytes else 0 # Грубая оценка для изображения
+        estimated_prompt_tokens = estimate_tokens(prompt) + estimate_tokens(memory_block or "")
+        estimated_image_tokens = 256 * len(images) # Грубая оценка для изображений
         total_new_tokens = estimated_prompt_tokens + estimated_image_tokens
 
         try:
@@ -133,33 +170,35 @@ def generate_response_openrouter(chat_id: int, prompt: str, image_bytes: Optiona
         except ValueError as ve:
             logger.error(f"Ошибка длины контекста: {ve}")
             return f"❌ {str(ve)}"
+        CONTEXT_PREPARE.observe(time.monotonic() - context_started, family="openrouter")
+        record_span("context", context_started, family="openrouter")
 
         # --- Настройка роли ---
+        # Снимок роли берётся один раз: перезагрузка person.set не меняет роль посреди запроса
+        role = get_role_manager().for_chat(chat_id)
         system_message = None
-        if CURRENT_ROLE_SETTINGS.get('name'):
-            logger.info(f"Используется роль: {CURRENT_ROLE_SETTINGS['name']}")
-            
-            role_parts = []
-            instructions = CURRENT_ROLE_SETTINGS.get('instructions')
-            knowledge_base = CURRENT_ROLE_SETTINGS.get('knowledge_base')
-            
-            if instructions:
-                role_parts.append(f"[ИНСТРУКЦИИ РОЛИ]\n{instructions}")
-            if knowledge_base:
-                role_parts.append(f"[БАЗА ЗНАНИЙ РОЛИ]\n{knowledge_base}")
-            
-            if role_parts:
-                system_content = "\n\n".join(role_parts)
+        if role.active:
+            logger.info(f"Используется роль: {role.name}")
+            # Промпт собран заранее; большая база знаний — только фрагменты под вопрос (KB_TOKEN_BUDGET)
+            system_content = role.system_message(prompt)
+            if system_content:
                 system_message = {"role": "system", "content": system_content}
                 logger.debug("Системное сообщение с ролью подготовлено.")
             
             # Инициализация (добавление KB к первому запросу в чате)
             if not is_role_context_initialized(chat_id):
-                logger.info(f"Инициализируем контекст для роли '{CURRENT_ROLE_SETTINGS['name']}' в чате {chat_id}")
+                logger.info(f"Инициализируем контекст для роли '{role.name}' в чате {chat_id}")
                 set_role_initialized(chat_id)
         else:
             logger.info("Используется стандартный режим.")
 
+        # --- Долговременная память (блок получен до обрезки контекста) ---
+        if memory_block:
+            if system_message:
+                system_message["content"] += f"\n\n{memory_block}"
+            else:
+                system_message = {"role": "system", "content": memory_block}
+
         # --- Формирование финального списка сообщений ---
         final_messages = []
         if system_message:
@@ -181,45 +220,41 @@ def generate_response_openrouter(chat_id: int, prompt: str, image_bytes: Optiona
             # Можно добавить другие параметры, например:
             # "temperature": 0.7,
             # "max_tokens": 1000,
-            # "stream": False
+            # Потоковый ответ (SSE): при отмене запроса (/clear, новое сообщение) соединение закрывается
+            "stream": True,
         }
 
         logger.info(f"Отправляем запрос к модели OpenRouter '{model_id}'...")
         logger.debug(f"Запрос к OpenRouter: {payload}") # Для отладки, можно удалить
 
-        response = requests.post(url, headers=headers, json=payload, timeout=120) # Таймаут 120 секунд
-        response.raise_for_status() # Вызовет исключение для HTTP ошибок 4xx/5xx
-
-        response_data = response.json()
-        logger.debug(f"Ответ от OpenRouter: {response_data}") # Для отладки, можно удалить
+        raise_if_cancelled()  # запрос отменили, пока готовили контекст — не тратим квоту
+        request_started = time.monotonic()
+        response = requests.post(url, headers=headers, json=payload, timeout=120, stream=True) # Таймаут 120 секунд
+        try:
+            response.raise_for_status() # Вызовет исключение для HTTP ошибок 4xx/5xx
+            openrouter_answer = _read_sse_answer(response, model_id, request_started).strip()
+        finally:
+            response.close()
 
         # --- Обработка ответа ---
-        if "choices" in response_data and len(response_data["choices"]) > 0:
-            choice = response_data["choices"][0]
-            if "message" in choice and "content" in choice["message"]:
-                openrouter_answer = choice["message"]["content"].strip()
-            elif "delta" in choice and "content" in choice["delta"]:
-                # Для потокового режима (на случай, если включим позже)
-                openrouter_answer = choice["delta"]["content"].strip()
-            else:
-                openrouter_answer = "Извините, не удалось сформулировать ответ (пустой ответ от модели OpenRouter)."
-                logger.warning("OpenRouter вернул пустой или некорректный ответ.")
-        else:
-            openrouter_answer = "Извините, не удалось сформулировать ответ (некорректная структура ответа от OpenRouter)."
-            logger.warning("Некорректная структура ответа от OpenRouter.")
+        if not openrouter_answer:
+            openrouter_answer = "Извините, не удалось сформулировать ответ (пустой ответ от модели OpenRouter)."
+            logger.warning("OpenRouter вернул пустой или некорректный ответ.")
 
         # --- Сохранение в контекст ---
-        add_to_context(chat_id, 'user', prompt) # Сохраняем оригинальный текст запроса
+        add_to_context(chat_id, 'user', prompt if history_prompt is None else history_prompt) # Сохраняем оригинальный текст запроса
         add_to_context(chat_id, 'assistant', openrouter_answer)
 
         logger.info(f"Ответ от модели OpenRouter получен. Длина: {len(openrouter_answer)} символов.")
         return openrouter_answer
 
     except requests.exceptions.RequestException as e:
+        count_error("provider_openrouter", e)
         error_msg = f"❌ Ошибка сети при обращении к OpenRouter API: {str(e)}"
         logger.error(error_msg, exc_info=True)
         return error_msg
     except Exception as e:
+        count_error("provider_openrouter", e)
         error_msg = f"❌ Ошибка генерации (OpenRouter): {str(e)}"
         logger.error(error_msg, exc_info=True)
         return error_msg
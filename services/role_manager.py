@@ -0,0 +1,302 @@
+# services/role_manager.py
+"""Роль ассистента: горячая перезагрузка person.set и файлов роли, заранее собранные системные промпты."""
+import asyncio
+import itertools
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+from config import (
+    ROLE_CONFIG_FILE, ROLES_BASE_DIR, ROLE_RELOAD_INTERVAL, ROLE_CACHE_SIZE, KB_TOKEN_BUDGET,
+    load_role_settings, load_role, find_file_case_insensitive,
+)
+from services.knowledge_index import retrieve_knowledge, get_knowledge_index, release_knowledge_index
+from services.context_service import get_chat_role
+
+logger = logging.getLogger(__name__)
+
+_versions = itertools.count(1)
+
+
+def _gemma_turn(text: str) -> str:
+    return f"<start_of_turn>user\n{text}\n<end_of_turn>"
+
+
+@dataclass(frozen=True)
+class Role:
+    """
+    Неизменяемый снимок роли. Промпты для семейств собираются один раз при загрузке:
+    запросы берут готовые строки, а при перезагрузке получают новый объект целиком.
+    """
+    name: Optional[str] = None
+    instructions: Optional[str] = None
+    # Текст базы знаний хранится, только если она уходит в промпт целиком (kb_static);
+    # большая база остаётся на диске — в индексе по knowledge_base_path
+    knowledge_base: Optional[str] = None
+    knowledge_base_path: Optional[str] = None
+    version: int = 0
+    # База знаний отсутствует или укладывается в бюджет — промпты не зависят от вопроса
+    kb_static: bool = True
+    # Готовые промпты: системное сообщение (Groq/OpenRouter) и преамбула Gemma
+    system_text: Optional[str] = field(default=None, repr=False)
+    gemma_text: str = field(default="", repr=False)
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> "Role":
+        name = settings.get("name")
+        instructions = settings.get("instructions") if name else None
+        knowledge_base = settings.get("knowledge_base") if name else None
+        kb_static = not knowledge_base or len(knowledge_base) // 4 <= KB_TOKEN_BUDGET
+        kb_text = knowledge_base if kb_static else None
+        return cls(
+            name=name,
+            instructions=instructions,
+            knowledge_base=kb_text,
+            knowledge_base_path=settings.get("knowledge_base_path") if name else None,
+            version=next(_versions),
+            kb_static=kb_static,
+            system_text=cls._compile_system(instructions, kb_text),
+            gemma_text=cls._compile_gemma(instructions, kb_text),
+        )
+
+    @staticmethod
+    def _compile_system(instructions: Optional[str], knowledge_base: Optional[str]) -> Optional[str]:
+        role_parts = []
+        if instructions:
+            role_parts.append(f"[ИНСТРУКЦИИ РОЛИ]\n{instructions}")
+        if knowledge_base:
+            role_parts.append(f"[БАЗА ЗНАНИЙ РОЛИ]\n{knowledge_base}")
+        return "\n\n".join(role_parts) or None
+
+    @staticmethod
+    def _compile_gemma(instructions: Optional[str], knowledge_base: Optional[str]) -> str:
+        # Gemma не поддерживает system_instruction: инструкции и база знаний идут первым ходом пользователя
+        # См. https://ai.google.dev/gemma/docs/core/prompt-structure#system_instructions
+        if instructions:
+            text = f"[ИНСТРУКЦИИ РОЛИ]\n{instructions}"
+            if knowledge_base:
+                text += f"\n[БАЗА ЗНАНИЙ РОЛИ]\n{knowledge_base}"
+            return _gemma_turn(text)
+        if knowledge_base:
+            return _gemma_turn(f"[БАЗА ЗНАНИЙ РОЛИ]\n{knowledge_base}")
+        return ""
+
+    @property
+    def active(self) -> bool:
+        return bool(self.name)
+
+    @property
+    def settings(self) -> dict:
+        """Словарь в формате load_role_settings() (для совместимости)."""
+        return {
+            "name": self.name,
+            "instructions": self.instructions,
+            "knowledge_base": self.knowledge_base,
+            "knowledge_base_path": self.knowledge_base_path,
+        }
+
+    def _knowledge(self, query: str) -> Optional[str]:
+        return retrieve_knowledge(self.knowledge_base_path, query) if self.knowledge_base_path else None
+
+    def system_message(self, query: str) -> Optional[str]:
+        """Системное сообщение для Groq/OpenRouter; с большой базой знаний — с фрагментами под вопрос."""
+        if self.kb_static:
+            return self.system_text
+        return self._compile_system(self.instructions, self._knowledge(query))
+
+    def gemma_preamble(self, query: str) -> str:
+        """Первый ход промпта Gemma с инструкциями и базой знаний."""
+        if self.kb_static:
+            return self.gemma_text
+        return self._compile_gemma(self.instructions, self._knowledge(query))
+
+
+_NO_ROLE = Role()
+
+
+def _role_dir(name: str) -> str:
+    return os.path.join(ROLES_BASE_DIR, name)
+
+
+class RoleManager:
+    """
+    Роль по умолчанию берётся из person.set; чат может выбрать свою (/role, ChatSettings.role).
+
+    Следит за person.set и папками ролей (опрос mtime раз в ROLE_RELOAD_INTERVAL) и при
+    изменениях загружает роль заново. Новый Role подменяет старый одной операцией присваивания:
+    запрос берёт роль один раз и до конца работает со своим снимком, поэтому перезагрузка
+    не затрагивает уже идущие запросы.
+
+    Роли чатов загружаются при первом обращении в LRU-кэш на ROLE_CACHE_SIZE ролей: чаты с одной
+    ролью делят один Role (инструкции, готовые промпты, индекс базы знаний). Вытесненная роль
+    закрывает свой индекс, так что в памяти не держатся базы знаний всех ролей сразу.
+    """
+
+    def __init__(self, interval: float = ROLE_RELOAD_INTERVAL, cache_size: int = ROLE_CACHE_SIZE):
+        self.interval = interval
+        self.cache_size = max(1, cache_size)
+        self._role = _NO_ROLE
+        self._stamp: Optional[tuple] = None
+        # name -> (Role, отпечаток файлов папки роли на момент загрузки)
+        self._cache: OrderedDict[str, tuple[Role, tuple]] = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"reloads": 0, "errors": 0, "hits": 0, "loads": 0, "evictions": 0}
+
+    def _ensure_loaded(self):
+        """Роль по умолчанию загружается один раз: в start или при первом обращении, если start ещё не было."""
+        if self._stamp is None:
+            with self._load_lock:
+                if self._stamp is None:
+                    self.reload()
+
+    def current(self) -> Role:
+        """Роль по умолчанию (из person.set)."""
+        self._ensure_loaded()
+        return self._role
+
+    def for_chat(self, chat_id: int) -> Role:
+        """Роль чата: выбранная через /role или роль по умолчанию."""
+        name = get_chat_role(chat_id)
+        if name is None:
+            return self.current()
+        if not name:
+            return _NO_ROLE  # в чате роль отключена
+        return self.get(name)
+
+    def get(self, name: str) -> Role:
+        """Роль по имени папки в person/ (из кэша или с диска)."""
+        role = self.current()
+        if name == role.name:
+            return role
+        if not name or os.path.basename(name) != name:
+            return _NO_ROLE
+        with self._cache_lock:
+            entry = self._cache.get(name)
+            if entry is not None:
+                self._cache.move_to_end(name)
+                self.stats["hits"] += 1
+                return entry[0]
+            # Загрузка под блокировкой: одна и та же роль (и её индекс) не строится дважды
+            stamp = self._dir_stamp(_role_dir(name))
+            role = Role.from_settings(load_role(name))
+            if role.knowledge_base_path and not role.kb_static:
+                get_knowledge_index(role.knowledge_base_path)
+            self._cache[name] = (role, stamp)
+            self.stats["loads"] += 1
+            evicted = []
+            while len(self._cache) > self.cache_size:
+                _, (old, _) = self._cache.popitem(last=False)
+                evicted.append(old)
+                self.stats["evictions"] += 1
+        for old in evicted:
+            self._release(old)
+        return role
+
+    def _release(self, role: Role):
+        """Закрывает индекс базы знаний роли, если он больше никому не нужен."""
+        path = role.knowledge_base_path
+        if not path or path == self._role.knowledge_base_path:
+            return
+        with self._cache_lock:
+            if any(cached.knowledge_base_path == path for cached, _ in self._cache.values()):
+                return
+        # Запросы, уже взявшие этот Role, при необходимости откроют индекс заново
+        release_knowledge_index(path)
+
+    @staticmethod
+    def available_roles() -> list[str]:
+        """Папки person/, в которых есть Instructions.txt."""
+        try:
+            names = [entry.name for entry in os.scandir(ROLES_BASE_DIR) if entry.is_dir()]
+        except OSError:
+            return []
+        return sorted(name for name in names if find_file_case_insensitive(_role_dir(name), 'Instructions.txt'))
+
+    @staticmethod
+    def _dir_stamp(path: str) -> tuple:
+        try:
+            return tuple(sorted(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in os.scandir(path) if entry.is_file()
+            ))
+        except OSError:
+            return ()
+
+    def _current_stamp(self) -> tuple:
+        try:
+            set_stamp = os.stat(ROLE_CONFIG_FILE).st_mtime_ns
+        except OSError:
+            set_stamp = None
+        # Файлы активной роли: правка Instructions.txt или базы знаний тоже перезагружает роль
+        role_dir = _role_dir(self._role.name) if self._role.name else None
+        return set_stamp, self._role.name, self._dir_stamp(role_dir) if role_dir else ()
+
+    def reload(self) -> Role:
+        """Загружает роль из person.set и файлов роли и атомарно подменяет текущую."""
+        role = Role.from_settings(load_role_settings())
+        if role.knowledge_base_path and not role.kb_static:
+            # Индекс строится до подмены — первый запрос к новой роли его не ждёт
+            get_knowledge_index(role.knowledge_base_path)
+        previous, self._role = self._role, role
+        self._stamp = self._current_stamp()
+        if previous.version:
+            self.stats["reloads"] += 1
+            logger.info(f"Роль перезагружена: '{previous.name}' → '{role.name}' (версия {role.version})")
+            if previous.knowledge_base_path != role.knowledge_base_path:
+                self._release(previous)
+        return role
+
+    def _poll_cache(self) -> int:
+        """Выбрасывает из кэша роли, файлы которых изменились; загрузятся заново при обращении."""
+        with self._cache_lock:
+            stale = [name for name, (_, stamp) in self._cache.items() if self._dir_stamp(_role_dir(name)) != stamp]
+            dropped = [self._cache.pop(name)[0] for name in stale]
+        for role in dropped:
+            self.stats["reloads"] += 1
+            logger.info(f"Роль '{role.name}' изменилась на диске и будет загружена заново")
+            self._release(role)
+        return len(dropped)
+
+    def poll(self) -> bool:
+        """Перезагружает роли, если файлы изменились. True — роль по умолчанию подменена."""
+        self._poll_cache()
+        if self._stamp is not None and self._current_stamp() == self._stamp:
+            return False
+        self.reload()
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.poll)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка перезагрузки роли: {e}", exc_info=True)
+
+    async def start(self):
+        await asyncio.to_thread(self._ensure_loaded)
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "cached": len(self._cache), "default": self._role.name}
+
+
+# Синглтон менеджера ролей
+_role_manager_instance: Optional[RoleManager] = None
+
+def get_role_manager() -> RoleManager:
+    global _role_manager_instance
+    if _role_manager_instance is None:
+        _role_manager_instance = RoleManager()
+    return _role_manager_instance
@@ -0,0 +1,294 @@
+# services/telegram_outbound.py
+"""Исходящие запросы к Telegram: лимиты скорости, повтор после 429, склейка правок статуса и пакетное удаление."""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from config import (
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_GROUP_RATE,
+    TELEGRAM_RETRY_ATTEMPTS, TELEGRAM_DELETE_DELAY, PLACEHOLDER_MODE,
+)
+from services.metrics import TELEGRAM_REQUEST, count_error
+from services.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Методы, которые Telegram ограничивает по чату (сообщения и их правки)
+_CHAT_LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+# Методы, которые не проходят через лимиты (long polling и служебные)
+_UNLIMITED_METHODS = {"getUpdates", "getMe", "getFile", "sendChatAction"}
+# Сколько чатов храним в кэше последних текстов статусов и корзин лимитов
+_MAX_TRACKED = 1000
+# Интервал повтора sendChatAction (Telegram показывает действие ~5 секунд)
+_CHAT_ACTION_INTERVAL = 4.5
+# Лимит для текущего запроса уже учтён (правки из edit_text) — middleware его не ждёт
+_rate_prepaid: contextvars.ContextVar[bool] = contextvars.ContextVar("rate_prepaid", default=False)
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше capacity про запас.
+
+    Токены могут уходить в минус — каждый запрос сразу резервирует свой токен и ждёт,
+    пока долг не погасится. Так очередь ожидающих обслуживается по порядку без блокировок.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # пауза после 429 (retry_after)
+
+    def reserve(self) -> float:
+        """Резервирует токен и возвращает, сколько секунд нужно подождать."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        return self.tokens >= self.capacity - 1 and time.monotonic() > self.blocked_until
+
+
+class OutboundScheduler:
+    """
+    Центральный диспетчер исходящих запросов бота.
+
+    - Все запросы проходят через глобальную корзину, сообщения и правки — ещё и через корзину чата
+      (личные чаты — TELEGRAM_CHAT_RATE, группы — TELEGRAM_GROUP_RATE). Подключается к сессии бота
+      как middleware (OutboundMiddleware), поэтому работает для любых вызовов bot.*.
+    - При 429 чат (или весь бот) ставится на паузу retry_after, запрос повторяется.
+    - edit_text склеивает правки одного сообщения: пока правка ждёт лимита, более новая
+      её заменяет, и в Telegram уходит только последний текст.
+    - delete копит удаления по чату и отправляет их одним deleteMessages.
+    - placeholder показывает ожидание эмодзи-сообщением или sendChatAction (PLACEHOLDER_MODE).
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self._edit_pending: dict[tuple[int, int], tuple[str, dict]] = {}
+        self._edit_tasks: dict[tuple[int, int], asyncio.Task] = {}
+        self._edit_last: OrderedDict[tuple[int, int], str] = OrderedDict()
+        self._delete_pending: dict[int, set[int]] = {}
+        self._delete_tasks: dict[int, asyncio.Task] = {}
+        self._bot: Optional[Bot] = None
+        self.stats = {"requests": 0, "retry_after": 0, "edits_coalesced": 0, "deletes_batched": 0}
+
+    # --- Лимиты ---
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= _MAX_TRACKED:
+                # Забываем чаты, чьи корзины полны — их состояние совпадает с новым
+                for key in [k for k, b in self.chat_buckets.items() if b.idle()]:
+                    del self.chat_buckets[key]
+            rate = TELEGRAM_GROUP_RATE if chat_id < 0 else TELEGRAM_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, TELEGRAM_CHAT_BURST)
+        return bucket
+
+    async def acquire(self, api_method: str, chat_id: Optional[int]):
+        """Ждёт, пока запрос api_method в чат chat_id укладывается в лимиты."""
+        if api_method in _UNLIMITED_METHODS:
+            return
+        wait = self.global_bucket.reserve()
+        if isinstance(chat_id, int) and api_method.startswith(_CHAT_LIMITED_PREFIXES):
+            wait = max(wait, self._chat_bucket(chat_id).reserve())
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_retry_after(self, chat_id: Optional[int], seconds: float):
+        self.stats["retry_after"] += 1
+        if isinstance(chat_id, int):
+            self._chat_bucket(chat_id).block(seconds)
+        else:
+            self.global_bucket.block(seconds)
+
+    # --- Склейка правок ---
+    async def edit_text(self, bot: Bot, chat_id: int, message_id: Optional[int], text: str, **kwargs):
+        """
+        Правит текст сообщения, склеивая частые правки. Ждёт, пока уйдёт этот или более новый текст.
+        Ошибки (сообщение удалено, текст не изменился) логируются и не пробрасываются.
+        """
+        if not message_id:
+            return
+        key = (chat_id, message_id)
+        if key in self._edit_pending:
+            self.stats["edits_coalesced"] += 1
+        self._edit_pending[key] = (text, kwargs)
+        task = self._edit_tasks.get(key)
+        if task is None or task.done():
+            task = self._edit_tasks[key] = asyncio.create_task(self._flush_edits(bot, key))
+        await asyncio.shield(task)
+
+    async def _flush_edits(self, bot: Bot, key: tuple[int, int]):
+        chat_id, message_id = key
+        _rate_prepaid.set(True)  # контекст задачи свой, на вызывающий код не влияет
+        try:
+            while key in self._edit_pending:
+                # Ждём лимит чата до того, как забрать текст — за это время его может заменить более новый
+                await self.acquire("editMessageText", chat_id)
+                pending = self._edit_pending.pop(key, None)
+                if pending is None:
+                    break  # сообщение поставлено на удаление — править нечего
+                text, kwargs = pending
+                if self._edit_last.get(key) == text:
+                    continue
+                try:
+                    await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+                    self._remember_edit(key, text)
+                except Exception as e:
+                    logger.debug(f"Правка сообщения {message_id} в чате {chat_id} не удалась: {e}")
+        finally:
+            self._edit_tasks.pop(key, None)
+
+    def _remember_edit(self, key: tuple[int, int], text: str):
+        self._edit_last[key] = text
+        self._edit_last.move_to_end(key)
+        while len(self._edit_last) > _MAX_TRACKED:
+            self._edit_last.popitem(last=False)
+
+    # --- Пакетное удаление ---
+    def delete(self, bot: Bot, chat_id: int, *message_ids: Optional[int]):
+        """Ставит сообщения на удаление; через TELEGRAM_DELETE_DELAY они уходят одним deleteMessages."""
+        ids = {mid for mid in message_ids if mid}
+        if not ids:
+            return
+        self._bot = bot
+        self._delete_pending.setdefault(chat_id, set()).update(ids)
+        for mid in ids:
+            self._edit_pending.pop((chat_id, mid), None)
+        task = self._delete_tasks.get(chat_id)
+        if task is None or task.done():
+            self._delete_tasks[chat_id] = asyncio.create_task(self._flush_deletes(bot, chat_id, TELEGRAM_DELETE_DELAY))
+
+    async def _flush_deletes(self, bot: Bot, chat_id: int, delay: float):
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            ids = sorted(self._delete_pending.pop(chat_id, ()))
+            if not ids:
+                return
+            if len(ids) > 1:
+                self.stats["deletes_batched"] += len(ids) - 1
+            try:
+                # deleteMessages принимает до 100 сообщений за вызов
+                for i in range(0, len(ids), 100):
+                    await bot.delete_messages(chat_id=chat_id, message_ids=ids[i:i + 100])
+            except Exception as e:
+                logger.debug(f"deleteMessages в чате {chat_id} не удался ({e}), удаляю по одному")
+                for mid in ids:
+                    try:
+                        await bot.delete_message(chat_id, mid)
+                    except Exception:
+                        pass
+        finally:
+            self._delete_tasks.pop(chat_id, None)
+
+    async def flush(self):
+        """Отправляет все накопленные удаления (при остановке бота)."""
+        if self._bot is None:
+            return
+        for task in list(self._delete_tasks.values()):
+            task.cancel()
+        self._delete_tasks.clear()
+        await asyncio.gather(
+            *(self._flush_deletes(self._bot, chat_id, 0) for chat_id in list(self._delete_pending)),
+            return_exceptions=True,
+        )
+
+    # --- Индикаторы ожидания ---
+    @asynccontextmanager
+    async def chat_action(self, bot: Bot, chat_id: int, action: str = "typing"):
+        """Повторяет sendChatAction, пока выполняется блок (в режиме 'typing')."""
+        if PLACEHOLDER_MODE != "typing":
+            yield
+            return
+
+        async def keep_alive():
+            while True:
+                try:
+                    await bot.send_chat_action(chat_id, action)
+                except Exception as e:
+                    logger.debug(f"sendChatAction в чате {chat_id} не удался: {e}")
+                await asyncio.sleep(_CHAT_ACTION_INTERVAL)
+
+        task = asyncio.create_task(keep_alive())
+        try:
+            yield
+        finally:
+            task.cancel()
+
+    @asynccontextmanager
+    async def placeholder(self, bot: Bot, chat_id: int, emoji: str, action: str = "typing"):
+        """
+        Индикатор ожидания на время блока: отдельное сообщение-эмодзи (режим 'emoji', удаляется
+        пакетно на выходе) или sendChatAction (режим 'typing'). Отдаёт message_id эмодзи или None.
+        """
+        if PLACEHOLDER_MODE == "typing":
+            async with self.chat_action(bot, chat_id, action):
+                yield None
+            return
+        msg = await bot.send_message(chat_id, emoji)
+        try:
+            yield msg.message_id
+        finally:
+            self.delete(bot, chat_id, msg.message_id)
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "chats": len(self.chat_buckets), "edits_pending": len(self._edit_pending)}
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Middleware сессии aiogram: лимиты перед каждым запросом и повтор после TelegramRetryAfter."""
+
+    def __init__(self, scheduler: OutboundScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        api_method = getattr(method, "__api_method__", "")
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(TELEGRAM_RETRY_ATTEMPTS + 1):
+            if attempt or not _rate_prepaid.get():
+                await self.scheduler.acquire(api_method, chat_id)
+            self.scheduler.stats["requests"] += 1
+            started = time.monotonic()
+            try:
+                with span(f"telegram.{api_method}", attempt=attempt):
+                    return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= TELEGRAM_RETRY_ATTEMPTS:
+                    count_error("telegram", e)
+                    raise
+                logger.warning(f"429 на {api_method} (чат {chat_id}): пауза {e.retry_after}s")
+                self.scheduler.on_retry_after(chat_id, e.retry_after)
+            except Exception as e:
+                count_error("telegram", e)
+                raise
+            finally:
+                # Время самого запроса, без ожидания лимитов; long polling не учитываем
+                if api_method != "getUpdates":
+                    TELEGRAM_REQUEST.observe(time.monotonic() - started, method=api_method)
+
+
+# Синглтон диспетчера
+_outbound_instance: Optional[OutboundScheduler] = None
+
+def get_outbound() -> OutboundScheduler:
+    global _outbound_instance
+    if _outbound_instance is None:
+        _outbound_instance = OutboundScheduler()
+    return _outbound_instance
@@ -0,0 +1,298 @@
+# services/tracing.py
+"""Трассировка запросов: trace_id на каждое обновление, спаны этапов, медленные трассы — в файл (Chrome Trace Event)."""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Iterator, Optional
+from aiogram import BaseMiddleware
+from config import TRACE_ENABLED, TRACE_DIR, TRACE_SLOW_THRESHOLD, TRACE_MAX_SPANS, TRACE_MAX_FILES
+
+logger = logging.getLogger(__name__)
+
+# Текущая трасса: копируется в asyncio-задачи и в asyncio.to_thread вместе с контекстом
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("current_trace", default=None)
+
+
+def _lane() -> tuple[tuple, str]:
+    """Дорожка спана: asyncio-задача или поток (в Chrome Trace — отдельная строка tid)."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return ("task", id(task)), task.get_name()
+    thread = threading.current_thread()
+    return ("thread", thread.ident), thread.name
+
+
+class Trace:
+    """
+    Трасса одного обновления. Живёт, пока её держит хотя бы один владелец: обработчик обновления,
+    задача конвейера голосовых... (retain/release). Последний release завершает трассу.
+    Спаны добавляются из любых потоков; после завершения — игнорируются.
+    """
+
+    def __init__(self, tracer: "Tracer", name: str, chat_id: Optional[int] = None, **attrs):
+        self.trace_id = secrets.token_hex(8)
+        self.name = name
+        self.chat_id = chat_id
+        self.attrs = attrs
+        self.started = time.monotonic()
+        self.started_wall = time.time()
+        self.finished_at: Optional[float] = None
+        # (имя, начало, конец, tid, атрибуты); время — time.monotonic()
+        self.spans: list[tuple[str, float, float, int, dict]] = []
+        self.dropped = 0
+        self._lanes: dict[tuple, tuple[int, str]] = {}
+        self._refs = 1
+        self._lock = threading.Lock()
+        self._tracer = tracer
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started
+
+    def add_span(self, name: str, start: float, end: Optional[float] = None, attrs: Optional[dict] = None):
+        end = time.monotonic() if end is None else end
+        lane_key, lane_name = _lane()
+        with self._lock:
+            if self.finished_at is not None:
+                return
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped += 1
+                return
+            tid = self._lanes.setdefault(lane_key, (len(self._lanes) + 1, lane_name))[0]
+            self.spans.append((name, start, end, tid, attrs or {}))
+
+    def retain(self):
+        with self._lock:
+            self._refs += 1
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            done = self._refs <= 0 and self.finished_at is None
+            if done:
+                self.finished_at = time.monotonic()
+        if done:
+            self._tracer.finished(self)
+
+    def to_chrome(self) -> dict:
+        """Трасса в формате Chrome Trace Event (JSON Object Format): ts/dur — микросекунды."""
+        pid = os.getpid()
+
+        def ts(moment: float) -> float:
+            return round((self.started_wall + moment - self.started) * 1e6, 1)
+
+        with self._lock:
+            spans = list(self.spans)
+            lanes = list(self._lanes.values())
+        events: list[dict] = [
+            {"ph": "M", "name": "process_name", "pid": pid, "tid": 0,
+             "args": {"name": f"{self.name} (чат {self.chat_id})"}},
+            {"ph": "M", "name": "thread_name", "pid": pid, "tid": 0, "args": {"name": "trace"}},
+        ]
+        events.extend(
+            {"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in lanes
+        )
+        events.append({
+            "name": self.name, "cat": "trace", "ph": "X", "pid": pid, "tid": 0,
+            "ts": ts(self.started), "dur": round(self.duration * 1e6, 1),
+            "args": {"trace_id": self.trace_id, "chat_id": self.chat_id, **self.attrs},
+        })
+        for name, start, end, tid, attrs in spans:
+            events.append({
+                "name": name, "cat": name.split(".", 1)[0], "ph": "X", "pid": pid, "tid": tid,
+                "ts": ts(start), "dur": round(max(0.0, end - start) * 1e6, 1), "args": attrs,
+            })
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "trace_id": self.trace_id, "name": self.name, "chat_id": self.chat_id,
+                "duration": round(self.duration, 3), "dropped_spans": self.dropped,
+            },
+        }
+
+
+class Tracer:
+    """
+    Создаёт трассы и разбирает завершённые: трассы дольше TRACE_SLOW_THRESHOLD записываются
+    в TRACE_DIR (по файлу на трассу, не больше TRACE_MAX_FILES), чтобы медленный ответ можно было
+    разобрать по этапам в chrome://tracing или Perfetto. Быстрые трассы только считаются.
+    """
+
+    def __init__(self, enabled: bool = TRACE_ENABLED, directory: str = TRACE_DIR,
+                 threshold: float = TRACE_SLOW_THRESHOLD, max_files: int = TRACE_MAX_FILES):
+        self.enabled = enabled
+        self.directory = directory
+        self.threshold = threshold
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self.stats = {"traces": 0, "slow": 0, "dumped": 0, "dump_errors": 0}
+
+    def start(self, name: str, chat_id: Optional[int] = None, **attrs) -> Optional[Trace]:
+        return Trace(self, name, chat_id, **attrs) if self.enabled else None
+
+    def finished(self, trace: Trace):
+        with self._lock:
+            self.stats["traces"] += 1
+            slow = trace.duration >= self.threshold
+            if slow:
+                self.stats["slow"] += 1
+        if not slow:
+            return
+        logger.warning(
+            f"Медленный запрос {trace.trace_id} ({trace.name}, чат {trace.chat_id}): {trace.duration:.1f}s"
+        )
+        # Запись файла — не в event loop; из потока (генерация в to_thread) пишем сразу
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self.dump, trace)
+        except RuntimeError:
+            self.dump(trace)
+
+    def dump(self, trace: Trace) -> Optional[str]:
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(trace.started_wall))
+        path = os.path.join(self.directory, f"{stamp}_{trace.name}_{trace.trace_id}.json")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(trace.to_chrome(), f, ensure_ascii=False)
+            os.replace(tmp, path)
+            self._prune()
+        except Exception as e:
+            with self._lock:
+                self.stats["dump_errors"] += 1
+            logger.error(f"Не удалось сохранить трассу {trace.trace_id}: {e}")
+            return None
+        with self._lock:
+            self.stats["dumped"] += 1
+        logger.info(f"Трасса {trace.trace_id} сохранена: {path}")
+        return path
+
+    def _prune(self):
+        paths = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith(".json")]
+        if len(paths) <= self.max_files:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_files]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+
+# Синглтон трассировщика
+_tracer_instance: Optional[Tracer] = None
+
+def get_tracer() -> Tracer:
+    global _tracer_instance
+    if _tracer_instance is None:
+        _tracer_instance = Tracer()
+    return _tracer_instance
+
+
+# --- Контекст ---
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+@contextmanager
+def bind_trace(trace: Optional[Trace]) -> Iterator[Optional[Trace]]:
+    """Делает trace текущей на время блока (для воркеров, обрабатывающих задачи разных чатов)."""
+    reset = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(reset)
+
+
+@contextmanager
+def trace(name: str, chat_id: Optional[int] = None, **attrs) -> Iterator[Optional[Trace]]:
+    """Новая трасса на время блока (сам блок — спан handler). Трасса завершится, когда её отпустят все владельцы."""
+    current = get_tracer().start(name, chat_id, **attrs)
+    if current is None:
+        yield None
+        return
+    try:
+        with bind_trace(current):
+            yield current
+    finally:
+        current.add_span("handler", current.started)
+        current.release()
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[None]:
+    """Спан этапа в текущей трассе (вне трассы — ничего не делает). Исключение записывается в атрибут error."""
+    current = _current_trace.get()
+    if current is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        current.add_span(name, start, time.monotonic(), attrs)
+
+
+def record_span(name: str, start: float, end: Optional[float] = None, **attrs):
+    """Спан по уже замеренному интервалу (time.monotonic()), например ожидание в очереди."""
+    current = _current_trace.get()
+    if current is not None:
+        current.add_span(name, start, end, attrs)
+
+
+class TraceLogFilter(logging.Filter):
+    """Добавляет к записям лога trace_id текущего запроса (%(trace_id)s в формате обработчика)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id() or "-"
+        return True
+
+
+# --- Трасса на каждое обновление ---
+def _describe_update(update) -> tuple[str, Optional[int]]:
+    """Имя трассы по типу обновления (message.voice, callback_query...) и chat_id."""
+    event_type = getattr(update, "event_type", None) or "update"
+    event = getattr(update, "event", None)
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    name = event_type
+    if event_type in ("message", "edited_message"):
+        for kind in ("voice", "photo", "document"):
+            if getattr(event, kind, None):
+                name = f"{event_type}.{kind}"
+                break
+        else:
+            text = getattr(event, "text", None) or ""
+            name = f"{event_type}.{'command' if text.startswith('/') else 'text'}"
+    return name, getattr(chat, "id", None)
+
+
+class TraceMiddleware(BaseMiddleware):
+    """Outer-middleware диспетчера: каждое обновление обрабатывается внутри своей трассы."""
+
+    async def __call__(self, handler: Callable[[Any, dict], Awaitable[Any]], event, data: dict) -> Any:
+        name, chat_id = _describe_update(event)
+        with trace(name, chat_id, update_id=getattr(event, "update_id", None)):
+            return await handler(event, data)
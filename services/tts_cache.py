@@ -0,0 +1,186 @@
+# services/tts_cache.py
+"""Контентно-адресуемый кэш озвучки: OGG/Opus на диске с LRU-вытеснением и file_id Telegram."""
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+from config import (
+    TTS_CACHE_ENABLED, TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, TTS_CACHE_MAX_ENTRIES, TTS_MODEL, TTS_VOICE_NAME,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TTSCacheEntry:
+    """Результат поиска в кэше: file_id (отправка без загрузки) и/или готовое аудио."""
+    key: str
+    file_id: Optional[str] = None
+    audio: Optional[bytes] = None
+
+
+def normalize_tts_text(text: str) -> str:
+    """Нормализация для ключа: пробелы схлопываются, края обрезаются (регистр и пунктуация влияют на интонацию)."""
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class TTSCache:
+    """
+    Кэш озвучки.
+
+    Аудио лежит файлами <key>.ogg в TTS_CACHE_DIR, индекс (размер, file_id, время
+    последнего обращения) — в SQLite рядом. При превышении TTS_CACHE_MAX_BYTES удаляются
+    давно не использованные записи; при превышении TTS_CACHE_MAX_ENTRIES — давно не
+    использованные строки индекса, в том числе оставшиеся только с file_id.
+    Методы работают с диском синхронно — из event loop вызываются через asyncio.to_thread.
+    """
+
+    def __init__(self, directory: str = TTS_CACHE_DIR, max_bytes: int = TTS_CACHE_MAX_BYTES,
+                 max_entries: int = TTS_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "index.sqlite3"), check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL DEFAULT 0,"
+            " file_id TEXT,"
+            " last_access REAL NOT NULL)"
+        )
+
+    @staticmethod
+    def key_for(text: str, voice: str = TTS_VOICE_NAME, model: str = TTS_MODEL) -> str:
+        payload = f"{model}\n{voice}\n{normalize_tts_text(text)}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.ogg")
+
+    def lookup(self, key: str) -> Optional[TTSCacheEntry]:
+        """Ищет запись; при попадании обновляет время обращения."""
+        with self._lock:
+            row = self._conn.execute("SELECT size, file_id FROM entries WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        size, file_id = row
+        entry = TTSCacheEntry(key=key, file_id=file_id)
+        if size:
+            try:
+                with open(self._path(key), "rb") as f:
+                    entry.audio = f.read()
+            except OSError:
+                # Файл удалён вручную — запись остаётся полезной, только если есть file_id
+                entry.audio = None
+        if not entry.audio and not entry.file_id:
+            self.forget(key)
+            return None
+        return entry
+
+    def store_audio(self, key: str, audio: bytes):
+        """Сохраняет аудио и при необходимости вытесняет старые записи."""
+        try:
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, self._path(key))
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO entries(key, size, last_access) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET size = excluded.size, last_access = excluded.last_access",
+                    (key, len(audio), time.time()),
+                )
+            self._evict()
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить озвучку в кэш: {e}")
+
+    def set_file_id(self, key: str, file_id: str):
+        """Запоминает file_id, полученный от Telegram после первой отправки."""
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO entries(key, file_id, last_access) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET file_id = excluded.file_id",
+                    (key, file_id, time.time()),
+                )
+            self._evict()
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить file_id озвучки в кэш: {e}")
+
+    def forget(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        self._evict_bytes()
+        self._evict_rows()
+
+    def _evict_rows(self):
+        """Строки сверх max_entries (по давности обращения) удаляются вместе с аудио."""
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if count <= self.max_entries:
+                return
+            keys = [row[0] for row in self._conn.execute(
+                "SELECT key FROM entries ORDER BY last_access LIMIT ?", (count - self.max_entries,)
+            ).fetchall()]
+        for key in keys:
+            self.forget(key)
+        logger.info(f"Кэш озвучки: удалено {len(keys)} старых записей индекса")
+
+    def _evict_bytes(self):
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self._conn.execute(
+                "SELECT key, size, file_id FROM entries WHERE size > 0 ORDER BY last_access"
+            ).fetchall()
+        removed = 0
+        for key, size, file_id in rows:
+            if total <= self.max_bytes:
+                break
+            if file_id:
+                # file_id занимает байты, а не мегабайты — оставляем его, удаляем только аудио
+                with self._lock:
+                    self._conn.execute("UPDATE entries SET size = 0 WHERE key = ?", (key,))
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            else:
+                self.forget(key)
+            total -= size
+            removed += 1
+        logger.info(f"Кэш озвучки: вытеснено {removed} записей, размер {total} байт")
+
+
+# Синглтон кэша
+_tts_cache_instance: Optional[TTSCache] = None
+
+def get_tts_cache() -> Optional[TTSCache]:
+    global _tts_cache_instance
+    if not TTS_CACHE_ENABLED:
+        return None
+    if _tts_cache_instance is None:
+        try:
+            _tts_cache_instance = TTSCache()
+        except Exception as e:
+            logger.error(f"Кэш озвучки недоступен: {e}")
+            return None
+    return _tts_cache_instance
@@ -0,0 +1,156 @@
+# services/voice_journal.py
+"""Журнал задач голосовой очереди: append-only лог переходов состояний в SQLite."""
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Optional
+from config import VOICE_JOURNAL_PATH, VOICE_JOURNAL_KEEP_DONE
+
+logger = logging.getLogger(__name__)
+
+# Состояния задачи в порядке прохождения конвейера
+STATE_QUEUED = "queued"
+STATE_TRANSCRIBED = "transcribed"
+STATE_GENERATING = "generating"
+STATE_GENERATED = "generated"
+STATE_REPLIED = "replied"
+STATE_FAILED = "failed"
+
+FINAL_STATES = (STATE_REPLIED, STATE_FAILED)
+
+# Сигнал потоку записи: дописать очередь и завершиться
+_STOP = object()
+
+
+class VoiceJournal:
+    """
+    Журнал переходов состояний голосовых задач.
+
+    Каждая запись — событие (job_id, state, payload). Записи только добавляются,
+    текущее состояние задачи получается слиянием payload всех её событий по порядку.
+    WAL-режим гарантирует, что при падении процесса зафиксированные события не теряются.
+
+    record не ждёт диска: события уходят в очередь, отдельный поток пишет их пачками
+    в одной транзакции, так что медленный диск не задерживает event loop и другие чаты.
+    Порядок событий сохраняется.
+    """
+
+    def __init__(self, path: str = VOICE_JOURNAL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " job_id TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " ts REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS events_job ON events(job_id)")
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_loop, name="voice-journal", daemon=True)
+        self._writer.start()
+
+    def record(self, job_id: str, state: str, **payload):
+        """Ставит в очередь на запись событие перехода задачи в состояние state."""
+        try:
+            self._queue.put((job_id, state, json.dumps(payload, ensure_ascii=False), time.time()))
+        except Exception as e:
+            # Журнал не должен ломать обработку голосовых
+            logger.error(f"Не удалось записать событие {state} для задачи {job_id}: {e}")
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = [item for item in batch if isinstance(item, tuple)]
+            if rows:
+                self._write(rows)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if _STOP in batch:
+                return
+
+    def _write(self, rows: list[tuple]):
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany(
+                        "INSERT INTO events(job_id, state, payload, ts) VALUES (?, ?, ?, ?)", rows
+                    )
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        except Exception as e:
+            logger.error(f"Не удалось записать в журнал голосовых {len(rows)} событий: {e}")
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Ждёт, пока поток записи допишет уже поставленные события (синхронно)."""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def load_unfinished(self) -> list[dict]:
+        """
+        Возвращает незавершённые задачи в порядке постановки в очередь.
+
+        Каждый элемент — словарь со слитым payload, а также полями
+        job_id, state (последнее состояние) и created_at.
+        """
+        jobs: dict[str, dict] = {}
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id, state, payload, ts FROM events ORDER BY id"
+            ).fetchall()
+        for job_id, state, payload, ts in rows:
+            job = jobs.setdefault(job_id, {"job_id": job_id, "created_at": ts})
+            try:
+                job.update(json.loads(payload))
+            except ValueError:
+                logger.warning(f"Повреждённая запись журнала для задачи {job_id}")
+            job["state"] = state
+        return [j for j in jobs.values() if j["state"] not in FINAL_STATES]
+
+    def compact(self, keep_seconds: float = VOICE_JOURNAL_KEEP_DONE):
+        """Удаляет события задач, завершённых раньше чем keep_seconds назад."""
+        cutoff = time.time() - keep_seconds
+        placeholders = ",".join("?" for _ in FINAL_STATES)
+        with self._lock:
+            cur = self._conn.execute(
+                f"DELETE FROM events WHERE job_id IN ("
+                f" SELECT job_id FROM events WHERE state IN ({placeholders}) AND ts < ?)",
+                (*FINAL_STATES, cutoff),
+            )
+        if cur.rowcount:
+            logger.info(f"Журнал голосовых: удалено {cur.rowcount} устаревших событий")
+
+    def close(self):
+        """Дописывает очередь и закрывает базу."""
+        self._queue.put(_STOP)
+        self._writer.join(timeout=10.0)
+        with self._lock:
+            self._conn.close()
+
+
+# Синглтон журнала
+_journal_instance: Optional[VoiceJournal] = None
+
+def get_voice_journal() -> VoiceJournal:
+    global _journal_instance
+    if _journal_instance is None:
+        _journal_instance = VoiceJournal()
+    return _journal_instance
@@ -1,18 +1,67 @@
 # services/voice_queue.py
 import asyncio
+import itertools
 import logging
 import os
-from typing import Optional, Tuple
+import time
+from dataclasses import dataclass, field
+from typing import Optional
 from aiogram import Bot
-from config import VOICE_WORKERS_COUNT
-from audio_utils import process_voice_message
+from config import (
+    VOICE_WORKERS_COUNT, VOICE_QUEUE_MAXSIZE, VOICE_SHORT_CLIP_SECONDS, VOICE_LONG_CLIP_PENALTY,
+    VOICE_SCALE_INTERVAL, VOICE_JOURNAL_MAX_AGE, VOICE_STAGE_WORKERS, VOICE_STAGE_QUEUE_SIZE,
+    TRANSCRIPTION_PROGRESS_EDITS, TRANSCRIPTION_PROGRESS_INTERVAL,
+    TRANSCRIPTION_BATCH_ENABLED, TRANSCRIPTION_BATCH_MAX_ITEMS, TRANSCRIPTION_BATCH_MAX_CLIP,
+    TRANSCRIPTION_BATCH_MAX_SECONDS, TRANSCRIPTION_BATCH_MAX_BYTES,
+)
+from audio_utils import download_voice_file, transcribe_voice_file, transcribe_voice_batch, remove_temp_file
 from services.model_service import generate_model_response
 from utils.helpers import send_response
 from services.audio_service import send_audio_with_progress
 from services.context_service import get_voice_mode
+from services.voice_journal import (
+    get_voice_journal, STATE_QUEUED, STATE_TRANSCRIBED, STATE_GENERATING,
+    STATE_GENERATED, STATE_REPLIED, STATE_FAILED,
+)
+from services.voice_stages import PipelineStage
+from services.audio_pool import get_audio_pool
+from services.telegram_outbound import get_outbound
+from services.cancellation import get_cancellation, bind, CancelToken, RequestCancelled
+from services.tracing import Trace, get_tracer, current_trace, bind_trace, span, record_span
 
 logger = logging.getLogger(__name__)
 
+
+@dataclass(order=True)
+class VoiceJob:
+    """
+    Задача очереди. Сортируется по виртуальному сроку, затем по порядку поступления.
+
+    Хранит только идентификаторы (а не объекты Message), чтобы задачу можно было
+    восстановить из журнала после перезапуска.
+    """
+    deadline: float
+    seq: int
+    job_id: str = field(compare=False)
+    chat_id: int = field(compare=False)
+    message_id: int = field(compare=False)
+    file_id: str = field(compare=False)
+    duration: int = field(compare=False)
+    status_msg_id: Optional[int] = field(compare=False, default=None)
+    icon_msg_id: Optional[int] = field(compare=False, default=None)
+    # Результаты уже пройденных этапов (при восстановлении из журнала)
+    transcript: Optional[str] = field(compare=False, default=None)
+    response: Optional[str] = field(compare=False, default=None)
+    # Скачанный временный файл между этапами download и transcribe
+    audio_path: Optional[str] = field(compare=False, default=None)
+    # Момент постановки на текущий этап (обновляется этапом)
+    enqueued_at: float = field(compare=False, default_factory=time.monotonic)
+    # Отмена (/clear, смена модели): ещё не пройденные этапы пропускаются
+    cancel_token: Optional[CancelToken] = field(compare=False, default=None)
+    # Трасса обновления с голосовым: этапы конвейера пишут в неё спаны
+    trace: Optional[Trace] = field(compare=False, default=None)
+
+
 class VoiceQueue:
     """
     Очередь асинхронной обработки голосовых для aiogram 3.x
@@ -24,127 +73,405 @@ class VoiceQueue:
       3) Отдельным сообщением отправляем 📝.
       4) После генерации: удаляем 📝 и редактируем статус: "Ответ получен".
       5) Итоговый ответ отправляем как reply к исходному голосовому.
+
+    Каждый переход (queued → transcribed → generated → replied) пишется в журнал,
+    при старте незавершённые задачи продолжаются с последнего пройденного этапа.
+
+    Устройство — конвейер из этапов, каждый со своим пулом воркеров и метриками
+    (services/voice_stages.PipelineStage), соединённых ограниченными очередями:
+      download → transcribe → generate (+ ответ текстом) → tts.
+    Этапы работают параллельно над разными задачами, поэтому долгая озвучка не мешает
+    распознавать следующие голосовые: пропускная способность определяется самым медленным этапом.
+      - задачи одного чата на каждом этапе идут через один шард — порядок сохраняется;
+      - общий размер ограничен VOICE_QUEUE_MAXSIZE, при переполнении add_message возвращает None;
+      - короткие клипы идут раньше длинных (длинным добавляется VOICE_LONG_CLIP_PENALTY к сроку);
+      - число воркеров каждого этапа масштабируется в пределах VOICE_STAGE_WORKERS;
+      - короткие голосовые, уже ждущие транскрибации, распознаются пакетом одним запросом;
+      - у каждой задачи свой токен отмены: после /clear или смены модели оставшиеся этапы
+        не выполняются, генерация и озвучка прерываются;
+      - задача держит трассу обновления (services/tracing) до выхода из конвейера: ожидание
+        в очереди и работа каждого этапа записываются спанами.
     """
 
     def __init__(self, bot: Bot, loop: asyncio.AbstractEventLoop):
         self.bot = bot
         self.loop = loop
-        # Элементы очереди: (voice_message, status_msg, icon_voice_msg)
-        self.queue: asyncio.Queue[Tuple] = asyncio.Queue()
-        self.workers: list[asyncio.Task] = []
         self.running = False
         self.google_api_key = os.getenv("GOOGLE_API_KEY")
+        self.journal = get_voice_journal()
+        self.outbound = get_outbound()
+        self.cancellation = get_cancellation()
+        self._seq = itertools.count()
+        self._pending = 0  # задачи, ещё не покинувшие конвейер
+        # chat_id -> [срок последней задачи, задач чата в конвейере]
+        self._chat_state: dict[int, list] = {}
+        self._scaler: Optional[asyncio.Task] = None
+        self.stats = {"processed": 0, "rejected": 0, "cancelled": 0}
+
+        handlers = {
+            "download": self._stage_download,
+            "transcribe": self._stage_transcribe,
+            "generate": self._stage_generate,
+            "tts": self._stage_tts,
+        }
+        self.stages: list[PipelineStage] = []
+        for name, handler in handlers.items():
+            min_w, max_w = VOICE_STAGE_WORKERS.get(name, (1, 1))
+            stage = PipelineStage(
+                name,
+                self._cancellable(name, handler),
+                min_workers=min_w,
+                max_workers=max_w,
+                initial_workers=VOICE_WORKERS_COUNT if name == "transcribe" else None,
+                # Первый этап принимает задачи без ожидания — его размер ограничен VOICE_QUEUE_MAXSIZE
+                queue_size=0 if not self.stages else VOICE_STAGE_QUEUE_SIZE,
+            )
+            stage.on_finish = self._on_finish
+            stage.on_error = self._on_error
+            if name == "transcribe" and TRANSCRIPTION_BATCH_ENABLED:
+                stage.batch_handler = self._stage_transcribe_batch
+                stage.batch_filter = self._batch_filter
+                stage.batch_max = TRANSCRIPTION_BATCH_MAX_ITEMS
+            if self.stages:
+                self.stages[-1].next_stage = stage
+            self.stages.append(stage)
 
     def start(self):
         if self.running:
             return
         self.running = True
-        for i in range(VOICE_WORKERS_COUNT):
-            self.workers.append(asyncio.create_task(self._worker(f"worker-{i+1}")))
-        logger.info(f"Запущено {len(self.workers)} воркеров обработки голоса")
+        for stage in self.stages:
+            stage.start()
+        self._scaler = asyncio.create_task(self._autoscaler())
+        logger.info(f"Конвейер голосовых запущен: {', '.join(f'{st.name}={st.active_workers}' for st in self.stages)}")
+        asyncio.create_task(self._resume_from_journal())
 
     def stop(self):
         if not self.running:
             return
         self.running = False
-        for w in self.workers:
-            w.cancel()
-        self.workers.clear()
+        if self._scaler:
+            self._scaler.cancel()
+            self._scaler = None
+        for stage in self.stages:
+            stage.stop()
+        self.journal.close()
         logger.info("Очередь обработки голоса остановлена")
 
-    def add_message(self, voice_message, status_msg, icon_voice_msg):
-        # Кладём задачу с обоими плейсхолдерами
-        asyncio.create_task(self.queue.put((voice_message, status_msg, icon_voice_msg)))
+    def add_message(self, voice_message, status_msg, icon_voice_msg) -> Optional[int]:
+        """
+        Ставит голосовое в очередь.
+
+        Returns:
+            int | None: Позиция в очереди своего воркера (1 — следующая),
+                        либо None, если очередь переполнена.
+        """
+        if self._pending >= VOICE_QUEUE_MAXSIZE:
+            self.stats["rejected"] += 1
+            logger.warning(f"Очередь голосовых переполнена ({self._pending}), задача отклонена")
+            return None
+
+        chat_id = voice_message.chat.id
+        payload = {
+            "chat_id": chat_id,
+            "message_id": voice_message.message_id,
+            "file_id": voice_message.voice.file_id,
+            "duration": int(getattr(voice_message.voice, "duration", 0) or 0),
+            "status_msg_id": getattr(status_msg, "message_id", None),
+            "icon_msg_id": getattr(icon_voice_msg, "message_id", None),
+        }
+        job_id = f"{chat_id}:{voice_message.message_id}"
+        self.journal.record(job_id, STATE_QUEUED, **payload)
+        return self._enqueue(job_id, payload)
+
+    def _enqueue(self, job_id: str, payload: dict) -> int:
+        chat_id = payload["chat_id"]
+        duration = payload["duration"]
+        deadline = time.monotonic() + (VOICE_LONG_CLIP_PENALTY if duration > VOICE_SHORT_CLIP_SECONDS else 0.0)
+        # Срок не может быть раньше предыдущей задачи того же чата — сохраняем порядок
+        state = self._chat_state.setdefault(chat_id, [0.0, 0])
+        deadline = max(deadline, state[0])
+        state[0] = deadline
+        state[1] += 1
+        self._pending += 1
+
+        # Трасса обработчика обновления живёт, пока задача в конвейере; восстановленной из журнала — новая
+        trace = current_trace()
+        if trace is not None:
+            trace.retain()
+        else:
+            trace = get_tracer().start("voice.resumed", chat_id, job_id=job_id)
+
+        job = VoiceJob(
+            deadline=deadline,
+            seq=next(self._seq),
+            job_id=job_id,
+            chat_id=chat_id,
+            message_id=payload["message_id"],
+            file_id=payload["file_id"],
+            duration=duration,
+            status_msg_id=payload.get("status_msg_id"),
+            icon_msg_id=payload.get("icon_msg_id"),
+            transcript=payload.get("transcript"),
+            response=payload.get("response"),
+            cancel_token=self.cancellation.start(chat_id, "voice"),
+            trace=trace,
+        )
+        return self.stages[0].put_nowait(job)
+
+    def _on_finish(self, job: VoiceJob):
+        self._pending -= 1
+        self.stats["processed"] += 1
+        if job.cancel_token is not None:
+            self.cancellation.finish(job.cancel_token)
+        if job.trace is not None:
+            job.trace.release()
+        state = self._chat_state.get(job.chat_id)
+        if state:
+            state[1] -= 1
+            # Последняя задача чата покинула конвейер — срок больше не нужен
+            if state[1] <= 0:
+                del self._chat_state[job.chat_id]
+
+    async def _on_error(self, job: VoiceJob, error: Exception):
+        self.journal.record(job.job_id, STATE_FAILED, error=str(error))
+        remove_temp_file(job.audio_path)
+        # На всякий случай пробуем убрать эмодзи, если остались
+        await self._safe_delete(job.chat_id, job.icon_msg_id)
 
-    async def _worker(self, name: str):
-        logger.info(f"{name}: запущен")
+    def _cancellable(self, name: str, handler):
+        """Обёртка этапа: отменённая задача дальше не обрабатывается, этап выполняется с токеном и трассой задачи."""
+        async def run(job: VoiceJob) -> bool:
+            with bind_trace(job.trace):
+                record_span(f"queue.{name}", job.enqueued_at)
+                try:
+                    if job.cancel_token is not None:
+                        job.cancel_token.raise_if_cancelled()
+                    # Токен и трасса видны генерации в потоке и озвучке через contextvars
+                    with bind(job.cancel_token), span(f"voice.{name}"):
+                        return await handler(job)
+                except RequestCancelled as e:
+                    await self._on_cancelled(job, e.reason)
+                    return False
+        return run
+
+    async def _on_cancelled(self, job: VoiceJob, reason: str):
+        self.stats["cancelled"] += 1
+        logger.info(f"Голосовое {job.job_id} отменено ({reason})")
+        self.journal.record(job.job_id, STATE_FAILED, error=f"cancelled: {reason}")
+        remove_temp_file(job.audio_path)
+        job.audio_path = None
+        await self._safe_delete(job.chat_id, job.icon_msg_id)
+        await self._edit_status(job.chat_id, job.status_msg_id, "⏹ Обработка голосового отменена")
+
+    def get_stats(self) -> dict:
+        """Снимок показателей конвейера для логов и диагностики."""
+        return {
+            **self.stats,
+            "pending": self._pending,
+            "stages": {st.name: st.get_stats() for st in self.stages},
+            "audio_pool": get_audio_pool().get_stats(),
+            "cancellation": self.cancellation.get_stats(),
+        }
+
+    async def _autoscaler(self):
         while self.running:
-            try:
-                voice_message, status_msg, icon_voice_msg = await asyncio.wait_for(
-                    self.queue.get(), timeout=1.0
+            await asyncio.sleep(VOICE_SCALE_INTERVAL)
+            for stage in self.stages:
+                stage.autoscale()
+            logger.debug(f"Состояние конвейера голосовых: {self.get_stats()}")
+
+    async def _resume_from_journal(self):
+        """Восстанавливает незавершённые задачи из журнала и чистит осиротевшие плейсхолдеры."""
+        try:
+            # Чтение и чистка журнала — в потоке, не в event loop
+            await asyncio.to_thread(self.journal.compact)
+            unfinished = await asyncio.to_thread(self.journal.load_unfinished)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать журнал голосовых: {e}", exc_info=True)
+            return
+        if not unfinished:
+            return
+
+        now = time.time()
+        resumed = 0
+        for entry in unfinished:
+            job_id = entry["job_id"]
+            chat_id = entry.get("chat_id")
+            if chat_id is None or not entry.get("file_id"):
+                self.journal.record(job_id, STATE_FAILED, error="incomplete journal entry")
+                continue
+
+            # 📝 этапа генерации остался от прошлого процесса — генерация будет запущена заново
+            await self._safe_delete(chat_id, entry.pop("answer_icon_id", None))
+
+            if now - entry["created_at"] > VOICE_JOURNAL_MAX_AGE:
+                await self._safe_delete(chat_id, entry.get("icon_msg_id"))
+                await self._edit_status(
+                    chat_id, entry.get("status_msg_id"),
+                    "❌ Голосовое не было обработано из-за перезапуска бота. Пожалуйста, отправьте его ещё раз."
                 )
-            except asyncio.TimeoutError:
+                self.journal.record(job_id, STATE_FAILED, error="expired")
                 continue
 
+            if entry["state"] == STATE_QUEUED:
+                await self._edit_status(
+                    chat_id, entry.get("status_msg_id"), "распознаю речь... (восстановлено после перезапуска)"
+                )
+            self._enqueue(job_id, entry)
+            resumed += 1
+
+        if resumed:
+            logger.info(f"Восстановлено {resumed} голосовых задач из журнала")
+
+    # --- Этапы конвейера ---
+    async def _stage_download(self, job: VoiceJob) -> bool:
+        # При восстановлении с готовой транскрипцией скачивать нечего
+        if job.transcript is None:
+            job.audio_path = await download_voice_file(self.bot, job.file_id)
+        return True
+
+    async def _stage_transcribe(self, job: VoiceJob) -> bool:
+        # 1) Транскрибация (асинхронная); при восстановлении берём сохранённый текст
+        text = None
+        if job.transcript is None:
             try:
-                chat_id = voice_message.chat.id
-
-                # 1) Транскрибация (асинхронная)
-                text = await process_voice_message(self.bot, voice_message, self.google_api_key)
-                if not isinstance(text, str) or text.strip().startswith("❌"):
-                    # Ошибка транскрибации: удаляем 🎤, обновляем статус и выходим
-                    await self._safe_delete(chat_id, getattr(icon_voice_msg, "message_id", None))
-                    try:
-                        await status_msg.edit_text(f"❌ Ошибка транскрибации: {text}")
-                    except Exception:
-                        pass
-                    continue
-
-                # Удаляем стартовый эмодзи СРАЗУ ПОСЛЕ транскрибации (требование)
-                await self._safe_delete(chat_id, getattr(icon_voice_msg, "message_id", None))
-
-                # Обновляем статус на распознанный текст + формирование ответа
-                recognized_block = f"🎤Распознано:\n{text.strip()}\nФормулирую ответ"
-                try:
-                    await status_msg.edit_text(recognized_block)
-                except Exception:
-                    pass
+                async with self.outbound.chat_action(self.bot, job.chat_id):
+                    text = await transcribe_voice_file(
+                        job.audio_path, self.google_api_key,
+                        on_progress=self._progress_updater(job) if TRANSCRIPTION_PROGRESS_EDITS else None,
+                    )
+            finally:
+                remove_temp_file(job.audio_path)
+                job.audio_path = None
+        return await self._after_transcription(job, text)
+
+    @staticmethod
+    def _batch_filter(batch: list[VoiceJob], job: VoiceJob) -> bool:
+        """Пакет — только короткие скачанные клипы в пределах лимитов длительности и размера."""
+        if job.transcript is not None or not job.audio_path or job.duration > TRANSCRIPTION_BATCH_MAX_CLIP:
+            return False
+        jobs = [*batch, job]
+        if sum(j.duration for j in jobs) > TRANSCRIPTION_BATCH_MAX_SECONDS:
+            return False
+        try:
+            return sum(os.path.getsize(j.audio_path) for j in jobs) <= TRANSCRIPTION_BATCH_MAX_BYTES
+        except OSError:
+            return False
+
+    async def _stage_transcribe_batch(self, jobs: list[VoiceJob]) -> list[bool]:
+        # Отменённые пока ждали в очереди задачи в запрос не идут
+        cancelled = [job for job in jobs if job.cancel_token is not None and job.cancel_token.cancelled]
+        if cancelled:
+            for job in cancelled:
+                await self._on_cancelled(job, job.cancel_token.reason)
+            live = [job for job in jobs if job not in cancelled]
+            live_results = iter(await self._stage_transcribe_batch(live) if live else [])
+            return [False if job in cancelled else next(live_results) for job in jobs]
+        started = time.monotonic()
+        try:
+            texts = await transcribe_voice_batch([job.audio_path for job in jobs], self.google_api_key)
+        finally:
+            for job in jobs:
+                remove_temp_file(job.audio_path)
+                job.audio_path = None
+                # Пакет обрабатывается вне трасс задач — спаны пишем в трассу каждой задачи
+                if job.trace is not None:
+                    job.trace.add_span("queue.transcribe", job.enqueued_at, started)
+                    job.trace.add_span("voice.transcribe", started, attrs={"batch": len(jobs)})
+        results = []
+        for job, text in zip(jobs, texts):
+            try:
+                with bind_trace(job.trace):
+                    results.append(await self._after_transcription(job, text))
+            except Exception as e:
+                # Ошибка одной задачи не должна ронять остальные задачи пакета
+                logger.error(f"Ошибка после транскрибации задачи {job.job_id}: {e}", exc_info=True)
+                await self._on_error(job, e)
+                results.append(False)
+        return results
+
+    async def _after_transcription(self, job: VoiceJob, text: Optional[str]) -> bool:
+        """Фиксирует результат транскрибации (text=None — текст уже есть в задаче) и обновляет статус."""
+        chat_id = job.chat_id
+        if text is not None:
+            if not isinstance(text, str) or text.strip().startswith("❌"):
+                # Ошибка транскрибации: удаляем 🎤, обновляем статус и выходим
+                await self._safe_delete(chat_id, job.icon_msg_id)
+                await self._edit_status(chat_id, job.status_msg_id, f"❌ Ошибка транскрибации: {text}")
+                self.journal.record(job.job_id, STATE_FAILED, error=str(text))
+                return False
+            job.transcript = text
+            self.journal.record(job.job_id, STATE_TRANSCRIBED, transcript=text)
+
+        # Удаляем стартовый эмодзи СРАЗУ ПОСЛЕ транскрибации (требование)
+        await self._safe_delete(chat_id, job.icon_msg_id)
+
+        # Обновляем статус на распознанный текст + формирование ответа
+        await self._edit_status(chat_id, job.status_msg_id, self._recognized_block(job, "Формулирую ответ"))
+        return True
+
+    async def _stage_generate(self, job: VoiceJob) -> bool:
+        chat_id = job.chat_id
 
-                # 2) Отдельный плейсхолдер для этапа генерации ответа
-                icon_answer_msg = await self.bot.send_message(chat_id, "📝")
+        if job.response is None:
+            # 2) Отдельный плейсхолдер для этапа генерации ответа (📝 или «печатает...»),
+            #    📝 удаляется на выходе независимо от результата
+            async with self.outbound.placeholder(self.bot, chat_id, "📝") as answer_icon_id:
+                self.journal.record(job.job_id, STATE_GENERATING, answer_icon_id=answer_icon_id)
 
                 # 3) Генерация ответа (синхронная → отдельный поток, чтобы не блокировать UI)
-                response = await asyncio.to_thread(generate_model_response, chat_id, text, None)
-
-                # Удаляем 📝 независимо от результата
-                await self._safe_delete(chat_id, getattr(icon_answer_msg, "message_id", None))
-
-                if not response:
-                    # Обновляем статус, если ответ не получен
-                    try:
-                        await status_msg.edit_text(
-                            recognized_block.replace("Формулирую ответ", "Ответ не получен")
-                        )
-                    except Exception:
-                        pass
-                    continue
-
-                # 4) Меняем "Формулирую ответ" → "Ответ получен"
-                try:
-                    await status_msg.edit_text(
-                        recognized_block.replace("Формулирую ответ", "Ответ получен")
-                    )
-                except Exception:
-                    pass
+                response = await asyncio.to_thread(generate_model_response, chat_id, job.transcript, None)
 
-                # Отправляем итоговый ответ как reply к голосовому
-                await send_response(self.bot, chat_id, response, voice_message.message_id)
+            if not response:
+                # Обновляем статус, если ответ не получен
+                await self._edit_status(chat_id, job.status_msg_id, self._recognized_block(job, "Ответ не получен"))
+                self.journal.record(job.job_id, STATE_FAILED, error="empty response")
+                return False
+            job.response = response
+            self.journal.record(job.job_id, STATE_GENERATED, response=response, answer_icon_id=None)
 
-                # Озвучка по режиму
-                if get_voice_mode(chat_id) and response:
-                    await send_audio_with_progress(
-                        self.bot, chat_id, response, voice_message.message_id
-                    )
+        # 4) Меняем "Формулирую ответ" → "Ответ получен"
+        await self._edit_status(chat_id, job.status_msg_id, self._recognized_block(job, "Ответ получен"))
 
-            except Exception as e:
-                logger.error(f"{name}: {e}", exc_info=True)
-                # На всякий случай пробуем убрать эмодзи, если остались
-                try:
-                    await self._safe_delete(voice_message.chat.id, getattr(icon_voice_msg, "message_id", None))
-                except Exception:
-                    pass
-            finally:
-                self.queue.task_done()
-        logger.info(f"{name}: остановлен")
+        # Отправляем итоговый ответ как reply к голосовому
+        await send_response(self.bot, chat_id, job.response, job.message_id)
+        self.journal.record(job.job_id, STATE_REPLIED)
+
+        # Озвучка — отдельным этапом, чтобы не задерживать следующие ответы
+        return bool(get_voice_mode(chat_id))
+
+    async def _stage_tts(self, job: VoiceJob) -> bool:
+        await send_audio_with_progress(self.bot, job.chat_id, job.response, job.message_id)
+        return False
+
+    def _progress_updater(self, job: VoiceJob):
+        """Колбэк для сегментированной транскрибации: показывает частичный текст в статусе (с троттлингом)."""
+        last_edit = 0.0
+
+        async def on_progress(partial: str, done: int, total: int):
+            nonlocal last_edit
+            now = time.monotonic()
+            if done < total and now - last_edit < TRANSCRIPTION_PROGRESS_INTERVAL:
+                return
+            last_edit = now
+            # Лимит длины сообщения Telegram — показываем хвост частичного текста
+            tail = partial[-3500:] if len(partial) > 3500 else partial
+            await self._edit_status(job.chat_id, job.status_msg_id, f"🎤Распознаю ({done}/{total})...\n{tail}")
+
+        return on_progress
+
+    @staticmethod
+    def _recognized_block(job: VoiceJob, tail: str) -> str:
+        return f"🎤Распознано:\n{job.transcript.strip()}\n{tail}"
+
+    async def _edit_status(self, chat_id: int, message_id: Optional[int], text: str):
+        # Частые правки статуса склеиваются; ошибки (сообщение удалено, текст не изменился) игнорируются
+        await self.outbound.edit_text(self.bot, chat_id, message_id, text)
 
     async def _safe_delete(self, chat_id: int, message_id: Optional[int]):
-        if not message_id:
-            return
-        try:
-            await self.bot.delete_message(chat_id, message_id)
-        except Exception:
-            # игнорируем ограничения/тайминги Telegram при удалении
-            pass
+        # Удаления копятся и уходят пакетом; ограничения/тайминги Telegram игнорируются
+        self.outbound.delete(self.bot, chat_id, message_id)
 
 # Синглтон очереди
 _voice_queue_instance: Optional[VoiceQueue] = None
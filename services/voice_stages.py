@@ -0,0 +1,263 @@
+# services/voice_stages.py
+"""Этап конвейера обработки голосовых: шардированные очереди, собственный пул воркеров и метрики."""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+from config import VOICE_SCALE_UP_DEPTH, VOICE_SCALE_UP_WAIT, VOICE_SCALE_DOWN_IDLE
+from services.metrics import QUEUE_WAIT, STAGE_SERVICE, count_error
+
+logger = logging.getLogger(__name__)
+
+# Коэффициент сглаживания для скользящих средних (EWMA)
+_EWMA_ALPHA = 0.2
+
+# Обработчик этапа: True — передать задачу дальше, False — задача завершена на этом этапе
+StageHandler = Callable[[Any], Awaitable[bool]]
+# Пакетный обработчик: по одному флагу на каждую задачу пакета, в том же порядке
+BatchHandler = Callable[[list], Awaitable[list[bool]]]
+# Можно ли добавить задачу (второй аргумент) к уже собранному пакету (первый)
+BatchFilter = Callable[[list, Any], bool]
+
+
+class _ChatAffinity:
+    """Привязка чата к шарду, пока у чата есть задачи на этапе."""
+    __slots__ = ("shard", "pending")
+
+    def __init__(self, shard: int):
+        self.shard = shard
+        self.pending = 0
+
+
+class PipelineStage:
+    """
+    Этап конвейера.
+
+    - У каждого воркера свой шард (PriorityQueue). Чат хэшируется на шард и остаётся на нём,
+      пока у него есть задачи на этапе, поэтому задачи одного чата проходят этап строго по порядку.
+    - queue_size ограничивает каждый шард: предыдущий этап ждёт на put(), пока здесь не освободится
+      место (обратное давление), так что пропускная способность определяется самым медленным этапом.
+    - Число активных воркеров меняется в пределах [min_workers, max_workers] по глубине очереди
+      и среднему времени ожидания (см. autoscale).
+    - Если задан batch_handler, воркер забирает из своего шарда подряд идущие задачи, которые
+      пропускает batch_filter (до batch_max), и обрабатывает их одним вызовом. Пакет собирается
+      только из уже ждущих задач, поэтому пакетирование не добавляет задержки.
+
+    Задача должна иметь атрибуты chat_id и enqueued_at и поддерживать сравнение (<).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: StageHandler,
+        min_workers: int,
+        max_workers: int,
+        initial_workers: Optional[int] = None,
+        queue_size: int = 0,
+    ):
+        self.name = name
+        self.handler = handler
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        start = initial_workers if initial_workers is not None else self.min_workers
+        self.active_workers = min(max(start, self.min_workers), self.max_workers)
+        # Шарды создаются сразу под максимум, активными считаются первые active_workers
+        self.shards: list[asyncio.PriorityQueue] = [
+            asyncio.PriorityQueue(maxsize=queue_size) for _ in range(self.max_workers)
+        ]
+        self.workers: dict[int, asyncio.Task] = {}
+        self.next_stage: Optional["PipelineStage"] = None
+        # Вызывается, когда задача покидает конвейер (успешно, досрочно или с ошибкой)
+        self.on_finish: Optional[Callable[[Any], None]] = None
+        # Вызывается при исключении в обработчике
+        self.on_error: Optional[Callable[[Any, Exception], Awaitable[None]]] = None
+        # Пакетная обработка (необязательно)
+        self.batch_handler: Optional[BatchHandler] = None
+        self.batch_filter: Optional[BatchFilter] = None
+        self.batch_max = 1
+        self.running = False
+        self._busy: set[int] = set()
+        self._affinity: dict[int, _ChatAffinity] = {}
+        self._last_busy_at = time.monotonic()
+        # Показатели: последние значения и скользящие средние (сек)
+        self.stats = {
+            "queue_wait_last": 0.0,
+            "queue_wait_avg": 0.0,
+            "service_time_last": 0.0,
+            "service_time_avg": 0.0,
+            "processed": 0,
+            "failed": 0,
+            "batches": 0,
+            "batched_jobs": 0,
+        }
+
+    # --- Управление ---
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for i in range(self.active_workers):
+            self._ensure_worker(i)
+        logger.info(f"Этап '{self.name}': запущено {len(self.workers)} воркеров")
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        for w in self.workers.values():
+            w.cancel()
+        self.workers.clear()
+
+    # --- Постановка задач ---
+    def _shard_for(self, chat_id: int) -> tuple[int, _ChatAffinity]:
+        affinity = self._affinity.get(chat_id)
+        if affinity is None:
+            affinity = _ChatAffinity(hash(chat_id) % self.active_workers)
+            self._affinity[chat_id] = affinity
+        affinity.pending += 1
+        return affinity.shard, affinity
+
+    def put_nowait(self, job) -> int:
+        """Ставит задачу без ожидания (для первого этапа). Возвращает позицию в шарде."""
+        index, _ = self._shard_for(job.chat_id)
+        job.enqueued_at = time.monotonic()
+        shard = self.shards[index]
+        shard.put_nowait(job)
+        return shard.qsize()
+
+    async def put(self, job):
+        """Ставит задачу, ожидая свободного места в шарде."""
+        index, _ = self._shard_for(job.chat_id)
+        job.enqueued_at = time.monotonic()
+        await self.shards[index].put(job)
+
+    def _release(self, chat_id: int):
+        affinity = self._affinity.get(chat_id)
+        if affinity:
+            affinity.pending -= 1
+            if affinity.pending <= 0:
+                del self._affinity[chat_id]
+
+    # --- Метрики ---
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.shards)
+
+    def _observe(self, key: str, value: float):
+        self.stats[f"{key}_last"] = value
+        avg = self.stats[f"{key}_avg"]
+        self.stats[f"{key}_avg"] = value if avg == 0.0 else avg + _EWMA_ALPHA * (value - avg)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "depth": self.depth(),
+            "workers": self.active_workers,
+            "busy": len(self._busy),
+        }
+
+    # --- Автомасштабирование ---
+    def _ensure_worker(self, index: int):
+        task = self.workers.get(index)
+        if task is None or task.done():
+            self.workers[index] = asyncio.create_task(self._worker(index))
+
+    def autoscale(self):
+        """Добавляет или снимает один воркер по текущей нагрузке этапа."""
+        depth = self.depth()
+        now = time.monotonic()
+        if depth or self._busy:
+            self._last_busy_at = now
+
+        if self.active_workers < self.max_workers and (
+            depth > self.active_workers * VOICE_SCALE_UP_DEPTH
+            or (depth and self.stats["queue_wait_avg"] > VOICE_SCALE_UP_WAIT)
+        ):
+            self._ensure_worker(self.active_workers)
+            self.active_workers += 1
+            logger.info(f"Этап '{self.name}': воркеров стало {self.active_workers} (в очереди {depth})")
+        elif (
+            self.active_workers > self.min_workers
+            and depth == 0
+            and now - self._last_busy_at > VOICE_SCALE_DOWN_IDLE
+        ):
+            self.active_workers -= 1
+            index = self.active_workers
+            # Простаивающий воркер снимаем сразу, занятый завершится сам после опустошения шарда
+            if index not in self._busy and self.shards[index].empty():
+                task = self.workers.pop(index, None)
+                if task:
+                    task.cancel()
+            self._last_busy_at = now
+            logger.info(f"Этап '{self.name}': воркеров стало {self.active_workers}")
+
+    # --- Воркер ---
+    def _collect_batch(self, shard: asyncio.PriorityQueue, job) -> list:
+        """Добирает к job ждущие в шарде задачи, пока они подходят для пакета."""
+        batch = [job]
+        if not self.batch_handler or self.batch_max <= 1 or not self.batch_filter or not self.batch_filter([], job):
+            return batch
+        while len(batch) < self.batch_max and not shard.empty():
+            candidate = shard.get_nowait()
+            if not self.batch_filter(batch, candidate):
+                # Возвращаем на место: очередь приоритетная, порядок не нарушится
+                shard.put_nowait(candidate)
+                shard.task_done()
+                break
+            batch.append(candidate)
+        return batch
+
+    async def _worker(self, index: int):
+        name = f"{self.name}-{index + 1}"
+        shard = self.shards[index]
+        logger.info(f"{name}: запущен")
+        while self.running:
+            batch = self._collect_batch(shard, await shard.get())
+            self._busy.add(index)
+            started = time.monotonic()
+            for job in batch:
+                self._observe("queue_wait", started - job.enqueued_at)
+                QUEUE_WAIT.observe(started - job.enqueued_at, stage=self.name)
+            results = [False] * len(batch)
+            try:
+                if len(batch) > 1:
+                    self.stats["batches"] += 1
+                    self.stats["batched_jobs"] += len(batch)
+                    logger.info(f"{name}: пакет из {len(batch)} задач")
+                    results = await self.batch_handler(batch)
+                else:
+                    results = [await self.handler(batch[0])]
+            except Exception as e:
+                self.stats["failed"] += len(batch)
+                count_error(f"voice_{self.name}", e)
+                logger.error(f"{name}: {e}", exc_info=True)
+                if self.on_error:
+                    for job in batch:
+                        try:
+                            await self.on_error(job, e)
+                        except Exception:
+                            logger.exception(f"{name}: ошибка в обработчике ошибок")
+            finally:
+                self._observe("service_time", time.monotonic() - started)
+                STAGE_SERVICE.observe(time.monotonic() - started, stage=self.name)
+                self.stats["processed"] += len(batch)
+
+            try:
+                for job, proceed in zip(batch, results):
+                    try:
+                        if proceed and self.next_stage:
+                            # Ждём места на следующем этапе; привязку чата держим до передачи,
+                            # чтобы следующая задача чата не обогнала эту через другой шард
+                            await self.next_stage.put(job)
+                        elif self.on_finish:
+                            self.on_finish(job)
+                    finally:
+                        self._release(job.chat_id)
+                        shard.task_done()
+            finally:
+                self._busy.discard(index)
+
+            # Воркер снят автомасштабированием — завершаемся, когда шард опустел
+            if index >= self.active_workers and shard.empty():
+                self.workers.pop(index, None)
+                break
+        logger.info(f"{name}: остановлен")
@@ -1,34 +1,33 @@
 # utils/helpers.py
-import re
 import logging
 from typing import Optional
 from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile
 from google.genai import types
 import requests
+from config import MESSAGE_CHUNK_CHARS, RESPONSE_DOCUMENT_CHARS
+from utils.telegram_html import markdown_to_html, split_html, html_to_text
 
 logger = logging.getLogger(__name__)
 
-def clean_html_tags(text: str) -> str:
-    """Удаление HTML тегов из текста"""
-    for tag in ['b', 'i', 'u', 's', 'code', 'pre']:
-        text = re.sub(fr'<{tag}>(.*?)(?=</{tag}>|$)', r'\1', text, flags=re.DOTALL)
-        text = re.sub(fr'</{tag}>', '', text)
-    return text
-
 def safe_html(text: str) -> str:
-    """Безопасное форматирование HTML для Telegram"""
-    # Базовое экранирование
-    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-    # Простая конвертация Markdown-подобной разметки в HTML
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
-    text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text)
-    text = re.sub(r'`(.*?)`', r'<code>\1</code>', text)
-    return clean_html_tags(text)
+    """Безопасное форматирование HTML для Telegram: Markdown ответа модели → сбалансированный HTML"""
+    return markdown_to_html(text)
+
+def split_long(text: str, chunk: int = MESSAGE_CHUNK_CHARS) -> list[str]:
+    """Разделение длинного HTML на части по абзацам/строкам/предложениям без разрыва тегов"""
+    return split_html(text, chunk)
 
-def split_long(text: str, chunk: int = 4000):
-    """Разделение длинного текста на части"""
-    for i in range(0, len(text), chunk):
-        yield text[i:i + chunk]
+async def _send_html_chunk(bot: Bot, chat_id: int, chunk: str, **params):
+    try:
+        await bot.send_message(chat_id=chat_id, text=chunk, parse_mode='HTML',
+                               disable_web_page_preview=True, **params)
+    except TelegramBadRequest as e:
+        # Рендер выдаёт корректный HTML; на случай непредвиденного — та же часть без разметки
+        logger.warning(f"Telegram не принял HTML ({e}), отправляю часть без форматирования")
+        await bot.send_message(chat_id=chat_id, text=html_to_text(chunk), parse_mode=None,
+                               disable_web_page_preview=True, **params)
 
 async def send_response(
     bot: Bot,
@@ -37,29 +36,29 @@ async def send_response(
     reply_to_message_id: Optional[int] = None
 ):
     """Отправка текстового ответа с обработкой форматирования (ASYNC для aiogram 3)"""
+    if len(text) > RESPONSE_DOCUMENT_CHARS:
+        await send_as_document(bot, chat_id, text, reply_to_message_id)
+        return
+    for i, chunk in enumerate(split_long(safe_html(text))):
+        params = {"reply_to_message_id": reply_to_message_id} if i == 0 and reply_to_message_id else {}
+        await _send_html_chunk(bot, chat_id, chunk, **params)
+
+async def send_as_document(
+    bot: Bot,
+    chat_id: int,
+    text: str,
+    reply_to_message_id: Optional[int] = None
+):
+    """Очень длинный ответ — одним файлом .md, начало ответа — в подписи (лимит подписи 1024)"""
+    preview = split_html(safe_html(text), 900)
+    caption = f"{preview[0]}\n…" if preview else None
+    document = BufferedInputFile(text.encode("utf-8"), filename="answer.md")
     try:
-        safe_text = safe_html(text)
-        chunks = list(split_long(safe_text))
-        for i, chunk in enumerate(chunks):
-            if i == 0 and reply_to_message_id:
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=chunk,
-                    reply_to_message_id=reply_to_message_id,
-                    parse_mode='HTML',
-                    disable_web_page_preview=True
-                )
-            else:
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=chunk,
-                    parse_mode='HTML',
-                    disable_web_page_preview=True
-                )
-    except Exception as e:
-        error_msg = f"⚠️ Ошибка форматирования: {str(e)}\n{text}"
-        # Резервная отправка без форматирования
-        await bot.send_message(chat_id, error_msg, parse_mode=None)
+        await bot.send_document(chat_id, document, caption=caption, parse_mode='HTML',
+                                reply_to_message_id=reply_to_message_id)
+    except TelegramBadRequest as e:
+        logger.warning(f"Telegram не принял подпись документа ({e}), отправляю без неё")
+        await bot.send_document(chat_id, document, reply_to_message_id=reply_to_message_id)
 
 async def send_command_response(
     bot: Bot,
@@ -70,7 +69,7 @@ async def send_command_response(
 ):
     """Отправка командного ответа (ASYNC для aiogram 3)"""
     try:
-        chunks = list(split_long(text))
+        chunks = split_long(text)
         for i, chunk in enumerate(chunks):
             params = {
                 "chat_id": chat_id,
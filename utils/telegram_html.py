@@ -0,0 +1,328 @@
+# utils/telegram_html.py
+"""Markdown ответа модели → HTML для Telegram за один проход и разбиение HTML на сообщения без разрыва тегов."""
+import html
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# --- Рендер Markdown → Telegram HTML ---
+_FENCE_RE = re.compile(r"^\s*```\s*([\w+#.-]*)\s*$")
+_HEADING_RE = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$")
+_QUOTE_RE = re.compile(r"^\s{0,3}>\s?(.*)$")
+_BULLET_RE = re.compile(r"^(\s*)[-*+]\s+(?=\S)")
+_HR_RE = re.compile(r"^\s{0,3}([-*_])(?:\s*\1){2,}\s*$")
+
+_SPOILER_OPEN = "<tg-spoiler>"
+_SPOILER_CLOSE = "</tg-spoiler>"
+# Маркер Markdown → тег Telegram
+_EMPHASIS_TAGS = {"**": "b", "__": "b", "*": "i", "_": "i", "~~": "s"}
+_LINK_SCHEMES = ("http://", "https://", "tg://", "mailto:")
+
+
+def escape_html(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _emphasis_marker(line: str, i: int) -> str | None:
+    c = line[i]
+    if c in "*_~" and line.startswith(c * 2, i):
+        return c * 2
+    if c in "*_":
+        return c
+    return None
+
+
+def render_inline(line: str) -> str:
+    """
+    Разметка внутри строки: **жирный**, *курсив*, __жирный__, _курсив_, ~~зачёркнутый~~, `код`,
+    [текст](ссылка) и готовые <tg-spoiler>. Один проход слева направо: открывающий маркер
+    запоминается на стеке как литерал и превращается в тег, только если нашёлся закрывающий —
+    поэтому незакрытая разметка остаётся обычным текстом, а теги всегда сбалансированы.
+    """
+    pieces: list[str] = []
+    stack: list[tuple[str, int]] = []  # (маркер, индекс его куска в pieces)
+    plain_start = 0
+    link_possible = "](" in line
+    n = len(line)
+    i = 0
+
+    def flush_plain(end: int):
+        if end > plain_start:
+            pieces.append(escape_html(line[plain_start:end]))
+
+    def close(marker: str, tag: str) -> bool:
+        """Закрывает маркер, если он открыт; всё, что открыто поверх него, остаётся литералом."""
+        for depth in range(len(stack) - 1, -1, -1):
+            if stack[depth][0] == marker:
+                index = stack[depth][1]
+                del stack[depth:]
+                pieces[index] = f"<{tag}>"
+                pieces.append(f"</{tag}>")
+                return True
+        return False
+
+    while i < n:
+        c = line[i]
+        if c == "`":
+            end = line.find("`", i + 1)
+            if end != -1:
+                flush_plain(i)
+                pieces.append(f"<code>{escape_html(line[i + 1:end])}</code>")
+                i = plain_start = end + 1
+                continue
+        elif c == "[" and link_possible:
+            mid = line.find("](", i + 1)
+            if mid == -1:
+                link_possible = False  # дальше в строке ссылок нет — больше не ищем
+            else:
+                end = line.find(")", mid + 2)
+                url = line[mid + 2:end].strip() if end != -1 else ""
+                if url.startswith(_LINK_SCHEMES) and " " not in url:
+                    flush_plain(i)
+                    pieces.append(f'<a href="{html.escape(url)}">{escape_html(line[i + 1:mid])}</a>')
+                    i = plain_start = end + 1
+                    continue
+        elif c == "<" and (line.startswith(_SPOILER_OPEN, i) or line.startswith(_SPOILER_CLOSE, i)):
+            flush_plain(i)
+            if line.startswith(_SPOILER_OPEN, i):
+                stack.append((_SPOILER_OPEN, len(pieces)))
+                pieces.append(escape_html(_SPOILER_OPEN))
+                i += len(_SPOILER_OPEN)
+            else:
+                if not close(_SPOILER_OPEN, "tg-spoiler"):
+                    pieces.append(escape_html(_SPOILER_CLOSE))
+                i += len(_SPOILER_CLOSE)
+            plain_start = i
+            continue
+        else:
+            marker = _emphasis_marker(line, i)
+            if marker:
+                prev = line[i - 1] if i else " "
+                nxt = line[i + len(marker)] if i + len(marker) < n else " "
+                word_char = marker[0] == "_"  # snake_case не считаем разметкой
+                can_close = not prev.isspace() and not (word_char and nxt.isalnum())
+                can_open = not nxt.isspace() and not (word_char and prev.isalnum())
+                flush_plain(i)
+                if not (can_close and close(marker, _EMPHASIS_TAGS[marker])):
+                    if can_open:
+                        stack.append((marker, len(pieces)))
+                    pieces.append(marker)
+                i = plain_start = i + len(marker)
+                continue
+        i += 1
+    flush_plain(n)
+    return "".join(pieces)
+
+
+def markdown_to_html(text: str) -> str:
+    """
+    Переводит Markdown из ответа модели в HTML, который принимает Telegram (parse_mode='HTML'):
+    блоки кода → <pre>, заголовки → <b>, цитаты → <blockquote>, маркеры списков → «•»,
+    строчная разметка — render_inline. Весь текст экранируется; результат всегда сбалансирован.
+    """
+    out: list[str] = []
+    quote: list[str] = []
+    code: list[str] | None = None
+    lang = ""
+
+    def flush_quote():
+        if quote:
+            out.append(f"<blockquote>{chr(10).join(quote)}</blockquote>")
+            quote.clear()
+
+    for line in text.split("\n"):
+        fence = _FENCE_RE.match(line)
+        if code is not None:
+            if fence and not fence.group(1):
+                out.append(_render_code(code, lang))
+                code = None
+            else:
+                code.append(line)
+            continue
+        if fence:
+            flush_quote()
+            code, lang = [], fence.group(1)
+            continue
+
+        match = _QUOTE_RE.match(line)
+        if match:
+            quote.append(render_inline(match.group(1)))
+            continue
+        flush_quote()
+
+        if _HR_RE.match(line):
+            out.append("——————")
+        elif (match := _HEADING_RE.match(line)):
+            out.append(f"<b>{render_inline(match.group(1))}</b>")
+        elif (match := _BULLET_RE.match(line)):
+            out.append(f"{match.group(1)}• {render_inline(line[match.end():])}")
+        else:
+            out.append(render_inline(line))
+
+    flush_quote()
+    if code is not None:
+        # Незакрытый блок кода — закрываем в конце ответа
+        out.append(_render_code(code, lang))
+    return "\n".join(out)
+
+
+def _render_code(lines: list[str], lang: str) -> str:
+    body = escape_html("\n".join(lines))
+    if lang:
+        return f'<pre><code class="language-{html.escape(lang)}">{body}</code></pre>'
+    return f"<pre>{body}</pre>"
+
+
+def html_to_text(text: str) -> str:
+    """Убирает теги и раскрывает сущности — для отправки без parse_mode."""
+    return html.unescape(re.sub(r"<[^>]+>", "", text))
+
+
+# --- Разбиение HTML на сообщения ---
+# Теги, сущности, перевод строки, пробелы, слова
+_HTML_TOKEN_RE = re.compile(r"<[^>]*>|&#?\w+;|\n|[^\S\n]+|[^<&\s]+|[<&]")
+_TAG_NAME_RE = re.compile(r"</?\s*([a-zA-Z][\w-]*)")
+_SENTENCE_END = (".", "!", "?", "…", ":", ";")
+
+# Приоритеты мест разреза: граница абзаца/блока > строка > предложение > пробел
+_BREAK_BLOCK, _BREAK_LINE, _BREAK_SENTENCE, _BREAK_SPACE = 3, 2, 1, 0
+
+
+def _tokens(text: str, max_word: int):
+    for match in _HTML_TOKEN_RE.finditer(text):
+        token = match.group(0)
+        if len(token) > max_word and token[0] not in "<&":
+            # Очень длинное «слово» (ссылка, base64) режем по символам
+            for i in range(0, len(token), max_word):
+                yield token[i:i + max_word]
+        else:
+            yield token
+
+
+def split_html(text: str, limit: int = 4000) -> list[str]:
+    """
+    Делит HTML на части не длиннее limit. Режет по границам абзацев и блоков кода, затем строк,
+    предложений и слов; сущности (&amp;) и теги не разрываются. Открытые на месте разреза теги
+    закрываются в конце части и открываются заново в начале следующей (в том числе <pre> с языком) —
+    их длина входит в limit.
+    """
+    if len(text) <= limit:
+        return [text] if text.strip() else []
+
+    chunks: list[str] = []
+    # cur[0] — теги, заново открытые в начале части
+    cur: list[str] = [""]
+    cur_len = 0
+    stack: list[tuple[str, str]] = []  # (имя тега, открывающий тег)
+    # Места разреза: (позиция в cur, приоритет, открытые теги, длина части до разреза)
+    breaks: list[tuple[int, int, tuple, int]] = []
+    prev_token = ""
+
+    def closers(tags) -> str:
+        return "".join(f"</{name}>" for name, _ in reversed(tags))
+
+    def cut():
+        nonlocal cur, cur_len, breaks
+        tail_closers = len(closers(stack))
+        # Разрез годится, если и часть до него с закрывающими тегами, и остаток с заново
+        # открытыми укладываются в limit
+        fitting = [
+            b for b in breaks
+            if b[3] + len(closers(b[2])) <= limit
+            and sum(len(tag) for _, tag in b[2]) + cur_len - b[3] + tail_closers <= limit
+        ]
+        # Лучший — с наивысшим приоритетом во второй половине части, иначе последний возможный;
+        # если не годится ни один, режем по концу части (она укладывается в limit всегда)
+        candidates = [b for b in fitting if b[3] >= limit // 2] or fitting
+        if candidates:
+            pos, _, tags, _ = max(candidates, key=lambda b: (b[1], b[0]))
+        else:
+            pos, tags = len(cur), tuple(stack)
+        head = "".join(cur[:pos]) + closers(tags)
+        if html_to_text(head).strip():
+            chunks.append(head)
+
+        # Пробелы и переводы строк на стыке не переносим в начало следующей части
+        start = pos
+        while start < len(cur) and not cur[start].strip():
+            start += 1
+        reopen = "".join(tag for _, tag in tags)
+        kept = {b[0]: b for b in breaks if b[0] > start}
+        old = cur
+        cur = [reopen]
+        cur_len = len(reopen)
+        breaks = []
+        for index in range(start, len(old)):
+            cur.append(old[index])
+            cur_len += len(old[index])
+            if index + 1 in kept:
+                _, prio, btags, _ = kept[index + 1]
+                breaks.append((len(cur), prio, btags, cur_len))
+
+    for token in _tokens(text, max(16, limit // 8)):
+        tag = None
+        if token.startswith("<"):
+            match = _TAG_NAME_RE.match(token)
+            if match:
+                tag = match.group(1).lower()
+
+        # Часть вместе с токеном и закрывающими тегами (включая тег, который откроет сам токен)
+        # должна уложиться в limit
+        opens = tag is not None and not token.startswith("</") and not token.endswith("/>")
+        extra = len(f"</{tag}>") if opens else 0
+        while len(cur) > 1 and cur_len + len(token) + len(closers(stack)) + extra > limit:
+            cut()
+
+        cur.append(token)
+        cur_len += len(token)
+
+        prio = None
+        if tag is not None:
+            if token.startswith("</"):
+                if stack and stack[-1][0] == tag:
+                    stack.pop()
+                if tag in ("pre", "blockquote"):
+                    prio = _BREAK_BLOCK
+            elif opens:
+                stack.append((tag, token))
+        elif token == "\n":
+            prio = _BREAK_BLOCK if prev_token == "\n" else _BREAK_LINE
+        elif not token.strip():
+            in_pre = any(name == "pre" for name, _ in stack)
+            if not in_pre:
+                prio = _BREAK_SENTENCE if prev_token.endswith(_SENTENCE_END) else _BREAK_SPACE
+        if prio is not None:
+            breaks.append((len(cur), prio, tuple(stack), cur_len))
+        prev_token = token
+
+    tail = "".join(cur)
+    if html_to_text(tail).strip():
+        chunks.append(tail)
+    # Одни только открытые теги (вложенные ссылки с длинными адресами) могут не поместиться в limit —
+    # такую часть отправляем без разметки
+    result = []
+    for chunk in chunks:
+        if len(chunk) <= limit:
+            result.append(chunk)
+            continue
+        logger.error(f"split_html: часть из {len(chunk)} символов не уложилась в {limit} с разметкой, отправляю текстом")
+        result.extend(_split_plain(html_to_text(chunk), limit))
+    return result
+
+
+def _split_plain(text: str, limit: int) -> list[str]:
+    """Экранированный текст частями не длиннее limit (сущности не разрываются)."""
+    parts: list[str] = []
+    cur = ""
+    for char in text:
+        escaped = escape_html(char)
+        if len(escaped) > limit:
+            escaped = " "  # сущность длиннее limit (limit < 5) — такой символ не передать
+        if len(cur) + len(escaped) > limit:
+            parts.append(cur)
+            cur = ""
+        cur += escaped
+    if cur.strip():
+        parts.append(cur)
+    return [part for part in parts if part.strip()]